@@ -1,146 +1,2885 @@
-from flask import Flask, request, jsonify, send_file, render_template_string
+import time
+# Instante de inicio de la importación, para el informe de arranque
+_import_started = time.perf_counter()
+
+from flask import Flask, Response, request, jsonify, send_file, render_template_string, stream_with_context
 from flask_cors import CORS
-import yt_dlp
+from werkzeug.middleware.proxy_fix import ProxyFix
 import os
+import sys
 import uuid
 import threading
-import time
+import importlib
 from pathlib import Path
 import shutil
+import subprocess
+import collections
+import functools
+import re
+import json
+import copy
+import hashlib
+import unicodedata
+import sqlite3
+import socket
+import zipfile
+import itertools
+import heapq
+import contextlib
+import math
+import struct
+import gzip
+import tempfile
+from urllib.parse import quote
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+# Duración de cada fase del arranque de este proceso (segundos)
+startup_timings = {}
+
+class LazyModule:
+    """Módulo que se importa en el primer acceso a uno de sus atributos"""
+    
+    def __init__(self, name):
+        self._name = name
+        self._module = None
+    
+    def __getattr__(self, attribute):
+        module = self._module
+        if module is None:
+            started = time.perf_counter()
+            module = importlib.import_module(self._name)
+            if self._module is None:
+                startup_timings[f'import_{self._name}'] = time.perf_counter() - started
+                self._module = module
+        return getattr(module, attribute)
+
+# yt-dlp carga cientos de módulos de extractores: se importa al usarlo por primera vez
+yt_dlp = LazyModule('yt_dlp')
+
+try:
+    import redis  # opcional, solo para STATE_BACKEND_URL=redis://...
+except ImportError:
+    redis = None
+
+try:
+    import brotli  # opcional, variante .br de la página principal
+except ImportError:
+    brotli = None
+
+try:
+    import fcntl  # para que un solo worker por máquina haga la limpieza
+except ImportError:
+    fcntl = None
 
 app = Flask(__name__)
 CORS(app)
 
 # Configuración
 DOWNLOAD_FOLDER = 'downloads'
-TEMP_FOLDER = 'temp'
+# Dentro de DOWNLOAD_FOLDER (el disco persistente en Render) para que los .part
+# sobrevivan a un despliegue y la descarga se retome
+TEMP_FOLDER = os.environ.get('TEMP_FOLDER', os.path.join(DOWNLOAD_FOLDER, '.temp'))
+
+# Crear carpetas si no existen
+os.makedirs(DOWNLOAD_FOLDER, exist_ok=True)
+os.makedirs(TEMP_FOLDER, exist_ok=True)
+
+# Configuración del planificador de trabajos
+DOWNLOAD_WORKERS = int(os.environ.get('DOWNLOAD_WORKERS', 4))
+TRANSCODE_WORKERS = int(os.environ.get('TRANSCODE_WORKERS', os.cpu_count() or 1))
+# Audios descargados (o descargándose) que pueden esperar a ffmpeg además de los que se
+# convierten; con la cola de conversión llena las descargas esperan y no se acumulan
+# archivos de origen en TEMP_FOLDER
+TRANSCODE_BACKLOG = int(os.environ.get('TRANSCODE_BACKLOG', DOWNLOAD_WORKERS))
+MAX_PENDING_JOBS = int(os.environ.get('MAX_PENDING_JOBS', 50))
+RETRY_AFTER_SECONDS = int(os.environ.get('RETRY_AFTER_SECONDS', 10))
+
+# Orden de la cola: primero los trabajos cortos, con clases de prioridad y envejecimiento.
+# Cada clase suma una penalización expresada en segundos de audio
+PRIORITY_PENALTIES = {
+    'interactive': 0,
+    'batch': float(os.environ.get('BATCH_PRIORITY_PENALTY', 1800)),
+}
+# Segundos de audio que descuenta un trabajo por cada segundo que espera (evita la inanición)
+JOB_AGING_RATE = float(os.environ.get('JOB_AGING_RATE', 10))
+# Duración supuesta de un trabajo cuyos metadatos aún no se conocen
+DEFAULT_JOB_DURATION = float(os.environ.get('DEFAULT_JOB_DURATION', 300))
+FFMPEG_BINARY = os.environ.get('FFMPEG_BINARY', 'ffmpeg')
+# Final de la salida de error de ffmpeg que se guarda en el error del trabajo
+FFMPEG_ERROR_CHARS = 2000
+
+# Descarga por rangos en paralelo (DOWNLOAD_CONNECTIONS=1 la desactiva)
+DOWNLOAD_CONNECTIONS = int(os.environ.get('DOWNLOAD_CONNECTIONS', 4))
+SEGMENT_SIZE = int(os.environ.get('SEGMENT_SIZE', 4 * 1024 * 1024))
+SEGMENT_RETRIES = int(os.environ.get('SEGMENT_RETRIES', 3))
+# Por debajo de este tamaño (si se conoce) se descarga con una sola conexión
+PARALLEL_MIN_BYTES = int(os.environ.get('PARALLEL_MIN_BYTES', 16 * 1024 * 1024))
+# Conexiones simultáneas al origen entre todas las descargas del proceso
+MAX_UPSTREAM_CONNECTIONS = int(os.environ.get('MAX_UPSTREAM_CONNECTIONS', DOWNLOAD_WORKERS * DOWNLOAD_CONNECTIONS))
+
+# Límites de un trabajo, comprobados con los metadatos antes de descargar (0 = sin límite)
+MAX_DURATION = int(os.environ.get('MAX_DURATION', 3 * 3600))
+MAX_FILESIZE = int(os.environ.get('MAX_FILESIZE', 500 * 1024 * 1024))
+# Fracción máxima del espacio libre en disco que puede ocupar un trabajo (origen + resultado)
+MAX_DISK_FRACTION = float(os.environ.get('MAX_DISK_FRACTION', 0.5))
+
+# Codificación MP3 por segmentos en paralelo para audios largos (SEGMENT_ENCODERS=1 la desactiva)
+SEGMENTED_ENCODE_MIN_DURATION = float(os.environ.get('SEGMENTED_ENCODE_MIN_DURATION', 20 * 60))
+SEGMENT_ENCODERS = int(os.environ.get('SEGMENT_ENCODERS', os.cpu_count() or 1))
+# Tramas de audio real que se codifican de más a cada lado de un corte
+SEGMENT_OVERLAP_FRAMES = int(os.environ.get('SEGMENT_OVERLAP_FRAMES', 4))
+
+# Formatos de salida: codificador y contenedor de ffmpeg, y códecs de origen
+# que se pueden copiar tal cual (remux) en lugar de recodificar
+AUDIO_FORMATS = {
+    'mp3': {
+        'encoder': 'libmp3lame', 'muxer': 'mp3', 'mimetype': 'audio/mpeg',
+        'download_format': 'bestaudio/best',
+        'source_codecs': ('mp3',), 'default_bitrate': 192, 'vbr': True,
+    },
+    'm4a': {
+        'encoder': 'aac', 'muxer': 'ipod', 'mimetype': 'audio/mp4',
+        'download_format': 'bestaudio[acodec^=mp4a]/bestaudio/best',
+        'source_codecs': ('mp4a', 'aac'), 'default_bitrate': None, 'vbr': False,
+    },
+    'opus': {
+        'encoder': 'libopus', 'muxer': 'opus', 'mimetype': 'audio/ogg',
+        'download_format': 'bestaudio[acodec=opus]/bestaudio/best',
+        'source_codecs': ('opus',), 'default_bitrate': None, 'vbr': True,
+    },
+    'flac': {
+        'encoder': 'flac', 'muxer': 'flac', 'mimetype': 'audio/flac',
+        'download_format': 'bestaudio/best',
+        'source_codecs': ('flac',), 'default_bitrate': None, 'vbr': False,
+        'lossless': True,
+    },
+}
+DEFAULT_FORMAT = 'mp3'
+ALLOWED_BITRATES = (64, 96, 128, 160, 192, 256, 320)
+# Bitrate usado al recodificar cuando se pidió "calidad de origen"
+FALLBACK_BITRATE = 192
+
+# Configuración de la caché de resultados
+CACHE_MAX_BYTES = int(os.environ.get('CACHE_MAX_BYTES', 800 * 1024 * 1024))
+CACHE_MAX_AGE = int(os.environ.get('CACHE_MAX_AGE', 24 * 3600))
+# Índice de la caché (junto a los archivos para que sobreviva a los reinicios)
+CACHE_INDEX_PATH = os.environ.get('CACHE_INDEX_PATH', os.path.join(DOWNLOAD_FOLDER, '.index.db'))
+# Un resultado pedido hace menos de esto puede estar enviándose y no se desaloja
+SERVE_GRACE = int(os.environ.get('SERVE_GRACE', 600))
+
+# Conserje en segundo plano: cuota de la caché y fragmentos huérfanos de TEMP_FOLDER
+JANITOR_INTERVAL = int(os.environ.get('JANITOR_INTERVAL', 300))
+TEMP_MAX_AGE = int(os.environ.get('TEMP_MAX_AGE', 3600))
+
+# Envío de archivos: '' (lo sirve el propio worker, con sendfile si el servidor lo
+# permite), 'x-sendfile' (Apache/lighttpd) o 'x-accel' (nginx, con una location
+# `internal` en X_ACCEL_PREFIX que apunte a DOWNLOAD_FOLDER)
+FILE_OFFLOAD = os.environ.get('FILE_OFFLOAD', '')
+X_ACCEL_PREFIX = os.environ.get('X_ACCEL_PREFIX', '/protected-downloads/')
+app.config['USE_X_SENDFILE'] = FILE_OFFLOAD == 'x-sendfile'
+
+# Configuración de la caché de metadatos (las URLs de los formatos caducan en unas horas)
+METADATA_TTL = int(os.environ.get('METADATA_TTL', 1800))
+METADATA_CACHE_SIZE = int(os.environ.get('METADATA_CACHE_SIZE', 1000))
+METADATA_CACHE_DIR = os.environ.get('METADATA_CACHE_DIR')  # opcional, persiste en disco
+METADATA_WORKERS = int(os.environ.get('METADATA_WORKERS', 8))
+# Instancias de YoutubeDL libres que se conservan por perfil de opciones
+YTDL_POOL_IDLE = int(os.environ.get('YTDL_POOL_IDLE', max(DOWNLOAD_WORKERS, METADATA_WORKERS)))
+MAX_BATCH_URLS = int(os.environ.get('MAX_BATCH_URLS', 50))
+
+# Configuración del canal de progreso (SSE / long-poll)
+PROGRESS_MIN_INTERVAL = float(os.environ.get('PROGRESS_MIN_INTERVAL', 0.25))
+# Frecuencia máxima con la que la descarga y ffmpeg publican su avance
+PROGRESS_UPDATE_INTERVAL = float(os.environ.get('PROGRESS_UPDATE_INTERVAL', 0.5))
+# Parte de la barra de progreso que corresponde a la descarga (el resto es la conversión)
+DOWNLOAD_PROGRESS_SHARE = 80
+PROGRESS_HEARTBEAT = float(os.environ.get('PROGRESS_HEARTBEAT', 15))
+# Muy por debajo del timeout de gunicorn (gunicorn.conf.py)
+LONG_POLL_MAX_WAIT = float(os.environ.get('LONG_POLL_MAX_WAIT', 20))
+
+# Almacén del progreso: memory:// (un worker), sqlite:///ruta.db (varios procesos
+# en una máquina) o redis://host:puerto/0 (varias máquinas)
+STATE_BACKEND_URL = os.environ.get('STATE_BACKEND_URL', 'memory://')
+STATE_POLL_INTERVAL = float(os.environ.get('STATE_POLL_INTERVAL', 0.2))
+# Caducidad del progreso: tras terminar, sin cambios (trabajos abandonados) y límite duro
+PROGRESS_TTL = int(os.environ.get('PROGRESS_TTL', 3600))
+PROGRESS_STALE_TTL = int(os.environ.get('PROGRESS_STALE_TTL', 24 * 3600))
+PROGRESS_MAX_ENTRIES = int(os.environ.get('PROGRESS_MAX_ENTRIES', 10000))
+
+# Límites por cliente (IP o API key) con cubos de fichas: capacidad y recarga por
+# segundo (un ritmo de 0 desactiva el límite). Con varios workers se comparten a
+# través de STATE_BACKEND_URL; con redis:// se aplican con scripts Lua, así que el
+# servidor debe admitir EVAL/EVALSHA (no vale un sustituto de Redis sin scripting)
+METADATA_RATE = float(os.environ.get('METADATA_RATE', 0.5))
+METADATA_BURST = float(os.environ.get('METADATA_BURST', 30))
+CONVERT_RATE = float(os.environ.get('CONVERT_RATE', 0.1))
+CONVERT_BURST = float(os.environ.get('CONVERT_BURST', 20))
+# Una conversión cuesta 1 más 1 por cada CONVERT_COST_SECONDS de audio
+CONVERT_COST_SECONDS = float(os.environ.get('CONVERT_COST_SECONDS', 600))
+# Conversiones simultáneas por cliente (0 = sin límite) y caducidad de su reserva
+# si el worker que la hizo muere sin liberarla
+MAX_CLIENT_JOBS = int(os.environ.get('MAX_CLIENT_JOBS', 5))
+CLIENT_JOB_TTL = int(os.environ.get('CLIENT_JOB_TTL', 3 * 3600))
+# API keys aceptadas (separadas por comas): cada una tiene sus límites en lugar de los de su IP
+API_KEYS = frozenset(key.strip() for key in os.environ.get('API_KEYS', '').split(',') if key.strip())
+# Proxies de confianza delante de la aplicación, para tomar la IP de X-Forwarded-For.
+# Detrás de un balanceador sin esto todos los clientes comparten la IP del proxy y,
+# con ella, un único cubo de límites. Sin proxy delante debe ser 0: cualquiera podría
+# falsear X-Forwarded-For (render_yaml.txt usa 1 por el balanceador de Render)
+TRUSTED_PROXIES = int(os.environ.get('TRUSTED_PROXIES', 0))
+if TRUSTED_PROXIES:
+    app.wsgi_app = ProxyFix(app.wsgi_app, x_for=TRUSTED_PROXIES)
+
+# Registro persistente de trabajos para recuperarlos tras un reinicio ('' lo desactiva).
+# Debe estar en almacenamiento persistente, como la caché
+JOB_STORE_PATH = os.environ.get('JOB_STORE_PATH', os.path.join(DOWNLOAD_FOLDER, '.jobs.db'))
+# Cada proceso renueva cada JOB_HEARTBEAT_INTERVAL segundos la concesión de sus
+# trabajos; los que llevan JOB_LEASE_TTL sin renovarse los reclama otro proceso
+JOB_HEARTBEAT_INTERVAL = float(os.environ.get('JOB_HEARTBEAT_INTERVAL', 30))
+JOB_LEASE_TTL = float(os.environ.get('JOB_LEASE_TTL', 90))
+# Arranque del servidor (gunicorn.conf.py lo fija en el maestro y lo heredan los
+# workers). Un jobs.db lo usa un solo servidor a la vez, así que las filas de otro
+# arranque son de procesos muertos y se reclaman sin esperar a su concesión; varios
+# procesos lanzados fuera de gunicorn deben compartir SERVER_BOOT_ID
+SERVER_BOOT_ID = os.environ.setdefault('SERVER_BOOT_ID', uuid.uuid4().hex[:12])
+
+# Configuración de las conversiones por lotes (listas de reproducción, canales)
+BATCH_WORKERS = int(os.environ.get('BATCH_WORKERS', 2))
+BATCH_PARALLELISM = int(os.environ.get('BATCH_PARALLELISM', 3))
+MAX_BATCH_ITEMS = int(os.environ.get('MAX_BATCH_ITEMS', 200))
+
+# Configuración de la conversión en streaming
+MAX_STREAMS = int(os.environ.get('MAX_STREAMS', TRANSCODE_WORKERS))
+STREAM_CHUNK_SIZE = int(os.environ.get('STREAM_CHUNK_SIZE', 64 * 1024))
+
+# Límites (segundos) de los histogramas de duración por etapa en /metrics
+STAGE_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600)
+
+class Counter:
+    """Contador de Prometheus con etiquetas (por proceso)"""
+    
+    def __init__(self, name, help_text, labelnames=()):
+        self.name = name
+        self.help_text = help_text
+        self.labelnames = labelnames
+        self.values = collections.defaultdict(float)
+        self.lock = threading.Lock()
+    
+    def inc(self, amount=1, **labels):
+        key = tuple(str(labels.get(name, '')) for name in self.labelnames)
+        with self.lock:
+            self.values[key] += amount
+    
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} counter"]
+        with self.lock:
+            for key, value in sorted(self.values.items()):
+                lines.append(f"{self.name}{format_labels(self.labelnames, key)} {value:g}")
+        return lines
+
+class Histogram:
+    """Histograma acumulativo de Prometheus con etiquetas (por proceso)"""
+    
+    def __init__(self, name, help_text, labelnames=(), buckets=STAGE_BUCKETS):
+        self.name = name
+        self.help_text = help_text
+        self.labelnames = labelnames
+        self.buckets = tuple(buckets)
+        # etiquetas -> [cuentas por límite..., suma, total]
+        self.values = {}
+        self.lock = threading.Lock()
+    
+    def observe(self, value, **labels):
+        key = tuple(str(labels.get(name, '')) for name in self.labelnames)
+        with self.lock:
+            counts = self.values.get(key)
+            if counts is None:
+                counts = self.values[key] = [0] * (len(self.buckets) + 2)
+            for index, bound in enumerate(self.buckets):
+                if value <= bound:
+                    counts[index] += 1
+            counts[-2] += value
+            counts[-1] += 1
+    
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} histogram"]
+        with self.lock:
+            for key, counts in sorted(self.values.items()):
+                for bound, count in zip(self.buckets, counts):
+                    labels = format_labels(self.labelnames + ('le',), key + (f'{bound:g}',))
+                    lines.append(f"{self.name}_bucket{labels} {count}")
+                labels = format_labels(self.labelnames + ('le',), key + ('+Inf',))
+                lines.append(f"{self.name}_bucket{labels} {counts[-1]}")
+                lines.append(f"{self.name}_sum{format_labels(self.labelnames, key)} {counts[-2]:g}")
+                lines.append(f"{self.name}_count{format_labels(self.labelnames, key)} {counts[-1]}")
+        return lines
+
+def format_labels(names, values):
+    if not names:
+        return ''
+    pairs = ','.join(
+        '{}="{}"'.format(name, value.replace('\\', '\\\\').replace('"', '\\"'))
+        for name, value in zip(names, values)
+    )
+    return '{' + pairs + '}'
+
+stage_seconds = Histogram(
+    'ytmp3_stage_seconds',
+    'Duración de cada etapa de una conversión',
+    ('stage',)
+)
+jobs_total = Counter('ytmp3_jobs_total', 'Trabajos terminados por resultado', ('outcome',))
+bytes_served = Counter('ytmp3_bytes_served_total', 'Bytes de audio enviados por el worker', ('route',))
+rate_limited = Counter('ytmp3_rate_limited_total', 'Solicitudes rechazadas por los límites por cliente', ('budget',))
+
+@contextlib.contextmanager
+def timed(stage, timings=None):
+    """Medir una etapa para /metrics y, si se pasa, para el desglose del trabajo"""
+    started = time.perf_counter()
+    yield
+    record_stage(stage, time.perf_counter() - started, timings)
+
+def record_stage(stage, elapsed, timings=None):
+    stage_seconds.observe(elapsed, stage=stage)
+    if timings is not None:
+        timings[stage] = round(elapsed, 3)
+
+class ProgressStore:
+    """Interfaz del almacén de progreso compartido
+    
+    Cada escritura incrementa la versión de la descarga, lo que permite a
+    SSE y long-poll esperar cambios. Por defecto la espera consulta la
+    versión periódicamente; el almacén en memoria la sobrescribe.
+    """
+    
+    poll_interval = STATE_POLL_INTERVAL
+    
+    def get(self, download_id):
+        raise NotImplementedError
+    
+    def set(self, download_id, progress):
+        raise NotImplementedError
+    
+    def delete(self, download_id):
+        raise NotImplementedError
+    
+    def version(self, download_id):
+        raise NotImplementedError
+    
+    def update(self, download_id, fields):
+        """Cambiar solo algunos campos del progreso"""
+        progress = self.get(download_id) or {}
+        progress.update(fields)
+        self.set(download_id, progress)
+    
+    def purge(self):
+        """Eliminar las entradas caducadas; devuelve cuántas se borraron"""
+        return 0
+    
+    def stats(self):
+        return {}
+    
+    @staticmethod
+    def ttl_for(progress):
+        # Lo terminado caduca pronto; lo que sigue en curso solo si lleva mucho sin cambiar
+        return PROGRESS_TTL if progress.get('status') in TERMINAL_STATUSES else PROGRESS_STALE_TTL
+    
+    def wait(self, download_id, since, timeout):
+        """Esperar a una versión posterior a `since`; devuelve la versión actual"""
+        deadline = time.monotonic() + timeout
+        while True:
+            current = self.version(download_id)
+            remaining = deadline - time.monotonic()
+            if current > since or remaining <= 0:
+                return current
+            time.sleep(min(self.poll_interval, remaining))
+
+_UNSET = object()
+
+class ProgressRecord:
+    """Registro de progreso con campos fijos que se actualiza en el sitio
+    
+    Los campos poco habituales (alias, lotes, tiempos...) van a `extra`.
+    """
+    
+    FIELDS = ('status', 'percent', 'stage', 'speed', 'eta', 'filename', 'title')
+    __slots__ = FIELDS + ('extra', 'version', 'updated_at', 'expires_at', 'size')
+    
+    def __init__(self):
+        self.version = 0
+        self.size = 0
+        self.clear()
+    
+    def clear(self):
+        for field in self.FIELDS:
+            setattr(self, field, _UNSET)
+        self.extra = None
+    
+    def update(self, progress):
+        for key, value in progress.items():
+            if key in self.FIELDS:
+                setattr(self, key, value)
+            else:
+                if self.extra is None:
+                    self.extra = {}
+                self.extra[key] = value
+    
+    def get(self, key, default=None):
+        if key in self.FIELDS:
+            value = getattr(self, key)
+            return default if value is _UNSET else value
+        return self.extra.get(key, default) if self.extra else default
+    
+    def as_dict(self):
+        progress = {field: getattr(self, field) for field in self.FIELDS if getattr(self, field) is not _UNSET}
+        if self.extra:
+            progress.update(self.extra)
+        return progress
+    
+    def measure(self):
+        """Tamaño aproximado en bytes (registro, valores y diccionario extra)"""
+        size = sys.getsizeof(self)
+        for field in self.FIELDS:
+            value = getattr(self, field)
+            if value is not _UNSET:
+                size += sys.getsizeof(value)
+        if self.extra:
+            size += sys.getsizeof(self.extra)
+            for key, value in self.extra.items():
+                size += sys.getsizeof(key) + sys.getsizeof(value)
+        return size
+
+class MemoryProgressStore(ProgressStore):
+    """Progreso en memoria del proceso (válido con un único worker)
+    
+    Las entradas caducan según `ttl_for` y nunca hay más de `max_entries`:
+    al superarlo se descartan las que llevan más tiempo sin cambiar.
+    """
+    
+    def __init__(self, max_entries=PROGRESS_MAX_ENTRIES):
+        self.condition = threading.Condition()
+        self.max_entries = max_entries
+        # download_id -> ProgressRecord, de la actualización más antigua a la más reciente
+        self.records = collections.OrderedDict()
+        self.total_bytes = 0
+        self.expired = 0
+        self.evicted = 0
+    
+    def get(self, download_id):
+        with self.condition:
+            record = self.records.get(download_id)
+            return record.as_dict() if record else None
+    
+    def set(self, download_id, progress):
+        with self.condition:
+            record = self.records.get(download_id)
+            if record is None:
+                record = self.records[download_id] = ProgressRecord()
+            else:
+                record.clear()
+                self.records.move_to_end(download_id)
+            self._apply(record, progress)
+    
+    def update(self, download_id, fields):
+        """Cambiar solo algunos campos, sin reconstruir el registro"""
+        with self.condition:
+            record = self.records.get(download_id)
+            if record is None:
+                record = self.records[download_id] = ProgressRecord()
+            else:
+                self.records.move_to_end(download_id)
+            self._apply(record, fields)
+    
+    def _apply(self, record, fields):
+        record.update(fields)
+        now = time.time()
+        record.version += 1
+        record.updated_at = now
+        record.expires_at = now + self.ttl_for(record)
+        size = record.measure()
+        self.total_bytes += size - record.size
+        record.size = size
+        self._purge(now)
+        self.condition.notify_all()
+    
+    def delete(self, download_id):
+        with self.condition:
+            if download_id in self.records:
+                self._remove(download_id)
+    
+    def version(self, download_id):
+        with self.condition:
+            return self._version(download_id)
+    
+    def _version(self, download_id):
+        record = self.records.get(download_id)
+        return record.version if record else 0
+    
+    def purge(self):
+        with self.condition:
+            now = time.time()
+            removed = self._purge(now)
+            # Repaso completo: entradas caducadas detrás de un trabajo largo aún vigente
+            for download_id, record in list(self.records.items()):
+                if record.expires_at <= now:
+                    self._remove(download_id)
+                    self.expired += 1
+                    removed += 1
+            return removed
+    
+    def _purge(self, now):
+        # Solo mira el principio (lo más antiguo), así que cada escritura cuesta O(1) amortizado
+        removed = 0
+        while self.records:
+            download_id, record = next(iter(self.records.items()))
+            if len(self.records) > self.max_entries:
+                self.evicted += 1
+            elif record.expires_at <= now:
+                self.expired += 1
+            else:
+                break
+            self._remove(download_id)
+            removed += 1
+        return removed
+    
+    def _remove(self, download_id):
+        record = self.records.pop(download_id)
+        self.total_bytes -= record.size
+    
+    def stats(self):
+        with self.condition:
+            return {
+                'entries': len(self.records),
+                'max_entries': self.max_entries,
+                'bytes': self.total_bytes,
+                'expired': self.expired,
+                'evicted': self.evicted,
+            }
+    
+    def wait(self, download_id, since, timeout):
+        deadline = time.monotonic() + timeout
+        with self.condition:
+            while self._version(download_id) <= since:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                self.condition.wait(remaining)
+            return self._version(download_id)
+
+class SQLiteDatabase:
+    """Base para tablas SQLite compartidas entre hilos y procesos"""
+    
+    schema = None
+    
+    def __init__(self, db_path):
+        self.db_path = db_path
+        self.local = threading.local()
+        # Conexión de un solo uso: así no queda ninguna abierta si el proceso hace fork
+        connection = sqlite3.connect(db_path, timeout=10, isolation_level=None)
+        try:
+            connection.executescript(self.schema)
+        finally:
+            connection.close()
+    
+    def _connection(self):
+        # Una conexión por hilo y por proceso (las conexiones no sobreviven a un fork)
+        connection = getattr(self.local, 'connection', None)
+        if connection is None or self.local.pid != os.getpid():
+            connection = sqlite3.connect(self.db_path, timeout=10, isolation_level=None)
+            connection.execute('PRAGMA journal_mode=WAL')
+            connection.execute('PRAGMA synchronous=NORMAL')
+            self.local.connection = connection
+            self.local.pid = os.getpid()
+        return connection
+    
+    @contextlib.contextmanager
+    def transaction(self):
+        """Transacción que toma el bloqueo de escritura desde el principio (leer y luego escribir)"""
+        connection = self._connection()
+        connection.execute('BEGIN IMMEDIATE')
+        try:
+            yield connection
+        except BaseException:
+            connection.execute('ROLLBACK')
+            raise
+        connection.execute('COMMIT')
+
+class SQLiteProgressStore(SQLiteDatabase, ProgressStore):
+    """Progreso en un archivo SQLite compartido por los workers de una máquina"""
+    
+    schema = (
+        'CREATE TABLE IF NOT EXISTS progress ('
+        'download_id TEXT PRIMARY KEY, data TEXT NOT NULL, '
+        'version INTEGER NOT NULL, updated_at REAL NOT NULL)'
+    )
+    
+    def get(self, download_id):
+        row = self._connection().execute(
+            'SELECT data FROM progress WHERE download_id = ?', (download_id,)
+        ).fetchone()
+        return json.loads(row[0]) if row else None
+    
+    def set(self, download_id, progress):
+        self._connection().execute(
+            'INSERT INTO progress (download_id, data, version, updated_at) VALUES (?, ?, 1, ?) '
+            'ON CONFLICT(download_id) DO UPDATE SET data = excluded.data, '
+            'version = progress.version + 1, updated_at = excluded.updated_at',
+            (download_id, json.dumps(progress), time.time())
+        )
+    
+    def delete(self, download_id):
+        self._connection().execute('DELETE FROM progress WHERE download_id = ?', (download_id,))
+    
+    def version(self, download_id):
+        row = self._connection().execute(
+            'SELECT version FROM progress WHERE download_id = ?', (download_id,)
+        ).fetchone()
+        return row[0] if row else 0
+    
+    def purge(self):
+        # Lo ejecuta el conserje; las escrituras no pagan el coste
+        connection = self._connection()
+        now = time.time()
+        terminal = ', '.join('?' * len(TERMINAL_STATUSES))
+        removed = connection.execute(
+            'DELETE FROM progress WHERE updated_at < ? OR (updated_at < ? AND '
+            f"json_extract(data, '$.status') IN ({terminal}))",
+            (now - PROGRESS_STALE_TTL, now - PROGRESS_TTL, *TERMINAL_STATUSES)
+        ).rowcount
+        removed += connection.execute(
+            'DELETE FROM progress WHERE download_id IN ('
+            'SELECT download_id FROM progress ORDER BY updated_at DESC LIMIT -1 OFFSET ?)',
+            (PROGRESS_MAX_ENTRIES,)
+        ).rowcount
+        return removed
+    
+    def stats(self):
+        entries, size = self._connection().execute(
+            'SELECT COUNT(*), COALESCE(SUM(LENGTH(data)), 0) FROM progress'
+        ).fetchone()
+        return {'entries': entries, 'max_entries': PROGRESS_MAX_ENTRIES, 'bytes': size}
+
+class RedisProgressStore(ProgressStore):
+    """Progreso en Redis (o cualquier cliente con get/set/delete/incr/expire)
+    
+    Los límites por cliente del mismo backend (RedisRateLimiter) necesitan
+    además scripts Lua, así que un sustituto sin scripting solo sirve aquí.
+    """
+    
+    def __init__(self, client, prefix='ytmp3:progress:'):
+        self.client = client
+        self.prefix = prefix
+    
+    def get(self, download_id):
+        data = self.client.get(self.prefix + download_id)
+        return json.loads(data) if data else None
+    
+    def set(self, download_id, progress):
+        # Redis borra las claves al caducar; el tope de memoria lo pone maxmemory
+        ttl = self.ttl_for(progress)
+        self.client.set(self.prefix + download_id, json.dumps(progress), ex=ttl)
+        self.client.incr(self.prefix + download_id + ':version')
+        self.client.expire(self.prefix + download_id + ':version', ttl)
+    
+    def delete(self, download_id):
+        self.client.delete(self.prefix + download_id, self.prefix + download_id + ':version')
+    
+    def version(self, download_id):
+        return int(self.client.get(self.prefix + download_id + ':version') or 0)
+
+def create_progress_store(url):
+    """Construir el almacén de progreso a partir de STATE_BACKEND_URL"""
+    if not url or url.startswith('memory://'):
+        return MemoryProgressStore()
+    if url.startswith('sqlite:///'):
+        return SQLiteProgressStore(url[len('sqlite:///'):])
+    if url.startswith(('redis://', 'rediss://', 'unix://')):
+        if redis is None:
+            raise RuntimeError("STATE_BACKEND_URL usa Redis pero el paquete 'redis' no está instalado")
+        return RedisProgressStore(redis.Redis.from_url(url))
+    raise ValueError(f"STATE_BACKEND_URL no soportado: {url}")
+
+# Almacén para el progreso de las descargas
+progress_store = create_progress_store(STATE_BACKEND_URL)
+
+class RateLimiter:
+    """Interfaz de los límites por cliente: cubos de fichas y trabajos simultáneos
+    
+    `take` cobra `cost` fichas del cubo `key` (capacidad `burst`, recarga de
+    `rate` fichas por segundo) y devuelve 0, o los segundos que faltan para
+    poder pagarlo, sin cobrar nada. Con `force` cobra siempre: el cubo puede
+    quedar en negativo (cobros a posteriori) o recuperar fichas (coste negativo).
+    """
+    
+    def take(self, key, cost, rate, burst, force=False):
+        raise NotImplementedError
+    
+    def acquire_job(self, client, download_id, limit):
+        """Reservar uno de los `limit` trabajos simultáneos del cliente"""
+        raise NotImplementedError
+    
+    def release_job(self, client, download_id):
+        raise NotImplementedError
+    
+    def purge(self):
+        """Borrar cubos llenos y reservas caducadas; devuelve cuántos se borraron"""
+        return 0
+    
+    def stats(self):
+        return {}
+    
+    @staticmethod
+    def spend(tokens, updated_at, now, cost, rate, burst, force):
+        """Recargar el cubo hasta `now` y cobrar `cost`; devuelve (fichas, espera)"""
+        tokens = min(burst, tokens + max(now - updated_at, 0) * rate)
+        if force or tokens >= cost:
+            return min(burst, tokens - cost), 0
+        return tokens, (cost - tokens) / rate
+
+class MemoryRateLimiter(RateLimiter):
+    """Límites en memoria del proceso (válidos con un único worker)"""
+    
+    def __init__(self):
+        self.lock = threading.Lock()
+        # clave -> (fichas, instante de la última cuenta, instante en que estará lleno)
+        self.buckets = {}
+        # cliente -> IDs de sus trabajos en curso
+        self.jobs = {}
+    
+    def take(self, key, cost, rate, burst, force=False):
+        now = time.time()
+        with self.lock:
+            tokens, updated_at, _ = self.buckets.get(key, (burst, now, now))
+            tokens, wait = self.spend(tokens, updated_at, now, cost, rate, burst, force)
+            self.buckets[key] = (tokens, now, now + (burst - tokens) / rate)
+        return wait
+    
+    def acquire_job(self, client, download_id, limit):
+        with self.lock:
+            jobs = self.jobs.setdefault(client, set())
+            if limit and len(jobs) >= limit:
+                return False
+            jobs.add(download_id)
+            return True
+    
+    def release_job(self, client, download_id):
+        with self.lock:
+            jobs = self.jobs.get(client)
+            if jobs is not None:
+                jobs.discard(download_id)
+                if not jobs:
+                    del self.jobs[client]
+    
+    def purge(self):
+        # Un cubo lleno es igual que uno que no existe
+        now = time.time()
+        with self.lock:
+            full = [key for key, (_, _, full_at) in self.buckets.items() if full_at <= now]
+            for key in full:
+                del self.buckets[key]
+            return len(full)
+    
+    def stats(self):
+        with self.lock:
+            return {'buckets': len(self.buckets), 'clients_with_jobs': len(self.jobs)}
+
+class SQLiteRateLimiter(SQLiteDatabase, RateLimiter):
+    """Límites en el SQLite compartido por los workers de una máquina"""
+    
+    schema = (
+        'CREATE TABLE IF NOT EXISTS rate_buckets ('
+        'key TEXT PRIMARY KEY, tokens REAL NOT NULL, '
+        'updated_at REAL NOT NULL, full_at REAL NOT NULL);'
+        'CREATE TABLE IF NOT EXISTS client_jobs ('
+        'client TEXT NOT NULL, download_id TEXT NOT NULL, expires_at REAL NOT NULL, '
+        'PRIMARY KEY (client, download_id))'
+    )
+    
+    def take(self, key, cost, rate, burst, force=False):
+        now = time.time()
+        with self.transaction() as connection:
+            row = connection.execute(
+                'SELECT tokens, updated_at FROM rate_buckets WHERE key = ?', (key,)
+            ).fetchone()
+            tokens, wait = self.spend(*(row or (burst, now)), now, cost, rate, burst, force)
+            connection.execute(
+                'INSERT OR REPLACE INTO rate_buckets (key, tokens, updated_at, full_at) VALUES (?, ?, ?, ?)',
+                (key, tokens, now, now + (burst - tokens) / rate)
+            )
+        return wait
+    
+    def acquire_job(self, client, download_id, limit):
+        now = time.time()
+        with self.transaction() as connection:
+            connection.execute('DELETE FROM client_jobs WHERE client = ? AND expires_at < ?', (client, now))
+            active = connection.execute(
+                'SELECT COUNT(*) FROM client_jobs WHERE client = ?', (client,)
+            ).fetchone()[0]
+            if limit and active >= limit:
+                return False
+            connection.execute(
+                'INSERT OR REPLACE INTO client_jobs (client, download_id, expires_at) VALUES (?, ?, ?)',
+                (client, download_id, now + CLIENT_JOB_TTL)
+            )
+        return True
+    
+    def release_job(self, client, download_id):
+        self._connection().execute(
+            'DELETE FROM client_jobs WHERE client = ? AND download_id = ?', (client, download_id)
+        )
+    
+    def purge(self):
+        connection = self._connection()
+        now = time.time()
+        removed = connection.execute('DELETE FROM rate_buckets WHERE full_at <= ?', (now,)).rowcount
+        removed += connection.execute('DELETE FROM client_jobs WHERE expires_at < ?', (now,)).rowcount
+        return removed
+    
+    def stats(self):
+        connection = self._connection()
+        buckets = connection.execute('SELECT COUNT(*) FROM rate_buckets').fetchone()[0]
+        clients = connection.execute('SELECT COUNT(DISTINCT client) FROM client_jobs').fetchone()[0]
+        return {'buckets': buckets, 'clients_with_jobs': clients}
+
+class RedisRateLimiter(RateLimiter):
+    """Límites en Redis; cada operación es un script Lua atómico en el servidor
+    
+    Necesita un servidor con scripting (register_script usa EVALSHA/EVAL).
+    """
+    
+    TAKE_SCRIPT = """
+        local now, cost = tonumber(ARGV[1]), tonumber(ARGV[2])
+        local rate, burst, force = tonumber(ARGV[3]), tonumber(ARGV[4]), ARGV[5] == '1'
+        local state = redis.call('HMGET', KEYS[1], 'tokens', 'updated_at')
+        local tokens = tonumber(state[1]) or burst
+        local updated_at = tonumber(state[2]) or now
+        tokens = math.min(burst, tokens + math.max(now - updated_at, 0) * rate)
+        local wait = 0
+        if force or tokens >= cost then
+            tokens = math.min(burst, tokens - cost)
+        else
+            wait = (cost - tokens) / rate
+        end
+        redis.call('HSET', KEYS[1], 'tokens', tostring(tokens), 'updated_at', tostring(now))
+        redis.call('EXPIRE', KEYS[1], math.ceil((burst - tokens) / rate) + 1)
+        return tostring(wait)
+    """
+    
+    ACQUIRE_SCRIPT = """
+        redis.call('ZREMRANGEBYSCORE', KEYS[1], '-inf', ARGV[1])
+        local limit = tonumber(ARGV[3])
+        if limit > 0 and redis.call('ZCARD', KEYS[1]) >= limit then
+            return 0
+        end
+        redis.call('ZADD', KEYS[1], ARGV[2], ARGV[4])
+        redis.call('EXPIRE', KEYS[1], ARGV[5])
+        return 1
+    """
+    
+    def __init__(self, client, prefix='ytmp3:limits:'):
+        self.client = client
+        self.prefix = prefix
+        self._take = client.register_script(self.TAKE_SCRIPT)
+        self._acquire = client.register_script(self.ACQUIRE_SCRIPT)
+    
+    def take(self, key, cost, rate, burst, force=False):
+        wait = self._take(keys=[self.prefix + 'bucket:' + key], args=[time.time(), cost, rate, burst, int(force)])
+        return float(wait)
+    
+    def acquire_job(self, client, download_id, limit):
+        # Redis caduca las claves por su cuenta: no hace falta purgar
+        now = time.time()
+        return bool(self._acquire(
+            keys=[self.prefix + 'jobs:' + client],
+            args=[now, now + CLIENT_JOB_TTL, limit, download_id, CLIENT_JOB_TTL]
+        ))
+    
+    def release_job(self, client, download_id):
+        self.client.zrem(self.prefix + 'jobs:' + client, download_id)
+
+def create_rate_limiter(url):
+    """Construir los límites por cliente sobre el mismo backend que el progreso"""
+    if not url or url.startswith('memory://'):
+        return MemoryRateLimiter()
+    if url.startswith('sqlite:///'):
+        return SQLiteRateLimiter(url[len('sqlite:///'):])
+    if url.startswith(('redis://', 'rediss://', 'unix://')):
+        return RedisRateLimiter(redis.Redis.from_url(url))
+    raise ValueError(f"STATE_BACKEND_URL no soportado: {url}")
+
+rate_limiter = create_rate_limiter(STATE_BACKEND_URL)
+
+# Presupuestos de cubo de fichas: ritmo de recarga y capacidad
+RATE_BUDGETS = {
+    'metadata': (METADATA_RATE, METADATA_BURST),
+    'convert': (CONVERT_RATE, CONVERT_BURST),
+}
+
+def client_id():
+    """Identidad del cliente para los límites: su API key (si es válida) o su IP"""
+    api_key = request.headers.get('X-API-Key')
+    if api_key and api_key in API_KEYS:
+        return 'key:' + hashlib.sha256(api_key.encode('utf-8')).hexdigest()[:16]
+    return 'ip:' + (request.remote_addr or 'unknown')
+
+def check_rate(client, budget, cost=1, force=False):
+    """Cobrar `cost` del presupuesto del cliente; devuelve 0 o los segundos a esperar"""
+    rate, burst = RATE_BUDGETS[budget]
+    if rate <= 0 or not client:
+        return 0
+    # Un coste mayor que la capacidad nunca se podría pagar
+    wait = rate_limiter.take(f'{budget}:{client}', min(cost, burst), rate, burst, force)
+    if wait:
+        rate_limited.inc(budget=budget)
+    return wait
+
+def conversion_cost(duration):
+    """Coste de una conversión según la duración del audio (desconocida: el mínimo)"""
+    return 1 + (duration or 0) / CONVERT_COST_SECONDS
+
+def acquire_client_job(client, download_id):
+    """Reservar un trabajo simultáneo del cliente; False si ya tiene MAX_CLIENT_JOBS"""
+    if not MAX_CLIENT_JOBS or not client:
+        return True
+    if rate_limiter.acquire_job(client, download_id, MAX_CLIENT_JOBS):
+        return True
+    rate_limited.inc(budget='jobs')
+    return False
+
+def release_client_job(client, download_id):
+    if MAX_CLIENT_JOBS and client:
+        rate_limiter.release_job(client, download_id)
+
+class JobStore(SQLiteDatabase):
+    """Registro persistente de trabajos pendientes para recuperarlos tras un reinicio
+    
+    Cada fila pertenece al proceso que la encoló, identificado por un ID de
+    arranque (host y pid se repiten entre despliegues de contenedores), y
+    tiene una concesión que el dueño renueva periódicamente (`updated_at`).
+    Las filas de un arranque anterior del servidor se reclaman enseguida;
+    las de este arranque, cuando caduca su concesión (murió un worker). Quien
+    la reclama vuelve a encolar el trabajo; las demasiado antiguas se descartan.
+    """
+    
+    schema = (
+        'CREATE TABLE IF NOT EXISTS jobs ('
+        'download_id TEXT PRIMARY KEY, url TEXT NOT NULL, job_key TEXT, '
+        'params TEXT NOT NULL, state TEXT NOT NULL, source_path TEXT, '
+        'owner TEXT NOT NULL, created_at REAL NOT NULL, updated_at REAL NOT NULL)'
+    )
+    
+    def __init__(self, db_path):
+        super().__init__(db_path)
+        self.lock = threading.Lock()
+        self.thread = None
+        self._owner = None
+        self._owner_pid = None
+    
+    def owner(self):
+        # Nuevo en cada proceso, también en los hijos de un fork
+        if self._owner_pid != os.getpid():
+            self._owner = f"{SERVER_BOOT_ID}:{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:12]}"
+            self._owner_pid = os.getpid()
+        return self._owner
+    
+    def save(self, job, state):
+        now = time.time()
+        self._connection().execute(
+            'INSERT OR REPLACE INTO jobs VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)',
+            (job.download_id, job.url, job.key, json.dumps(job.params), state,
+             job.source_path, self.owner(), job.created_at, now)
+        )
+    
+    def update(self, download_id, state, source_path=None):
+        self._connection().execute(
+            'UPDATE jobs SET state = ?, source_path = COALESCE(?, source_path), updated_at = ? '
+            'WHERE download_id = ?',
+            (state, source_path, time.time(), download_id)
+        )
+    
+    def remove(self, download_id):
+        self._connection().execute('DELETE FROM jobs WHERE download_id = ?', (download_id,))
+    
+    def ids(self):
+        """IDs de todos los trabajos registrados (de cualquier proceso)"""
+        return {row[0] for row in self._connection().execute('SELECT download_id FROM jobs')}
+    
+    def heartbeat(self):
+        """Renovar la concesión de los trabajos de este proceso"""
+        self._connection().execute(
+            'UPDATE jobs SET updated_at = ? WHERE owner = ?', (time.time(), self.owner())
+        )
+    
+    def claim_orphans(self, lease_ttl=JOB_LEASE_TTL, max_age=PROGRESS_STALE_TTL):
+        """Reclamar los trabajos de un arranque anterior o cuya concesión caducó"""
+        connection = self._connection()
+        now = time.time()
+        # Los abandonados hace demasiado se descartan; el conserje borrará sus fragmentos
+        connection.execute(
+            'DELETE FROM jobs WHERE updated_at < ? AND created_at < ?', (now - lease_ttl, now - max_age)
+        )
+        rows = connection.execute(
+            'SELECT download_id, url, job_key, params, state, source_path, owner, created_at, updated_at '
+            'FROM jobs WHERE updated_at < ? OR owner NOT LIKE ? ORDER BY created_at',
+            (now - lease_ttl, f'{SERVER_BOOT_ID}:%')
+        ).fetchall()
+        claimed = []
+        for download_id, url, job_key, params, state, source_path, owner, created_at, updated_at in rows:
+            # Solo uno de los procesos que compiten por la fila la consigue
+            cursor = connection.execute(
+                'UPDATE jobs SET owner = ?, updated_at = ? '
+                'WHERE download_id = ? AND owner = ? AND updated_at = ?',
+                (self.owner(), now, download_id, owner, updated_at)
+            )
+            if cursor.rowcount == 1:
+                job = Job(download_id, url, key=job_key, params=json.loads(params))
+                job.source_path = source_path
+                job.created_at = created_at
+                claimed.append((job, state))
+        return claimed
+    
+    def start(self, interval=JOB_HEARTBEAT_INTERVAL):
+        """Renovar las concesiones y reclamar huérfanos periódicamente en segundo plano"""
+        with self.lock:
+            if self.thread is None and interval > 0:
+                self.thread = threading.Thread(target=self._run, args=(interval,), name='job-lease', daemon=True)
+                self.thread.start()
+    
+    def _run(self, interval):
+        while True:
+            time.sleep(interval)
+            try:
+                self.heartbeat()
+                # Los trabajos de un worker muerto se reclaman en cuanto caduca su concesión
+                recover_jobs()
+            except Exception as e:
+                print(f"Error renovando los trabajos: {e}")
+
+# Funciones llamadas en cada cambio de progreso (p. ej. el modo ASGI despierta a sus clientes)
+progress_listeners = []
+
+def set_progress(download_id, progress):
+    """Guardar el progreso de una descarga y avisar a los suscriptores"""
+    progress_store.set(download_id, progress)
+    for listener in progress_listeners:
+        listener(download_id)
+
+def update_progress(download_id, fields):
+    """Cambiar solo algunos campos del progreso y avisar a los suscriptores"""
+    progress_store.update(download_id, fields)
+    for listener in progress_listeners:
+        listener(download_id)
+
+def resolve_download(download_id):
+    """ID cuyo progreso corresponde a una descarga (el líder si está agrupada)"""
+    progress = progress_store.get(download_id)
+    if progress and 'alias_of' in progress:
+        return progress['alias_of']
+    return download_id
+
+class ProgressHook:
+    """Hook de yt-dlp que publica el avance de la descarga
+    
+    yt-dlp lo llama en cada bloque recibido; solo se publica como mucho una
+    vez cada `interval` segundos, usando los bytes numéricos y reutilizando
+    siempre el mismo diccionario de campos.
+    """
+    
+    def __init__(self, download_id, interval=PROGRESS_UPDATE_INTERVAL):
+        self.download_id = download_id
+        self.interval = interval
+        self.next_update = 0.0
+        self.fields = {'status': 'downloading', 'percent': 0, 'speed': 'N/A', 'eta': 'N/A',
+                       'stage': 'Descargando audio...'}
+    
+    def __call__(self, d):
+        if d['status'] == 'downloading':
+            now = time.monotonic()
+            if now < self.next_update:
+                return
+            self.next_update = now + self.interval
+            
+            total = d.get('total_bytes') or d.get('total_bytes_estimate')
+            downloaded = d.get('downloaded_bytes') or 0
+            speed = d.get('speed')
+            eta = d.get('eta')
+            fields = self.fields
+            fields['percent'] = round(min(downloaded / total, 1) * DOWNLOAD_PROGRESS_SHARE, 1) if total else 0
+            fields['speed'] = f"{yt_dlp.utils.format_bytes(speed)}/s" if speed else 'N/A'
+            fields['eta'] = yt_dlp.utils.formatSeconds(eta) if eta is not None else 'N/A'
+            update_progress(self.download_id, fields)
+        elif d['status'] == 'finished':
+            set_progress(self.download_id, {
+                'status': 'converting',
+                'percent': DOWNLOAD_PROGRESS_SHARE,
+                'stage': 'Preparando conversión...'
+            })
+
+class FfmpegProgress:
+    """Lee la salida de `ffmpeg -progress` y publica el avance de la conversión"""
+    
+    def __init__(self, download_id, duration, interval=PROGRESS_UPDATE_INTERVAL):
+        self.download_id = download_id
+        # Duración del audio en microsegundos (sin ella no se puede calcular el porcentaje)
+        self.duration_us = duration * 1000000 if duration else None
+        self.interval = interval
+        self.next_update = 0.0
+        self.fields = {'percent': DOWNLOAD_PROGRESS_SHARE}
+    
+    def __call__(self, line):
+        # out_time_ms también está en microsegundos (nombre histórico de ffmpeg)
+        if not self.duration_us or not line.startswith(('out_time_us=', 'out_time_ms=')):
+            return
+        now = time.monotonic()
+        if now < self.next_update:
+            return
+        try:
+            done = int(line[12:])
+        except ValueError:
+            return  # N/A al principio
+        self.next_update = now + self.interval
+        share = 99 - DOWNLOAD_PROGRESS_SHARE
+        self.fields['percent'] = round(DOWNLOAD_PROGRESS_SHARE + share * min(done / self.duration_us, 1), 1)
+        update_progress(self.download_id, self.fields)
+
+class _HookSlot:
+    """Hook fijo de una instancia del pool que reenvía al hook del trabajo actual"""
+    
+    __slots__ = ('target',)
+    
+    def __init__(self):
+        self.target = None
+    
+    def __call__(self, d):
+        if self.target is not None:
+            self.target(d)
+
+class YoutubeDLPool:
+    """Instancias de YoutubeDL reutilizables, agrupadas por perfil de opciones
+    
+    Cada instancia conserva entre trabajos sus extractores ya inicializados
+    (con sus cachés de reproductor), las cookies y la sesión HTTP con las
+    conexiones keep-alive. Un hilo la saca del pool, la usa en exclusiva y la
+    devuelve; si el uso termina con una excepción inesperada se descarta por
+    si quedó en mal estado.
+    """
+    
+    def __init__(self, max_idle):
+        self.max_idle = max_idle
+        # perfil -> [(instancia, hook)] libres
+        self.idle = collections.defaultdict(list)
+        self.lock = threading.Lock()
+        self.pid = os.getpid()
+        self.created = 0
+        self.reused = 0
+        self.discarded = 0
+    
+    @contextlib.contextmanager
+    def checkout(self, profile, options, outtmpl=None, progress_hook=None):
+        """Usar una instancia del perfil dado (`options` solo se usa al crearla)"""
+        entry = self._take(profile)
+        if entry is None:
+            hook = _HookSlot()
+            entry = (yt_dlp.YoutubeDL(dict(options, progress_hooks=[hook])), hook)
+            with self.lock:
+                self.created += 1
+        ydl, hook = entry
+        if outtmpl:
+            ydl.params['outtmpl']['default'] = outtmpl
+        hook.target = progress_hook
+        
+        healthy = False
+        try:
+            yield ydl
+            healthy = True
+        except (GeneratorExit, yt_dlp.utils.DownloadError, JobRejected):
+            # Un video no disponible o rechazado, o un lote que se deja de iterar,
+            # no estropean la instancia
+            healthy = True
+            raise
+        finally:
+            hook.target = None
+            self._give_back(profile, entry, healthy)
+    
+    def _take(self, profile):
+        with self.lock:
+            if self.pid != os.getpid():
+                # Las sesiones HTTP no sobreviven a un fork: empezar de cero en el worker
+                self.idle = collections.defaultdict(list)
+                self.pid = os.getpid()
+            if self.idle[profile]:
+                self.reused += 1
+                return self.idle[profile].pop()
+        return None
+    
+    def _give_back(self, profile, entry, healthy):
+        with self.lock:
+            if healthy and len(self.idle[profile]) < self.max_idle:
+                self.idle[profile].append(entry)
+                return
+            self.discarded += 1
+        entry[0].close()
+    
+    def stats(self):
+        with self.lock:
+            return {
+                'idle': {profile: len(entries) for profile, entries in self.idle.items()},
+                'created': self.created,
+                'reused': self.reused,
+                'discarded': self.discarded,
+            }
+
+EXTRACT_OPTIONS = {
+    'quiet': True,
+    'no_warnings': True,
+}
+
+def extract_video_info(url, timings=None):
+    """Extraer la información completa del video, usando la caché de metadatos"""
+    info = metadata_cache.get(url)
+    if info is not None:
+        return info
+    
+    with timed('metadata', timings), ytdl_pool.checkout('extract', EXTRACT_OPTIONS) as ydl:
+        info = ydl.sanitize_info(ydl.extract_info(url, download=False))
+    
+    metadata_cache.put(url, info)
+    return copy.deepcopy(info)
+
+def get_video_info(url):
+    """Obtener información del video sin descargarlo"""
+    try:
+        info = extract_video_info(url)
+        return {
+            'title': info.get('title', 'Unknown'),
+            'duration': format_duration(info.get('duration', 0)),
+            'uploader': info.get('uploader', 'Unknown'),
+            'view_count': info.get('view_count', 0),
+            'thumbnail': info.get('thumbnail', ''),
+        }
+    except Exception as e:
+        raise Exception(f"Error obteniendo información del video: {str(e)}")
+
+def get_video_info_batch(urls):
+    """Obtener la información de varios videos en paralelo"""
+    def resolve(url):
+        try:
+            return {'url': url, 'success': True, 'info': get_video_info(url)}
+        except Exception as e:
+            return {'url': url, 'success': False, 'error': str(e)}
+    
+    with ThreadPoolExecutor(max_workers=min(METADATA_WORKERS, len(urls)) or 1) as pool:
+        return list(pool.map(resolve, urls))
+
+def format_duration(seconds):
+    """Convertir segundos a formato MM:SS o HH:MM:SS"""
+    if not seconds:
+        return "0:00"
+    
+    hours = seconds // 3600
+    minutes = (seconds % 3600) // 60
+    seconds = seconds % 60
+    
+    if hours > 0:
+        return f"{hours}:{minutes:02d}:{seconds:02d}"
+    else:
+        return f"{minutes}:{seconds:02d}"
+
+def parse_audio_params(data):
+    """Validar los parámetros de salida (formato, bitrate, VBR) de una petición"""
+    audio_format = str(data.get('format') or DEFAULT_FORMAT).lower()
+    if audio_format not in AUDIO_FORMATS:
+        raise ValueError(f"Formato no soportado: {audio_format}")
+    spec = AUDIO_FORMATS[audio_format]
+    
+    bitrate = data.get('bitrate') or spec['default_bitrate']
+    if bitrate is not None:
+        try:
+            bitrate = int(bitrate)
+        except (TypeError, ValueError):
+            raise ValueError(f"Bitrate no válido: {bitrate}")
+        if bitrate not in ALLOWED_BITRATES:
+            raise ValueError(f"Bitrate no soportado: {bitrate}")
+    
+    vbr = str(data.get('vbr', '')).lower() in ('1', 'true', 'yes', 'on')
+    if vbr and not spec['vbr']:
+        raise ValueError(f"VBR no disponible para {audio_format}")
+    
+    if spec.get('lossless'):
+        bitrate, vbr = None, False
+    return {'format': audio_format, 'bitrate': bitrate, 'vbr': vbr}
+
+DEFAULT_AUDIO_PARAMS = parse_audio_params({})
+
+def quality_label(params):
+    """Parte de la clave de caché que describe la calidad pedida"""
+    if AUDIO_FORMATS[params['format']].get('lossless'):
+        return 'lossless'
+    if params['bitrate'] is None:
+        return 'source'
+    return f"{params['bitrate']}v" if params['vbr'] else str(params['bitrate'])
+
+def result_key(extractor, video_id, params):
+    return result_cache.key(extractor, video_id, params['format'], quality_label(params))
+
+def can_remux(params, source_format):
+    """Si el audio de origen ya está en el códec pedido basta con copiarlo"""
+    spec = AUDIO_FORMATS[params['format']]
+    acodec = (source_format.get('acodec') or '').lower()
+    if not acodec.startswith(spec['source_codecs']):
+        return False
+    if params['bitrate'] is None:
+        return True
+    # Solo si el origen no supera el bitrate pedido (copiar no puede reducirlo)
+    source_bitrate = source_format.get('abr') or source_format.get('tbr')
+    return bool(source_bitrate) and source_bitrate <= params['bitrate'] * 1.05
+
+def _mp3_vbr_quality(bitrate):
+    # Correspondencia aproximada entre bitrate medio y los niveles -V de LAME
+    for minimum, quality in ((245, 0), (225, 1), (190, 2), (175, 3), (165, 4), (130, 5), (115, 6), (100, 7), (85, 8)):
+        if bitrate >= minimum:
+            return quality
+    return 9
+
+def ffmpeg_audio_args(params, remux=False):
+    """Argumentos de salida de ffmpeg para los parámetros pedidos"""
+    spec = AUDIO_FORMATS[params['format']]
+    if remux:
+        return ['-vn', '-codec:a', 'copy', '-f', spec['muxer']]
+    
+    args = ['-vn', '-codec:a', spec['encoder']]
+    if not spec.get('lossless'):
+        bitrate = params['bitrate'] or FALLBACK_BITRATE
+        if params['vbr'] and params['format'] == 'mp3':
+            args += ['-q:a', str(_mp3_vbr_quality(bitrate))]
+        else:
+            args += ['-b:a', f'{bitrate}k']
+        if params['format'] == 'opus':
+            args += ['-vbr', 'on' if params['vbr'] else 'constrained']
+    return args + ['-f', spec['muxer']]
+
+class JobRejected(Exception):
+    """Trabajo rechazado por los límites antes de descargar nada"""
+    
+    def __init__(self, reason, message):
+        super().__init__(message)
+        # 'live', 'duration', 'filesize' o 'disk'; se publica en el progreso
+        self.reason = reason
+
+def estimated_source_size(audio_format):
+    """Tamaño del formato elegido según yt-dlp, o calculado con su bitrate y duración"""
+    size = audio_format.get('filesize') or audio_format.get('filesize_approx')
+    if not size and audio_format.get('requested_formats'):
+        sizes = [f.get('filesize') or f.get('filesize_approx') for f in audio_format['requested_formats']]
+        size = sum(sizes) if all(sizes) else None
+    if not size:
+        bitrate = audio_format.get('tbr') or audio_format.get('abr')
+        if bitrate and audio_format.get('duration'):
+            size = bitrate * 125 * audio_format['duration']
+    return size
+
+def estimated_output_size(params, duration):
+    spec = AUDIO_FORMATS[params['format']]
+    # Sin pérdida se toma como cota el PCM de un CD (1411 kbps)
+    bitrate = 1411 if spec.get('lossless') else params['bitrate'] or FALLBACK_BITRATE
+    return bitrate * 125 * (duration or 0)
+
+def check_job_limits(info, audio_format, params):
+    """Lanzar JobRejected si el trabajo superaría los límites de duración, tamaño o disco"""
+    if info.get('is_live'):
+        raise JobRejected('live', "No se pueden convertir emisiones en directo")
+    
+    duration = info.get('duration')
+    if MAX_DURATION and duration and duration > MAX_DURATION:
+        raise JobRejected('duration', (
+            f"El video dura {format_duration(int(duration))} y el máximo permitido "
+            f"es {format_duration(MAX_DURATION)}"
+        ))
+    
+    size = estimated_source_size(dict(audio_format, duration=audio_format.get('duration') or duration))
+    if MAX_FILESIZE and size and size > MAX_FILESIZE:
+        raise JobRejected('filesize', (
+            f"El audio ocupa unos {yt_dlp.utils.format_bytes(size)} y el máximo permitido "
+            f"es {yt_dlp.utils.format_bytes(MAX_FILESIZE)}"
+        ))
+    
+    if MAX_DISK_FRACTION:
+        # El origen y la conversión conviven en TEMP_FOLDER hasta que el resultado
+        # pasa a la caché en DOWNLOAD_FOLDER, que puede estar en otro disco
+        output_size = estimated_output_size(params, duration)
+        needed = {TEMP_FOLDER: (size or 0) + output_size}
+        if os.stat(DOWNLOAD_FOLDER).st_dev != os.stat(TEMP_FOLDER).st_dev:
+            needed[DOWNLOAD_FOLDER] = output_size
+        for folder, amount in needed.items():
+            if amount > shutil.disk_usage(folder).free * MAX_DISK_FRACTION:
+                raise JobRejected('disk', "No hay espacio libre suficiente en el servidor para esta conversión")
+
+def download_audio(url, download_id, params=DEFAULT_AUDIO_PARAMS, timings=None):
+    """Descargar el mejor audio disponible (sin convertir) a la carpeta temporal"""
+    # Actualizar progreso inicial
+    set_progress(download_id, {
+        'status': 'starting',
+        'percent': 0,
+        'stage': 'Iniciando descarga...'
+    })
+    
+    # Configuración de yt-dlp (la conversión se hace aparte en el pool de ffmpeg)
+    output_template = os.path.join(TEMP_FOLDER, f"{download_id}.%(ext)s")
+    
+    ydl_opts = {
+        # Preferir un origen en el códec pedido para poder copiarlo sin recodificar
+        'format': AUDIO_FORMATS[params['format']]['download_format'],
+        'outtmpl': output_template,
+        # Retomar el .part de un intento anterior (petición Range) tras un reinicio
+        'continuedl': True,
+        # Por si el tamaño no se conocía de antemano: yt-dlp corta al ver Content-Length
+        'max_filesize': MAX_FILESIZE or None,
+        'quiet': True,
+        'no_warnings': True,
+    }
+    
+    # La extracción se comparte con /api/video-info a través de la caché de metadatos
+    info = extract_video_info(url, timings)
+    # La extracción eligió el formato por defecto (video+audio); process_ie_result
+    # solo actualiza la información con el formato nuevo, así que la selección
+    # anterior sobreviviría y se descargaría (y mezclaría) el video también
+    for key in ('requested_formats', 'requested_downloads'):
+        info.pop(key, None)
+    
+    hook = ProgressHook(download_id)
+    # Una instancia por formato de origen; la plantilla y el hook son de este trabajo
+    with ytdl_pool.checkout(f"download:{params['format']}", ydl_opts,
+                            outtmpl=output_template, progress_hook=hook) as ydl:
+        # Otro trabajo pudo haber dejado el resultado en caché mientras esperábamos
+        cache_key = result_key(info.get('extractor_key'), info.get('id'), params)
+        # La consulta de enqueue_conversion ya contó el fallo; aquí no se vuelve a contar
+        if result_cache.contains(cache_key):
+            return info, None
+        
+        # Elegir el formato sin descargar: su tamaño decide si se admite el trabajo
+        # y si se puede descargar por rangos
+        selected = ydl.process_ie_result(copy.deepcopy(info), download=False)
+        check_job_limits(info, selected, params)
+        
+        with timed('download', timings):
+            source = segmented_download(ydl, selected, download_id, hook)
+            if source is not None:
+                return selected, source
+            # yt-dlp descarga con una conexión, que cuenta igual para MAX_UPSTREAM_CONNECTIONS
+            with upstream_slots:
+                info = ydl.process_ie_result(info, download=True)
+        downloads = info.get('requested_downloads') or [{}]
+        source = downloads[0].get('filepath') or ydl.prepare_filename(info)
+        # Al pasar de max_filesize yt-dlp aborta la descarga sin lanzar ninguna excepción
+        if MAX_FILESIZE and not os.path.exists(source):
+            raise JobRejected('filesize', (
+                f"El audio supera el máximo permitido de {yt_dlp.utils.format_bytes(MAX_FILESIZE)}"
+            ))
+    
+    return info, source
+
+class RangeNotSupported(Exception):
+    pass
+
+def fetch_segment(ydl, url, headers, start, end):
+    """Descargar los bytes [start, end] con reintentos; devuelve (datos, tamaño total)"""
+    request_headers = dict(headers, Range=f'bytes={start}-{end}')
+    for attempt in range(SEGMENT_RETRIES + 1):
+        try:
+            with upstream_slots:
+                response = ydl.urlopen(yt_dlp.networking.Request(url, headers=request_headers))
+                try:
+                    content_range = response.headers.get('Content-Range') or ''
+                    if response.status != 206 or '/' not in content_range:
+                        raise RangeNotSupported(f"HTTP {response.status} sin Content-Range")
+                    data = response.read()
+                finally:
+                    response.close()
+            total = content_range.rsplit('/', 1)[1]
+            total = int(total) if total.isdigit() else None
+            expected = end - start + 1 if total is None else min(end, total - 1) - start + 1
+            if len(data) != expected:
+                raise IOError(f"segmento incompleto ({len(data)} de {expected} bytes)")
+            return data, total
+        except RangeNotSupported:
+            raise
+        except Exception:
+            if attempt == SEGMENT_RETRIES:
+                raise
+            time.sleep(min(2 ** attempt, 10))
+
+def segmented_download(ydl, selected, download_id, hook):
+    """Descargar un formato HTTP con varias conexiones por rangos
+    
+    Los segmentos se piden en paralelo (como mucho DOWNLOAD_CONNECTIONS por
+    descarga y MAX_UPSTREAM_CONNECTIONS en total) y se escriben en orden,
+    así que el .part es siempre un prefijo válido y se puede retomar. Devuelve
+    la ruta del archivo, o None si el formato no admite este modo y debe
+    descargarlo yt-dlp.
+    """
+    size = selected.get('filesize') or selected.get('filesize_approx')
+    if (DOWNLOAD_CONNECTIONS < 2 or selected.get('requested_formats')
+            or selected.get('protocol') not in ('http', 'https') or not selected.get('url')
+            or (size and size < PARALLEL_MIN_BYTES)):
+        return None
+    
+    url = selected['url']
+    headers = selected.get('http_headers') or {}
+    path = os.path.join(TEMP_FOLDER, f"{download_id}.{selected['ext']}")
+    part_path = f"{path}.part"
+    
+    # Retomar desde el último segmento completo de un intento anterior
+    # (se repite el último por si quedó a medias)
+    offset = 0
+    if os.path.exists(part_path) and os.path.getsize(part_path):
+        offset = (os.path.getsize(part_path) - 1) // SEGMENT_SIZE * SEGMENT_SIZE
+    
+    try:
+        first, total = fetch_segment(ydl, url, headers, offset, offset + SEGMENT_SIZE - 1)
+    except RangeNotSupported:
+        return None
+    if total is None:
+        return None
+    if MAX_FILESIZE and total > MAX_FILESIZE:
+        raise JobRejected('filesize', (
+            f"El audio ocupa {yt_dlp.utils.format_bytes(total)} y el máximo permitido "
+            f"es {yt_dlp.utils.format_bytes(MAX_FILESIZE)}"
+        ))
+    
+    started = time.monotonic()
+    resumed_from = offset
+    with open(part_path, 'r+b' if offset else 'wb') as output, \
+            ThreadPoolExecutor(max_workers=DOWNLOAD_CONNECTIONS, thread_name_prefix='segment') as pool:
+        output.truncate(offset)
+        output.seek(offset)
+        output.write(first)
+        offset += len(first)
+        
+        # Ventana de segmentos en vuelo: limita la memoria a DOWNLOAD_CONNECTIONS segmentos
+        starts = iter(range(offset, total, SEGMENT_SIZE))
+        window = collections.deque()
+        for start in itertools.islice(starts, DOWNLOAD_CONNECTIONS):
+            window.append(pool.submit(fetch_segment, ydl, url, headers, start, start + SEGMENT_SIZE - 1))
+        try:
+            while window:
+                data, _ = window.popleft().result()
+                output.write(data)
+                offset += len(data)
+                start = next(starts, None)
+                if start is not None:
+                    window.append(pool.submit(fetch_segment, ydl, url, headers, start, start + SEGMENT_SIZE - 1))
+                
+                elapsed = time.monotonic() - started
+                speed = (offset - resumed_from) / elapsed if elapsed else None
+                hook({
+                    'status': 'downloading',
+                    'downloaded_bytes': offset,
+                    'total_bytes': total,
+                    'speed': speed,
+                    'eta': int((total - offset) / speed) if speed else None,
+                })
+        finally:
+            for future in window:
+                future.cancel()
+    
+    os.replace(part_path, path)
+    hook({'status': 'finished', 'downloaded_bytes': total, 'total_bytes': total})
+    return path
+
+# Tramas MPEG-1 Layer III: 1152 muestras cada una y 576 de retardo del codificador LAME
+MP3_FRAME_SAMPLES = 1152
+MP3_ENCODER_DELAY = 576
+MP3_BITRATES = (0, 32, 40, 48, 56, 64, 80, 96, 112, 128, 160, 192, 224, 256, 320)
+MP3_SAMPLE_RATES = (44100, 48000, 32000)
+
+def mp3_frames(data):
+    """Posición y tamaño de cada trama MPEG-1 Layer III de `data`"""
+    offset = 0
+    while offset + 4 <= len(data):
+        header = int.from_bytes(data[offset:offset + 4], 'big')
+        bitrate_index = header >> 12 & 0xF
+        rate_index = header >> 10 & 0x3
+        if header >> 17 != 0x7FFD or not 0 < bitrate_index < 15 or rate_index == 3:
+            raise ValueError(f"Trama MP3 no válida en el byte {offset}")
+        length = 144000 * MP3_BITRATES[bitrate_index] // MP3_SAMPLE_RATES[rate_index] + (header >> 9 & 1)
+        yield offset, length
+        offset += length
+
+def mp3_info_offset(frame):
+    """Posición de la cabecera Xing/Info dentro de la primera trama, o None"""
+    # Tras la cabecera de 4 bytes va la información lateral: 17 bytes en mono, 32 en estéreo
+    offset = 4 + (17 if (frame[3] >> 6) == 3 else 32)
+    return offset if frame[offset:offset + 4] in (b'Xing', b'Info') else None
+
+def lame_crc16(data):
+    """CRC-16 (polinomio 0x8005 reflejado) que usa la etiqueta LAME"""
+    crc = 0
+    for byte in data:
+        crc ^= byte
+        for _ in range(8):
+            crc = (crc >> 1) ^ 0xA001 if crc & 1 else crc >> 1
+    return crc
+
+def write_mp3_info_frame(template, offsets, total_bytes, padding):
+    """Rehacer la trama Xing/Info de `template` para el archivo completo
+    
+    `offsets` son las posiciones de las tramas de audio dentro del archivo y
+    `total_bytes` su tamaño, ambos contando la propia trama Xing/Info.
+    """
+    frame = bytearray(template)
+    xing = mp3_info_offset(frame)
+    flags = struct.unpack_from('>I', frame, xing + 4)[0]
+    if flags & 0x0F != 0x0F:
+        raise ValueError("Cabecera Xing incompleta")
+    # Tabla de búsqueda: posición (en 1/256 del archivo) de cada 1% de la duración
+    toc = bytes(min(offsets[len(offsets) * percent // 100] * 256 // total_bytes, 255) for percent in range(100))
+    struct.pack_into('>II100s', frame, xing + 8, len(offsets), total_bytes, toc)
+    lame = xing + 120
+    if frame[lame:lame + 4] in (b'LAME', b'Lavc', b'Lavf'):
+        # Retardo y relleno (12 bits cada uno) para la reproducción sin huecos
+        frame[lame + 21:lame + 24] = (MP3_ENCODER_DELAY << 12 | min(padding, 0xFFF)).to_bytes(3, 'big')
+        # Sin CRC del audio: calcularlo en Python costaría más que la propia unión
+        struct.pack_into('>IH', frame, lame + 28, total_bytes, 0)
+        struct.pack_into('>H', frame, lame + 34, lame_crc16(frame[:190]))
+    return bytes(frame)
+
+def mp3_encoder_padding(frame):
+    """Relleno final que indica la etiqueta LAME de una trama Xing/Info, o None"""
+    xing = mp3_info_offset(frame)
+    lame = xing + 120
+    if frame[lame:lame + 4] not in (b'LAME', b'Lavc', b'Lavf'):
+        return None
+    return int.from_bytes(frame[lame + 21:lame + 24], 'big') & 0xFFF
+
+def segmented_encode_count(params, remux, duration):
+    """Número de segmentos en que conviene codificar el audio (1 = de una vez)"""
+    if params['format'] != 'mp3' or remux or not duration or duration < SEGMENTED_ENCODE_MIN_DURATION:
+        return 1
+    return max(SEGMENT_ENCODERS, 1)
+
+def encode_mp3_segment(source, output, params, sample_rate, start, count):
+    """Codificar `count` muestras de `source` desde la muestra `start` (o hasta el final si es None)
+    
+    Sin depósito de bits (-reservoir 0) cada trama se decodifica por sí sola,
+    así que las tramas de distintos segmentos se pueden recortar y unir.
+    """
+    # Se decodifica desde el principio: buscar con -ss no es exacto a la muestra
+    # en todos los contenedores y decodificar cuesta mucho menos que codificar
+    filters = f'aresample={sample_rate},atrim=start_sample={start}'
+    if count is not None:
+        filters += f':end_sample={start + count}'
+    command = [
+        FFMPEG_BINARY, '-y', '-loglevel', 'error', '-nostdin',
+        '-i', source, '-af', filters, *ffmpeg_audio_args(params),
+        '-reservoir', '0', '-id3v2_version', '0', output,
+    ]
+    result = subprocess.run(command, capture_output=True, text=True)
+    if result.returncode != 0:
+        raise Exception(f"ffmpeg falló: {result.stderr.strip()}")
+    return output
+
+def encode_mp3_segmented(source, temp_file, download_id, params, source_format, segments):
+    """Codificar a MP3 repartiendo el audio en segmentos que se codifican en paralelo
+    
+    Los cortes caen en múltiplos de 1152 muestras, así que la trama k de un
+    segmento que empieza en el corte c es la trama c/1152 + k del archivo
+    completo. Cada segmento se codifica con SEGMENT_OVERLAP_FRAMES tramas de
+    más a cada lado para que el codificador vea el audio real junto al
+    corte; esas tramas se descartan al unir y el resultado se reproduce sin
+    huecos. La trama Xing/Info se rehace para el archivo completo.
+    """
+    sample_rate = source_format.get('asr')
+    if sample_rate not in MP3_SAMPLE_RATES:
+        sample_rate = 44100
+    total_frames = -(-int(source_format['duration'] * sample_rate) // MP3_FRAME_SAMPLES)
+    frames_per_segment = -(-total_frames // segments)
+    overlap = SEGMENT_OVERLAP_FRAMES
+    
+    # (primera trama, tramas a conservar) de cada segmento; el último llega hasta el final
+    plan = [(index * frames_per_segment, frames_per_segment) for index in range(segments)]
+    plan[-1] = (plan[-1][0], None)
+    parts = [f"{temp_file}.part{index}" for index in range(segments)]
+    futures = {}
+    try:
+        for index, (first, keep) in enumerate(plan):
+            skip = min(first, overlap)
+            count = (skip + keep + overlap) * MP3_FRAME_SAMPLES if keep is not None else None
+            future = segment_pool.submit(
+                encode_mp3_segment, source, parts[index], params, sample_rate,
+                (first - skip) * MP3_FRAME_SAMPLES, count,
+            )
+            futures[future] = index
+        
+        share = 99 - DOWNLOAD_PROGRESS_SHARE
+        for done, future in enumerate(as_completed(futures), 1):
+            future.result()
+            update_progress(download_id, {'percent': round(DOWNLOAD_PROGRESS_SHARE + share * done / segments, 1)})
+        
+        offsets = []
+        template = padding = None
+        with open(temp_file, 'wb') as output:
+            for index, (first, keep) in enumerate(plan):
+                with open(parts[index], 'rb') as part:
+                    data = part.read()
+                frames = list(mp3_frames(data))
+                if not frames or mp3_info_offset(data[:frames[0][1]]) is None:
+                    raise Exception("ffmpeg no escribió la cabecera Xing del segmento")
+                info_frame = data[:frames[0][1]]
+                if template is None:
+                    # Hueco para la trama Xing/Info, que se escribe al final
+                    template = info_frame
+                    output.write(bytes(len(template)))
+                skip = min(first, overlap)
+                kept = frames[1 + skip:] if keep is None else frames[1 + skip:1 + skip + keep]
+                if keep is not None and len(kept) < keep:
+                    raise Exception("El audio es más corto de lo que indica su duración")
+                if keep is None:
+                    # El relleno final del archivo es el del último segmento
+                    padding = mp3_encoder_padding(info_frame)
+                position = output.tell()
+                start = kept[0][0] if kept else 0
+                offsets.extend(position + offset - start for offset, _ in kept)
+                if kept:
+                    output.write(data[start:kept[-1][0] + kept[-1][1]])
+                del data
+            total_bytes = output.tell()
+            if padding is None:
+                padding = len(offsets) * MP3_FRAME_SAMPLES - MP3_ENCODER_DELAY - int(source_format['duration'] * sample_rate)
+            output.seek(0)
+            output.write(write_mp3_info_frame(template, offsets, total_bytes, max(padding, 0)))
+    finally:
+        for future in futures:
+            future.cancel()
+        for part in parts:
+            with contextlib.suppress(OSError):
+                os.remove(part)
+
+def transcode_audio(source, download_id, params=DEFAULT_AUDIO_PARAMS, source_format=None, timings=None):
+    """Convertir el audio descargado con ffmpeg (o copiarlo si el códec ya coincide)"""
+    source_format = source_format or {}
+    remux = can_remux(params, source_format)
+    segments = segmented_encode_count(params, remux, source_format.get('duration'))
+    stage = 'Copiando audio sin recodificar...' if remux else f"Convirtiendo a {params['format'].upper()}..."
+    if segments > 1:
+        stage = f"Convirtiendo a {params['format'].upper()} en {segments} segmentos..."
+    set_progress(download_id, {
+        'status': 'converting',
+        'percent': DOWNLOAD_PROGRESS_SHARE,
+        'stage': stage,
+        'remux': remux
+    })
+    
+    temp_file = os.path.join(TEMP_FOLDER, f"{download_id}.{params['format']}")
+    command = [
+        FFMPEG_BINARY, '-y', '-loglevel', 'error', '-nostats',
+        # Avance en formato clave=valor por la salida estándar
+        '-progress', 'pipe:1',
+        '-i', source,
+        *ffmpeg_audio_args(params, remux),
+        temp_file,
+    ]
+    
+    try:
+        if segments > 1:
+            with timed('transcode', timings):
+                encode_mp3_segmented(source, temp_file, download_id, params, source_format, segments)
+            return temp_file
+        report = FfmpegProgress(download_id, source_format.get('duration'))
+        # stderr va a un archivo: con una entrada corrupta ffmpeg escribe un error por
+        # paquete y, si llenara la tubería mientras se lee stdout, se bloquearían los dos
+        with timed('transcode', timings), tempfile.TemporaryFile() as errors, subprocess.Popen(
+            command, stdout=subprocess.PIPE, stderr=errors, text=True
+        ) as process:
+            for line in process.stdout:
+                report(line)
+            process.wait()
+            errors.seek(0)
+            stderr = errors.read().decode('utf-8', 'replace').strip()
+        if process.returncode != 0:
+            # El último mensaje es el que explica el fallo
+            raise Exception(f"ffmpeg falló: {stderr[-FFMPEG_ERROR_CHARS:]}")
+    finally:
+        if source != temp_file and os.path.exists(source):
+            os.remove(source)
+    
+    return temp_file
+
+def select_audio_format(info, params=DEFAULT_AUDIO_PARAMS):
+    """Elegir el mejor formato con audio (preferiblemente solo audio) de la info"""
+    formats = [f for f in info.get('formats') or [info] if f.get('url') and f.get('acodec') != 'none']
+    audio_only = [f for f in formats if f.get('vcodec') == 'none']
+    candidates = audio_only or formats
+    # Si hay un origen en el códec pedido se prefiere, para copiarlo sin recodificar
+    matching = [f for f in candidates if can_remux(dict(params, bitrate=None), f)]
+    candidates = matching or candidates
+    if not candidates:
+        raise Exception("No hay formatos de audio disponibles")
+    # yt-dlp ordena los formatos de peor a mejor
+    return max(candidates, key=lambda f: (f.get('abr') or f.get('tbr') or 0, candidates.index(f)))
+
+def stream_audio(info, cache_key, params=DEFAULT_AUDIO_PARAMS):
+    """Convertir al vuelo y entregar los bytes del audio según los produce ffmpeg
+    
+    El resultado se escribe a la vez en un archivo temporal que pasa a la
+    caché si la conversión termina correctamente.
+    """
+    audio_format = select_audio_format(info, params)
+    command = [FFMPEG_BINARY, '-loglevel', 'error']
+    headers = audio_format.get('http_headers') or {}
+    if headers:
+        command += ['-headers', ''.join(f"{name}: {value}\r\n" for name, value in headers.items())]
+    command += ['-i', audio_format['url'], *ffmpeg_audio_args(params, can_remux(params, audio_format))]
+    if params['format'] == 'm4a':
+        # MP4 no se puede escribir en una tubería sin fragmentar
+        command += ['-movflags', 'frag_keyframe+empty_moov']
+    command.append('pipe:1')
+    
+    temp_file = os.path.join(TEMP_FOLDER, f"stream-{uuid.uuid4()}.{params['format']}")
+    process = subprocess.Popen(command, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL)
+    completed = False
+    try:
+        with open(temp_file, 'wb') as output:
+            while True:
+                chunk = process.stdout.read1(STREAM_CHUNK_SIZE)
+                if not chunk:
+                    break
+                output.write(chunk)
+                yield chunk
+        completed = process.wait() == 0
+    finally:
+        # Si el cliente se desconecta el generador se cierra y ffmpeg se detiene
+        if process.poll() is None:
+            process.kill()
+            process.wait()
+        process.stdout.close()
+        if completed and cache_key:
+            result_cache.put(temp_file, cache_key, info.get('title'))
+        elif os.path.exists(temp_file):
+            os.remove(temp_file)
+
+class Job:
+    """Trabajo de conversión pendiente o en curso"""
+    
+    def __init__(self, download_id, url, key=None, params=None, client=None, priced=True,
+                 priority='interactive', duration=None):
+        self.download_id = download_id
+        self.url = url
+        # Clase de prioridad (ver PRIORITY_PENALTIES) y duración del audio si se conoce
+        self.priority = priority
+        self.duration = duration
+        # Cliente que lo pidió (para sus límites) y si su coste ya incluía la duración
+        self.client = client
+        self.priced = priced
+        # Clave del resultado (normalizada) para agrupar solicitudes idénticas
+        self.key = key
+        self.params = params or {}
+        # Audio ya descargado pendiente de conversión (al recuperar un trabajo)
+        self.source_path = None
+        self.followers = []
+        self.created_at = time.time()
+        # Duración de cada etapa (segundos), se publica al completar
+        self.timings = {}
+
+class JobScheduler:
+    """Planificador con pool fijo de descargas, pool de conversión y cola acotada
+    
+    La cola sale por orden de `duración + penalización de la clase - espera *
+    JOB_AGING_RATE`: los trabajos cortos e interactivos pasan delante, pero
+    uno largo acaba saliendo porque su espera lo va adelantando. Como todos
+    envejecen al mismo ritmo, el orden no cambia con el tiempo y basta con
+    fijar la clave al encolar (`_priority_key`) y usar un montículo.
+    """
+    
+    def __init__(self, download_workers, transcode_workers, max_pending, transcode_backlog=TRANSCODE_BACKLOG):
+        self.download_workers = download_workers
+        self.transcode_workers = transcode_workers
+        self.max_pending = max_pending
+        # Un hueco por trabajo entre el inicio de su descarga y el fin de su conversión
+        self.transcode_backlog = transcode_backlog
+        self.pipeline_slots = threading.BoundedSemaphore(transcode_workers + transcode_backlog)
+        # Montículo de (clave de prioridad, orden de llegada, trabajo)
+        self.pending = []
+        self.sequence = itertools.count()
+        self.condition = threading.Condition()
+        self.threads = []
+        self.transcode_pool = None
+        self.active_downloads = 0
+        self.active_transcodes = 0
+        # Trabajos en curso por clave (los seguidores se guardan en el propio trabajo)
+        self.inflight = {}
+        # IDs de los trabajos sacados de la cola que aún no terminaron
+        self.running = set()
+        self.coalesced = 0
+    
+    def _ensure_started(self):
+        # Los hilos se crean en el primer uso para que funcione tras el fork de gunicorn
+        if self.threads:
+            return
+        self.transcode_pool = ThreadPoolExecutor(
+            max_workers=self.transcode_workers,
+            thread_name_prefix='transcode'
+        )
+        for index in range(self.download_workers):
+            thread = threading.Thread(
+                target=self._download_worker,
+                name=f'download-{index}',
+                daemon=True
+            )
+            thread.start()
+            self.threads.append(thread)
+    
+    def submit(self, job, force=False):
+        """Encolar un trabajo o adjuntarlo a uno idéntico en curso
+        
+        Devuelve el trabajo que hará el trabajo real (el propio o el líder),
+        o None si la cola está llena. `force` ignora el límite de la cola
+        (trabajos recuperados tras un reinicio).
+        """
+        # Fuera del bloqueo: puede leer los metadatos del disco
+        priority_key = self._priority_key(job)
+        with self.condition:
+            self._ensure_started()
+            leader = self.inflight.get(job.key) if job.key else None
+            if leader is not None:
+                leader.followers.append(job.download_id)
+                # El alias vive en el almacén para que cualquier worker lo resuelva
+                set_progress(job.download_id, {'alias_of': leader.download_id})
+                self.coalesced += 1
+                return leader
+            if len(self.pending) >= self.max_pending and not force:
+                return None
+            set_progress(job.download_id, {
+                'status': 'queued',
+                'percent': 0,
+                'stage': 'En cola...'
+            })
+            if job_store and not force:
+                job_store.save(job, 'queued')
+            if job.key:
+                self.inflight[job.key] = job
+            heapq.heappush(self.pending, (priority_key, next(self.sequence), job))
+            self.condition.notify()
+            return job
+    
+    @staticmethod
+    def _priority_key(job):
+        if job.duration is None:
+            # Los metadatos suelen estar ya en caché por la consulta previa de /api/video-info
+            info = metadata_cache.peek(job.url)
+            job.duration = info.get('duration') if info else None
+        duration = job.duration if job.duration is not None else DEFAULT_JOB_DURATION
+        penalty = PRIORITY_PENALTIES.get(job.priority, 0)
+        return duration + penalty + JOB_AGING_RATE * job.created_at
+    
+    def detach(self, download_id):
+        """Soltar un seguidor de su líder"""
+        with self.condition:
+            for leader in self.inflight.values():
+                if download_id in leader.followers:
+                    leader.followers.remove(download_id)
+    
+    def _finish(self, job):
+        # Copiar el resultado final a los seguidores y liberar la clave
+        with self.condition:
+            if job.key and self.inflight.get(job.key) is job:
+                del self.inflight[job.key]
+            self.running.discard(job.download_id)
+            release_client_job(job.client, job.download_id)
+            final = progress_store.get(job.download_id)
+            followers, job.followers = job.followers, []
+            for follower_id in followers:
+                if final is not None:
+                    set_progress(follower_id, dict(final))
+        if job_store:
+            # Un trabajo recuperado que se unió a otro en curso conserva su fila hasta ahora
+            for download_id in [job.download_id, *followers]:
+                job_store.remove(download_id)
+    
+    def active_ids(self):
+        """IDs de los trabajos encolados o en curso en este proceso"""
+        with self.condition:
+            return self.running | {job.download_id for _, _, job in self.pending}
+    
+    def queue_position(self, download_id):
+        """Posición (1 = siguiente) de un trabajo en la cola, o None"""
+        download_id = resolve_download(download_id)
+        with self.condition:
+            for entry in self.pending:
+                if entry[2].download_id == download_id:
+                    # El montículo no está ordenado: contar los que saldrán antes
+                    return 1 + sum(1 for other in self.pending if other < entry)
+        return None
+    
+    def stats(self):
+        with self.condition:
+            return {
+                'pending': len(self.pending),
+                'pending_by_priority': dict(collections.Counter(job.priority for _, _, job in self.pending)),
+                'max_pending': self.max_pending,
+                'active_downloads': self.active_downloads,
+                'active_transcodes': self.active_transcodes,
+                'inflight': len(self.inflight),
+                'coalesced': self.coalesced,
+                'download_workers': self.download_workers,
+                'transcode_backlog': self.transcode_backlog,
+                'transcode_workers': self.transcode_workers,
+            }
+    
+    def _next_job(self):
+        with self.condition:
+            while not self.pending:
+                self.condition.wait()
+            self.active_downloads += 1
+            job = heapq.heappop(self.pending)[2]
+            self.running.add(job.download_id)
+        record_stage('queue_wait', time.time() - job.created_at, job.timings)
+        return job
+    
+    def _download_worker(self):
+        while True:
+            # No empezar otra descarga hasta que su audio tenga sitio en la cola de conversión
+            self.pipeline_slots.acquire()
+            job = self._next_job()
+            handed_off = False
+            try:
+                if job.source_path and os.path.exists(job.source_path):
+                    # Trabajo recuperado cuya descarga ya había terminado
+                    info, source = extract_video_info(job.url), job.source_path
+                else:
+                    if not job.priced:
+                        # Cobrar la duración que no se conocía al admitir el trabajo
+                        info = extract_video_info(job.url, job.timings)
+                        check_rate(job.client, 'convert', conversion_cost(info.get('duration')) - 1, force=True)
+                    if job_store:
+                        job_store.update(job.download_id, 'downloading')
+                    info, source = download_audio(job.url, job.download_id, job.params, timings=job.timings)
+                if source is None:
+                    cache_key = result_key(info.get('extractor_key'), info.get('id'), job.params)
+                    _mark_completed(job.download_id, cache_key, info.get('title', 'Unknown'), job.timings)
+                    jobs_total.inc(outcome='cached')
+                    self._finish(job)
+                else:
+                    if job_store:
+                        job_store.update(job.download_id, 'converting', source)
+                    self.transcode_pool.submit(self._transcode, job, info, source, time.perf_counter())
+                    handed_off = True
+            except Exception as e:
+                _mark_error(job.download_id, e)
+                jobs_total.inc(outcome='rejected' if isinstance(e, JobRejected) else 'error')
+                self._finish(job)
+            finally:
+                with self.condition:
+                    self.active_downloads -= 1
+                if not handed_off:
+                    self.pipeline_slots.release()
+    
+    def _transcode(self, job, info, source, submitted):
+        record_stage('transcode_wait', time.perf_counter() - submitted, job.timings)
+        with self.condition:
+            self.active_transcodes += 1
+        try:
+            temp_file = transcode_audio(source, job.download_id, job.params, info, timings=job.timings)
+            title = info.get('title', 'Unknown')
+            cache_key = result_key(info.get('extractor_key'), info.get('id'), job.params)
+            
+            # Mover archivo a la caché de resultados
+            with timed('move', job.timings):
+                result_cache.put(temp_file, cache_key, title)
+            _mark_completed(job.download_id, cache_key, title, job.timings)
+            jobs_total.inc(outcome='completed')
+        except Exception as e:
+            _mark_error(job.download_id, e)
+            jobs_total.inc(outcome='error')
+        finally:
+            with self.condition:
+                self.active_transcodes -= 1
+            self.pipeline_slots.release()
+            self._finish(job)
 
-# Crear carpetas si no existen
-os.makedirs(DOWNLOAD_FOLDER, exist_ok=True)
-os.makedirs(TEMP_FOLDER, exist_ok=True)
+def _mark_completed(download_id, filename, title, timings=None):
+    progress = {
+        'status': 'completed',
+        'percent': 100,
+        'stage': 'Completado',
+        'filename': filename,
+        'title': title
+    }
+    if timings:
+        progress['timings'] = dict(timings)
+    set_progress(download_id, progress)
 
-# Diccionario para almacenar el progreso de las descargas
-download_progress = {}
+def _mark_error(download_id, error):
+    if isinstance(error, JobRejected):
+        set_progress(download_id, {
+            'status': 'error',
+            'percent': 0,
+            'stage': f'Rechazado: {str(error)}',
+            'reason': error.reason
+        })
+        return
+    set_progress(download_id, {
+        'status': 'error',
+        'percent': 0,
+        'stage': f'Error: {str(error)}'
+    })
 
-class ProgressHook:
-    def __init__(self, download_id):
-        self.download_id = download_id
+class ResultCache(SQLiteDatabase):
+    """Caché de audios terminados direccionada por (extractor, id, códec, bitrate)
     
-    def __call__(self, d):
-        if d['status'] == 'downloading':
+    El índice (tamaño, último acceso, título, ETag) es un SQLite junto a los
+    archivos, compartido por todos los workers: el desalojo y el conserje
+    consultan el índice en lugar de recorrer el directorio.
+    """
+    
+    schema = (
+        'CREATE TABLE IF NOT EXISTS files ('
+        'name TEXT PRIMARY KEY, size INTEGER NOT NULL, '
+        'last_access REAL NOT NULL, title TEXT, etag TEXT)'
+    )
+    
+    def __init__(self, folder, max_bytes, max_age, index_path=None, serve_grace=0):
+        self.folder = folder
+        self.max_bytes = max_bytes
+        self.max_age = max_age
+        # Un archivo usado hace menos de esto puede estar enviándose: no se borra
+        self.serve_grace = serve_grace
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.lock = threading.Lock()
+        index_path = index_path or os.path.join(folder, '.index.db')
+        fresh = not os.path.exists(index_path)
+        super().__init__(index_path)
+        if fresh:
+            # Primera ejecución (o índice perdido): adoptar lo que ya hay en disco
+            self.load()
+    
+    @staticmethod
+    def key(extractor, video_id, codec, bitrate):
+        """Nombre de archivo estable para un resultado"""
+        if not extractor or not video_id:
+            return None
+        parts = [re.sub(r'[^A-Za-z0-9_-]', '_', str(value)) for value in (extractor, video_id, bitrate, codec)]
+        return '{}_{}_{}.{}'.format(*parts)
+    
+    def path(self, filename):
+        return os.path.join(self.folder, filename)
+    
+    def load(self):
+        """Indexar los archivos presentes en disco que falten en el índice"""
+        for entry in os.scandir(self.folder):
+            if entry.is_file() and not entry.name.startswith('.'):
+                stat = entry.stat()
+                self._connection().execute(
+                    'INSERT OR IGNORE INTO files (name, size, last_access) VALUES (?, ?, ?)',
+                    (entry.name, stat.st_size, stat.st_mtime)
+                )
+    
+    def get(self, filename):
+        """Ruta del resultado si está en caché (cuenta aciertos y fallos)"""
+        path = self.path(filename) if filename else None
+        if path is None or not os.path.exists(path):
+            if filename:
+                self._forget(filename)
+            with self.lock:
+                self.misses += 1
+            return None
+        with self.lock:
+            self.hits += 1
+        self.touch(filename)
+        return path
+    
+    def contains(self, filename):
+        """Si el resultado está en caché, sin contarlo en las estadísticas ni renovarlo"""
+        path = self.path(filename) if filename else None
+        return path is not None and os.path.exists(path)
+    
+    def touch(self, filename):
+        """Marcar el resultado como recién usado (LRU y protección mientras se envía)"""
+        now = time.time()
+        cursor = self._connection().execute(
+            'UPDATE files SET last_access = ? WHERE name = ?', (now, filename)
+        )
+        if cursor.rowcount == 0 and os.path.exists(self.path(filename)):
+            # Archivo en disco que no estaba en el índice
+            self._connection().execute(
+                'INSERT OR IGNORE INTO files (name, size, last_access) VALUES (?, ?, ?)',
+                (filename, os.path.getsize(self.path(filename)), now)
+            )
+        try:
+            os.utime(self.path(filename))
+        except OSError:
+            pass
+    
+    def title(self, filename):
+        row = self._connection().execute('SELECT title FROM files WHERE name = ?', (filename,)).fetchone()
+        return row[0] if row else None
+    
+    def etag(self, filename):
+        """ETag fuerte (hash del contenido), calculado una sola vez por archivo"""
+        row = self._connection().execute('SELECT etag FROM files WHERE name = ?', (filename,)).fetchone()
+        if row and row[0]:
+            return row[0]
+        etag = file_digest(self.path(filename))
+        self._connection().execute('UPDATE files SET etag = ? WHERE name = ?', (etag, filename))
+        return etag
+    
+    def put(self, temp_file, filename, title=None):
+        """Mover un resultado terminado a la caché y aplicar los límites"""
+        final_file = self.path(filename)
+        etag = file_digest(temp_file)
+        shutil.move(temp_file, final_file)
+        self._connection().execute(
+            'INSERT OR REPLACE INTO files (name, size, last_access, title, etag) VALUES (?, ?, ?, ?, ?)',
+            (filename, os.path.getsize(final_file), time.time(), title, etag)
+        )
+        self.evict()
+        return final_file
+    
+    def evict(self):
+        """Eliminar entradas caducadas y, después, las menos usadas hasta caber en el límite"""
+        connection = self._connection()
+        now = time.time()
+        total, oldest = connection.execute('SELECT COALESCE(SUM(size), 0), MIN(last_access) FROM files').fetchone()
+        if oldest is None or (total <= self.max_bytes and now - oldest <= self.max_age):
+            return []
+        
+        removed = []
+        rows = connection.execute('SELECT name, size, last_access FROM files ORDER BY last_access').fetchall()
+        for filename, size, last_access in rows:
+            expired = now - last_access > self.max_age
+            if not expired and total <= self.max_bytes:
+                break
+            if now - last_access < self.serve_grace:
+                # El resto es aún más reciente: mejor pasarse de la cuota que cortar una descarga
+                break
+            # Si otro worker lo acaba de usar, last_access ya no coincide y se conserva
+            cursor = connection.execute(
+                'DELETE FROM files WHERE name = ? AND last_access = ?', (filename, last_access)
+            )
+            if cursor.rowcount == 0:
+                continue
+            total -= size
+            removed.append(filename)
             try:
-                percent = float(d.get('_percent_str', '0%').replace('%', ''))
-                speed = d.get('_speed_str', 'N/A')
-                eta = d.get('_eta_str', 'N/A')
-                
-                download_progress[self.download_id] = {
-                    'status': 'downloading',
-                    'percent': percent,
-                    'speed': speed,
-                    'eta': eta,
-                    'stage': 'Descargando audio...'
-                }
-            except:
+                os.remove(self.path(filename))
+                print(f"Archivo eliminado: {filename}")
+            except OSError:
                 pass
-        elif d['status'] == 'finished':
-            download_progress[self.download_id] = {
-                'status': 'converting',
-                'percent': 90,
-                'stage': 'Convirtiendo a MP3...'
+        with self.lock:
+            self.evictions += len(removed)
+        return removed
+    
+    def _forget(self, filename):
+        self._connection().execute('DELETE FROM files WHERE name = ?', (filename,))
+    
+    def stats(self):
+        entries, total = self._connection().execute(
+            'SELECT COUNT(*), COALESCE(SUM(size), 0) FROM files'
+        ).fetchone()
+        with self.lock:
+            lookups = self.hits + self.misses
+            return {
+                'entries': entries,
+                'bytes': total,
+                'max_bytes': self.max_bytes,
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_ratio': self.hits / lookups if lookups else 0.0,
+                'evictions': self.evictions,
             }
 
-def get_video_info(url):
-    """Obtener información del video sin descargarlo"""
+class MetadataCache:
+    """Caché de metadatos de yt-dlp con caducidad y persistencia opcional en disco"""
+    
+    def __init__(self, ttl, max_entries, folder=None):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.folder = folder
+        # clave -> (instante de extracción, info saneada), en orden LRU
+        self.entries = collections.OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+        if folder:
+            os.makedirs(folder, exist_ok=True)
+    
+    @staticmethod
+    def key_for_url(url):
+        normalized = normalize_video_url(url)
+        return f"{normalized[0]}:{normalized[1]}" if normalized else f"url:{url}"
+    
+    def get(self, url):
+        """Copia de la información cacheada, o None si no existe o caducó"""
+        info = self.peek(url)
+        with self.lock:
+            if info is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+        return copy.deepcopy(info)
+    
+    def peek(self, url):
+        """La información cacheada sin copiarla ni contarla en las estadísticas (solo lectura)"""
+        key = self.key_for_url(url)
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None:
+                self.entries.move_to_end(key)
+        if entry is None:
+            entry = self._load(key)
+        if entry is None or time.time() - entry[0] > self.ttl:
+            return None
+        return entry[1]
+    
+    def put(self, url, info):
+        """Guardar la información bajo la URL y bajo el ID real del video"""
+        entry = (time.time(), info)
+        keys = {self.key_for_url(url)}
+        if info.get('extractor_key') and info.get('id'):
+            keys.add(f"{info['extractor_key']}:{info['id']}")
+        for key in keys:
+            self._store(key, entry)
+            self._save(key, entry)
+    
+    def _store(self, key, entry):
+        with self.lock:
+            self.entries[key] = entry
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+    
+    def _file_for(self, key):
+        return os.path.join(self.folder, hashlib.sha1(key.encode('utf-8')).hexdigest() + '.json')
+    
+    def _load(self, key):
+        if not self.folder:
+            return None
+        try:
+            with open(self._file_for(key), encoding='utf-8') as f:
+                data = json.load(f)
+            entry = (data['extracted_at'], data['info'])
+        except (OSError, ValueError, KeyError):
+            return None
+        self._store(key, entry)
+        return entry
+    
+    def _save(self, key, entry):
+        if not self.folder:
+            return
+        path = self._file_for(key)
+        temp_path = f"{path}.{uuid.uuid4().hex}.tmp"
+        try:
+            with open(temp_path, 'w', encoding='utf-8') as f:
+                json.dump({'extracted_at': entry[0], 'info': entry[1]}, f)
+            os.replace(temp_path, path)
+        except (OSError, TypeError, ValueError) as e:
+            print(f"Error guardando metadatos: {e}")
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+    
+    def stats(self):
+        with self.lock:
+            lookups = self.hits + self.misses
+            return {
+                'entries': len(self.entries),
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_ratio': self.hits / lookups if lookups else 0.0,
+            }
+
+def file_digest(path):
+    """Hash del contenido de un archivo (para ETags fuertes)"""
+    digest = hashlib.blake2b(digest_size=16)
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+@functools.lru_cache(maxsize=4096)
+def normalize_video_url(url):
+    """Obtener (extractor, id) de una URL sin acceder a la red; None si no se reconoce"""
+    for ie in yt_dlp.extractor.gen_extractor_classes():
+        if ie.ie_key() == 'Generic':
+            continue
+        if ie.suitable(url):
+            video_id = ie.get_temp_id(url)
+            return (ie.ie_key(), video_id) if video_id else None
+    return None
+
+def expand_batch(url, urls, batch):
+    """Generador perezoso de URLs de un lote (las páginas se piden según se consumen)"""
+    if urls:
+        yield from urls
+        return
+    
     ydl_opts = {
         'quiet': True,
         'no_warnings': True,
+        'extract_flat': 'in_playlist',
+        'lazy_playlist': True,
     }
+    with ytdl_pool.checkout('playlist', ydl_opts) as ydl:
+        info = ydl.extract_info(url, download=False, process=False)
+        batch['title'] = info.get('title')
+        if info.get('entries') is None:
+            # No es una lista: un único video
+            yield url
+            return
+        yield from playlist_videos(ydl, info, set())
+
+# Listas anidadas que se recorren como mucho (canal -> pestañas Videos/Shorts/Directos -> videos)
+MAX_PLAYLIST_DEPTH = 3
+
+def is_sublist(info, entry):
+    """Si una entrada plana de una lista es a su vez una lista (p. ej. la pestaña de un canal)"""
+    if entry.get('_type') == 'playlist':
+        return True
+    # Los videos los resuelve otro extractor; una entrada del mismo extractor que la lista es otra lista
+    return entry.get('_type') in ('url', 'url_transparent') and entry.get('ie_key') == info.get('extractor_key')
+
+def playlist_videos(ydl, info, seen, depth=0):
+    """URLs de los videos de una lista, entrando en sus sublistas según se consumen"""
+    for entry in info.get('entries') or ():
+        if not entry:
+            continue
+        entry_url = entry.get('webpage_url') or entry.get('url')
+        if not entry_url or entry_url in seen:
+            continue
+        seen.add(entry_url)
+        if depth < MAX_PLAYLIST_DEPTH and is_sublist(info, entry):
+            sublist = ydl.extract_info(entry_url, download=False, process=False)
+            if sublist.get('entries') is not None:
+                yield from playlist_videos(ydl, sublist, seen, depth + 1)
+                continue
+        yield entry_url
+
+# Estados de un lote con todos sus elementos ya encolados ('completed': además terminados)
+BATCH_EXPANDED_STATUSES = ('expanded', 'completed')
+
+def start_batch(url, urls, params, client=None):
+    """Registrar un lote y empezar a alimentarlo en segundo plano"""
+    batch_id = str(uuid.uuid4())
+    set_progress(batch_id, {
+        'type': 'batch',
+        'status': 'expanding',
+        'title': 'lote' if urls else None,
+        'items': [],
+        'error': None,
+    })
+    batch_pool.submit(run_batch, batch_id, url, urls, params, client)
+    return batch_id
+
+def run_batch(batch_id, url, urls, params, client=None):
+    """Expandir el lote y mantener como mucho BATCH_PARALLELISM elementos en curso
+    
+    Cuando terminan todos sus elementos el lote pasa a 'completed' (un estado
+    final, que caduca a los PROGRESS_TTL segundos como el de sus elementos).
+    """
+    batch = dict(progress_store.get(batch_id))
+    items = []
+    refreshed = time.monotonic()
+    
+    def unfinished():
+        return [item for item in items if progress_snapshot(item)[1].get('status') not in TERMINAL_STATUSES]
+    
+    def wait_for_item(download_id):
+        nonlocal refreshed
+        # Los elementos terminados no deben caducar antes que el propio lote
+        if time.monotonic() - refreshed > PROGRESS_TTL / 2:
+            refresh_batch_items(items)
+            refreshed = time.monotonic()
+        progress_id = resolve_download(download_id)
+        progress_store.wait(progress_id, progress_store.version(progress_id), PROGRESS_HEARTBEAT)
     
     try:
-        with yt_dlp.YoutubeDL(ydl_opts) as ydl:
-            info = ydl.extract_info(url, download=False)
-            return {
-                'title': info.get('title', 'Unknown'),
-                'duration': format_duration(info.get('duration', 0)),
-                'uploader': info.get('uploader', 'Unknown'),
-                'view_count': info.get('view_count', 0),
-                'thumbnail': info.get('thumbnail', ''),
-            }
+        for entry_url in itertools.islice(expand_batch(url, urls, batch), MAX_BATCH_ITEMS):
+            if not entry_url:
+                continue
+            # Esperar a que haya hueco en el lote y en la cola global
+            while True:
+                running = unfinished()
+                if len(running) < BATCH_PARALLELISM:
+                    result = enqueue_batch_item(entry_url, params, client)
+                    if result is not None:
+                        break
+                    time.sleep(RETRY_AFTER_SECONDS)
+                    continue
+                wait_for_item(running[0])
+            items.append(result['download_id'])
+            set_progress(batch_id, dict(batch, status='running', items=list(items)))
+        batch['status'] = 'expanded'
     except Exception as e:
-        raise Exception(f"Error obteniendo información del video: {str(e)}")
+        batch['status'] = 'expanded'
+        batch['error'] = f"Error expandiendo la lista: {str(e)}"
+    set_progress(batch_id, dict(batch, items=items))
+    
+    while True:
+        running = unfinished()
+        if not running:
+            break
+        wait_for_item(running[0])
+    refresh_batch_items(items)
+    set_progress(batch_id, dict(batch, status='completed', items=items))
 
-def format_duration(seconds):
-    """Convertir segundos a formato MM:SS o HH:MM:SS"""
-    if not seconds:
-        return "0:00"
+def refresh_batch_items(items):
+    """Renovar la caducidad del progreso de los elementos ya terminados de un lote"""
+    for item_id in items:
+        progress_id = resolve_download(item_id)
+        progress = progress_store.get(progress_id)
+        # Solo los terminados: los demás aún cambian y se podría pisar un avance
+        if progress and progress.get('status') in TERMINAL_STATUSES:
+            progress_store.set(progress_id, progress)
+
+def enqueue_batch_item(url, params, client):
+    """Encolar un elemento del lote como un trabajo simultáneo más de su cliente
     
-    hours = seconds // 3600
-    minutes = (seconds % 3600) // 60
-    seconds = seconds % 60
+    Devuelve lo mismo que enqueue_conversion, o None si el cliente ya tiene
+    MAX_CLIENT_JOBS trabajos o la cola está llena (el lote espera y reintenta).
+    """
+    download_id = str(uuid.uuid4())
+    if not acquire_client_job(client, download_id):
+        return None
+    try:
+        result = enqueue_conversion(url, params, download_id, client=client, priced=False, priority='batch')
+    except Exception:
+        release_client_job(client, download_id)
+        raise
+    if result is None or result.get('cached') or result.get('coalesced'):
+        release_client_job(client, download_id)
+    return result
+
+def batch_summary(batch_id):
+    """Progreso agregado de un lote a partir del progreso de sus elementos"""
+    batch = progress_store.get(batch_id)
+    if not batch or batch.get('type') != 'batch':
+        return None
     
-    if hours > 0:
-        return f"{hours}:{minutes:02d}:{seconds:02d}"
-    else:
-        return f"{minutes}:{seconds:02d}"
+    items = []
+    for item_id in batch['items']:
+        progress = progress_snapshot(item_id)[1]
+        items.append({
+            'download_id': item_id,
+            'status': progress.get('status'),
+            'percent': progress.get('percent', 0),
+            'stage': progress.get('stage'),
+            'title': progress.get('title'),
+        })
+    
+    completed = sum(1 for item in items if item['status'] == 'completed')
+    failed = sum(1 for item in items if item['status'] in ('error', 'not_found'))
+    expanded = batch['status'] in BATCH_EXPANDED_STATUSES
+    finished = batch['status'] == 'completed' or (expanded and completed + failed == len(items))
+    return {
+        'status': 'completed' if finished else ('expanding' if not items else 'running'),
+        'expanded': expanded,
+        'error': batch.get('error'),
+        'total': len(items),
+        'completed': completed,
+        'failed': failed,
+        'percent': sum(item['percent'] or 0 for item in items) / len(items) if items else 0,
+        'items': items,
+    }
 
-def download_audio(url, download_id):
-    """Descargar y convertir video a MP3"""
-    try:
-        # Actualizar progreso inicial
-        download_progress[download_id] = {
-            'status': 'starting',
-            'percent': 0,
-            'stage': 'Iniciando descarga...'
-        }
-        
-        # Configuración de yt-dlp
-        output_template = os.path.join(TEMP_FOLDER, f"{download_id}.%(ext)s")
-        
-        ydl_opts = {
-            'format': 'bestaudio/best',
-            'outtmpl': output_template,
-            'postprocessors': [{
-                'key': 'FFmpegExtractAudio',
-                'preferredcodec': 'mp3',
-                'preferredquality': '192',
-            }],
-            'progress_hooks': [ProgressHook(download_id)],
-            'quiet': True,
-            'no_warnings': True,
-        }
-        
-        # Descargar video
-        with yt_dlp.YoutubeDL(ydl_opts) as ydl:
-            info = ydl.extract_info(url, download=True)
+# Archivos temporales de un trabajo: <download_id>.<ext>[.part|.partN] o stream-<uuid>.<ext>
+TEMP_FRAGMENT_PATTERN = re.compile(r'^(?:stream-)?([0-9a-f]{8}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{12})\.')
+
+class Janitor:
+    """Limpieza periódica en segundo plano
+    
+    Aplica la cuota y la caducidad de la caché de resultados (consultando su
+    índice), purga el progreso caducado y borra de TEMP_FOLDER los
+    fragmentos de trabajos que ya no existen. Corre en cada worker, pero un cerrojo de archivo hace que solo
+    uno por máquina limpie en cada pasada.
+    """
+    
+    def __init__(self, interval, temp_max_age):
+        self.interval = interval
+        self.temp_max_age = temp_max_age
+        self.thread = None
+        self.lock = threading.Lock()
+        self.runs = 0
+        self.reaped = 0
+    
+    def start(self):
+        # Como en el planificador, el hilo se crea ya dentro del worker
+        with self.lock:
+            if self.thread is None and self.interval > 0:
+                self.thread = threading.Thread(target=self._run, name='janitor', daemon=True)
+                self.thread.start()
+    
+    def _run(self):
+        while True:
+            self.run_once()
+            time.sleep(self.interval)
+    
+    def run_once(self):
+        # El progreso y los límites en memoria son de cada worker, así que cada uno purga los suyos
+        try:
+            progress_store.purge()
+            rate_limiter.purge()
+        except Exception as e:
+            print(f"Error purgando el progreso: {e}")
+        with open(os.path.join(TEMP_FOLDER, 'janitor.lock'), 'a') as lock_file:
+            if fcntl:
+                try:
+                    fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                except OSError:
+                    return  # otro worker está limpiando
+            try:
+                result_cache.evict()
+                self.reaped += self.reap_temp()
+                self.runs += 1
+            except Exception as e:
+                print(f"Error limpiando archivos: {e}")
+    
+    def reap_temp(self):
+        """Borrar fragmentos antiguos de trabajos que ya no están registrados ni en curso"""
+        active = scheduler.active_ids()
+        if job_store:
+            active |= job_store.ids()
+        cutoff = time.time() - self.temp_max_age
+        removed = 0
+        for entry in os.scandir(TEMP_FOLDER):
+            match = TEMP_FRAGMENT_PATTERN.match(entry.name)
+            if not match or match.group(1) in active:
+                continue
+            try:
+                if entry.stat().st_mtime > cutoff:
+                    continue  # puede ser una descarga o un stream aún en marcha
+                os.remove(entry.path)
+                removed += 1
+            except OSError:
+                pass
+        if removed:
+            print(f"Fragmentos temporales eliminados: {removed}")
+        return removed
+    
+    def stats(self):
+        return {'runs': self.runs, 'reaped': self.reaped, 'interval': self.interval}
+
+class SlotPool:
+    """Semáforo no bloqueante que además informa de cuántos huecos están ocupados"""
+    
+    def __init__(self, size):
+        self.size = size
+        self.in_use = 0
+        self.lock = threading.Lock()
+    
+    def acquire(self):
+        with self.lock:
+            if self.in_use >= self.size:
+                return False
+            self.in_use += 1
+            return True
+    
+    def release(self):
+        with self.lock:
+            self.in_use -= 1
+
+class _ZipSink:
+    """Destino no buscable para zipfile que acumula los bytes para irlos enviando"""
+    
+    def __init__(self):
+        self.buffer = bytearray()
+        self.offset = 0
+    
+    def write(self, data):
+        self.buffer += data
+        self.offset += len(data)
+        return len(data)
+    
+    def tell(self):
+        return self.offset
+    
+    def flush(self):
+        pass
+    
+    def take(self):
+        data = bytes(self.buffer)
+        self.buffer.clear()
+        return data
+
+def stream_batch_zip(batch_id):
+    """Generar el ZIP del lote sin guardarlo en disco, añadiendo cada archivo al terminar"""
+    sink = _ZipSink()
+    added = set()
+    names = set()
+    with zipfile.ZipFile(sink, 'w', compression=zipfile.ZIP_STORED, allowZip64=True) as archive:
+        while True:
+            batch = progress_store.get(batch_id) or {'items': [], 'status': 'expanded'}
+            pending = [item for item in batch['items'] if item not in added]
+            if not pending:
+                if batch['status'] in BATCH_EXPANDED_STATUSES:
+                    break
+                progress_store.wait(batch_id, progress_store.version(batch_id), PROGRESS_HEARTBEAT)
+                continue
             
-            # El archivo MP3 se guarda con el ID de descarga
-            temp_file = os.path.join(TEMP_FOLDER, f"{download_id}.mp3")
-            final_file = os.path.join(DOWNLOAD_FOLDER, f"{download_id}.mp3")
+            ready = False
+            for item_id in pending:
+                progress = progress_snapshot(item_id)[1]
+                if progress.get('status') not in TERMINAL_STATUSES:
+                    continue
+                added.add(item_id)
+                ready = True
+                path = result_cache.path(progress['filename']) if progress.get('filename') else None
+                if progress.get('status') != 'completed' or not path or not os.path.exists(path):
+                    continue
+                result_cache.touch(progress['filename'])
+                
+                # Evitar nombres repetidos dentro del ZIP
+                name = attachment_name(progress.get('title'), progress['filename'])
+                base, extension = os.path.splitext(name)
+                counter = 2
+                while name in names:
+                    name = f"{base} ({counter}){extension}"
+                    counter += 1
+                names.add(name)
+                
+                with open(path, 'rb') as source, archive.open(name, 'w', force_zip64=True) as target:
+                    while True:
+                        chunk = source.read(STREAM_CHUNK_SIZE)
+                        if not chunk:
+                            break
+                        target.write(chunk)
+                        yield sink.take()
             
-            # Mover archivo a la carpeta de descargas
-            if os.path.exists(temp_file):
-                shutil.move(temp_file, final_file)
+            if not ready:
+                # Esperar a que termine el siguiente elemento
+                progress_id = resolve_download(pending[0])
+                progress_store.wait(progress_id, progress_store.version(progress_id), PROGRESS_HEARTBEAT)
+    
+    yield sink.take()
+
+def recover_jobs():
+    """Volver a encolar los trabajos que quedaron a medias en un proceso anterior"""
+    if not job_store:
+        return 0
+    recovered = job_store.claim_orphans()
+    for job, state in recovered:
+        if state != 'converting':
+            # La descarga se retoma desde el .part existente
+            job.source_path = None
+        scheduler.submit(job, force=True)
+    if recovered:
+        print(f"Trabajos recuperados: {len(recovered)}")
+    return len(recovered)
+
+_recovery_lock = threading.Lock()
+_recovery_done = False
+
+@app.before_request
+def _recover_once():
+    # Se hace en la primera petición, ya dentro del worker (tras el fork de gunicorn)
+    global _recovery_done
+    if _recovery_done:
+        return
+    with _recovery_lock:
+        if not _recovery_done:
+            _recovery_done = True
+            try:
+                recover_jobs()
+            except Exception as e:
+                print(f"Error recuperando trabajos: {e}")
+            if job_store:
+                job_store.start()
+            janitor.start()
+
+ytdl_pool = YoutubeDLPool(YTDL_POOL_IDLE)
+scheduler = JobScheduler(DOWNLOAD_WORKERS, TRANSCODE_WORKERS, MAX_PENDING_JOBS)
+job_store = JobStore(JOB_STORE_PATH) if JOB_STORE_PATH else None
+janitor = Janitor(JANITOR_INTERVAL, TEMP_MAX_AGE)
+result_cache = ResultCache(DOWNLOAD_FOLDER, CACHE_MAX_BYTES, CACHE_MAX_AGE, CACHE_INDEX_PATH, SERVE_GRACE)
+metadata_cache = MetadataCache(METADATA_TTL, METADATA_CACHE_SIZE, METADATA_CACHE_DIR)
+stream_slots = SlotPool(MAX_STREAMS)
+upstream_slots = threading.BoundedSemaphore(MAX_UPSTREAM_CONNECTIONS)
+batch_pool = ThreadPoolExecutor(max_workers=BATCH_WORKERS, thread_name_prefix='batch')
+segment_pool = ThreadPoolExecutor(max_workers=max(SEGMENT_ENCODERS, 1), thread_name_prefix='encode')
+
+class StaticAsset:
+    """Recurso estático en memoria, precomprimido con gzip y brotli, con ETag fuerte"""
+    
+    def __init__(self, body, mimetype):
+        data = body.encode('utf-8')
+        self.mimetype = mimetype
+        self.digest = hashlib.blake2b(data, digest_size=16).hexdigest()
+        self.variants = {'identity': data, 'gzip': gzip.compress(data, 9, mtime=0)}
+        if brotli is not None:
+            self.variants['br'] = brotli.compress(data, quality=11)
+    
+    def encoding_for(self, accept_encodings):
+        # La variante más pequeña que el cliente acepte
+        for encoding in ('br', 'gzip'):
+            if encoding in self.variants and accept_encodings[encoding]:
+                return encoding
+        return 'identity'
+
+class Frontend:
+    """Página principal renderizada una sola vez y dividida en HTML, CSS y JS
+    
+    El CSS y el JS se sirven con el hash de su contenido en la URL y caché
+    de un año; el HTML se revalida siempre (ETag, 304) para que un
+    despliegue nuevo llegue de inmediato.
+    """
+    
+    def __init__(self):
+        self.page = None
+        self.assets = {}
+        self.lock = threading.Lock()
+    
+    def build(self):
+        with self.lock:
+            if self.page is not None:
+                return
+            started = time.perf_counter()
+            with app.app_context():
+                html = render_template_string(HTML_TEMPLATE)
             
-            # Actualizar progreso final
-            download_progress[download_id] = {
-                'status': 'completed',
-                'percent': 100,
-                'stage': 'Completado',
-                'filename': f"{download_id}.mp3",
-                'title': info.get('title', 'Unknown')
-            }
+            def extract(match, tag, extension, mimetype):
+                asset = StaticAsset(match.group(1), mimetype)
+                name = f"app.{asset.digest[:12]}.{extension}"
+                self.assets[name] = asset
+                if tag == 'style':
+                    return f'<link rel="stylesheet" href="/assets/{name}">'
+                return f'<script src="/assets/{name}"></script>'
             
-    except Exception as e:
-        download_progress[download_id] = {
-            'status': 'error',
-            'percent': 0,
-            'stage': f'Error: {str(e)}'
-        }
+            html = re.sub(r'<style>(.*?)</style>', lambda m: extract(m, 'style', 'css', 'text/css'), html, flags=re.S)
+            html = re.sub(r'<script>(.*?)</script>', lambda m: extract(m, 'script', 'js', 'text/javascript'), html, flags=re.S)
+            self.page = StaticAsset(html, 'text/html')
+            startup_timings['frontend'] = time.perf_counter() - started
+    
+    def send(self, asset, immutable):
+        encoding = asset.encoding_for(request.accept_encodings)
+        response = Response(asset.variants[encoding], mimetype=asset.mimetype)
+        if encoding != 'identity':
+            response.content_encoding = encoding
+        response.vary.add('Accept-Encoding')
+        # Cada codificación es una representación distinta con su propio ETag fuerte
+        response.set_etag(asset.digest if encoding == 'identity' else f"{asset.digest}-{encoding}")
+        if immutable:
+            response.cache_control.public = True
+            response.cache_control.max_age = 365 * 24 * 3600
+            response.cache_control.immutable = True
+        else:
+            response.cache_control.no_cache = True
+        return response.make_conditional(request)
+
+frontend = Frontend()
 
 @app.route('/')
 def index():
     """Servir la página principal"""
-    return render_template_string(HTML_TEMPLATE)
+    frontend.build()
+    return frontend.send(frontend.page, immutable=False)
+
+@app.route('/assets/<name>')
+def frontend_asset(name):
+    """CSS y JS de la página principal (URL con el hash del contenido)"""
+    frontend.build()
+    asset = frontend.assets.get(name)
+    if asset is None:
+        return jsonify({'error': 'Recurso no encontrado'}), 404
+    return frontend.send(asset, immutable=True)
 
 @app.route('/api/video-info', methods=['POST'])
 def video_info():
@@ -152,98 +2891,501 @@ def video_info():
         if not url:
             return jsonify({'error': 'URL requerida'}), 400
         
+        wait = check_rate(client_id(), 'metadata')
+        if wait:
+            return busy_response(wait, 'Demasiadas consultas, intenta de nuevo más tarde')
+        
         info = get_video_info(url)
         return jsonify({'success': True, 'info': info})
         
     except Exception as e:
         return jsonify({'error': str(e)}), 400
 
+@app.route('/api/video-info/batch', methods=['POST'])
+def video_info_batch():
+    """Obtener información de varios videos en una sola petición"""
+    try:
+        data = request.get_json()
+        urls = data.get('urls')
+        
+        if not urls or not isinstance(urls, list):
+            return jsonify({'error': 'Lista de URLs requerida'}), 400
+        
+        if len(urls) > MAX_BATCH_URLS:
+            return jsonify({'error': f'Máximo {MAX_BATCH_URLS} URLs por petición'}), 400
+        
+        wait = check_rate(client_id(), 'metadata', len(urls))
+        if wait:
+            return busy_response(wait, 'Demasiadas consultas, intenta de nuevo más tarde')
+        
+        return jsonify({'success': True, 'results': get_video_info_batch(urls)})
+        
+    except Exception as e:
+        return jsonify({'error': str(e)}), 400
+
 @app.route('/api/convert', methods=['POST'])
 def convert_video():
-    """Iniciar conversión de video a MP3"""
+    """Iniciar conversión de video a MP3 (u otro formato de audio)"""
     try:
         data = request.get_json()
         url = data.get('url')
         
         if not url:
             return jsonify({'error': 'URL requerida'}), 400
+        if not isinstance(url, str):
+            return jsonify({'error': 'La URL debe ser un texto'}), 400
         
-        # Generar ID único para la descarga
-        download_id = str(uuid.uuid4())
+        try:
+            params = parse_audio_params(data)
+        except ValueError as e:
+            return jsonify({'error': str(e)}), 400
         
-        # Iniciar descarga en hilo separado
-        thread = threading.Thread(target=download_audio, args=(url, download_id))
-        thread.daemon = True
-        thread.start()
+        # Admisión: un trabajo simultáneo más y su coste según la duración, si ya se conoce
+        client = client_id()
+        download_id = str(uuid.uuid4())
+        if not acquire_client_job(client, download_id):
+            return busy_response(RETRY_AFTER_SECONDS, f'Máximo {MAX_CLIENT_JOBS} conversiones simultáneas por cliente')
+        charged = 0
+        try:
+            cached_info = metadata_cache.peek(url)
+            cost = conversion_cost(cached_info.get('duration') if cached_info else None)
+            wait = check_rate(client, 'convert', cost)
+            if wait:
+                release_client_job(client, download_id)
+                return busy_response(wait, 'Demasiadas conversiones, intenta de nuevo más tarde')
+            charged = cost
+            
+            # Las peticiones con API key son integraciones, no una persona esperando en la página
+            priority = 'batch' if client.startswith('key:') else 'interactive'
+            result = enqueue_conversion(url, params, download_id, client, priced=cached_info is not None, priority=priority)
+        except Exception:
+            # Sin trabajo encolado: devolver la reserva y lo cobrado
+            release_client_job(client, download_id)
+            if charged:
+                check_rate(client, 'convert', -charged, force=True)
+            raise
+        if result is None or result.get('cached') or result.get('coalesced'):
+            # Servida desde la caché o unida a otra: no ocupa un trabajo del cliente
+            release_client_job(client, download_id)
+        if result is None:
+            check_rate(client, 'convert', -cost, force=True)
+            return busy_response()
         
-        return jsonify({'success': True, 'download_id': download_id})
+        return jsonify(dict(result, success=True))
         
     except Exception as e:
         return jsonify({'error': str(e)}), 500
 
+def enqueue_conversion(url, params, download_id=None, client=None, priced=True, priority='interactive'):
+    """Iniciar una conversión: servirla desde caché, unirla a una idéntica o encolarla
+    
+    Devuelve {'download_id', 'cached'|'coalesced'} o None si la cola está llena.
+    """
+    # Generar ID único para la descarga
+    download_id = download_id or str(uuid.uuid4())
+    
+    # Servir al instante si el resultado ya está en caché
+    normalized = normalize_video_url(url)
+    cache_key = None
+    if normalized:
+        cache_key = result_key(*normalized, params)
+        if result_cache.get(cache_key):
+            _mark_completed(download_id, cache_key, result_cache.title(cache_key) or normalized[1])
+            return {'download_id': download_id, 'cached': True}
+    
+    # Encolar en el planificador, o unirse a una conversión idéntica en curso
+    job = Job(download_id, url, key=cache_key, params=params, client=client, priced=priced, priority=priority)
+    owner = scheduler.submit(job)
+    if owner is None:
+        return None
+    return {'download_id': download_id, 'coalesced': owner is not job}
+
+def busy_response(retry_after=RETRY_AFTER_SECONDS, message='Servidor ocupado, intenta de nuevo en unos segundos'):
+    """Respuesta 429 con Retry-After cuando no se admiten más trabajos"""
+    response = jsonify({'error': message})
+    response.headers['Retry-After'] = str(max(math.ceil(retry_after), 1))
+    return response, 429
+
+TERMINAL_STATUSES = ('completed', 'error', 'not_found')
+
+def progress_snapshot(download_id):
+    """Progreso actual de una descarga (siguiendo al líder si está agrupada)"""
+    progress_id = resolve_download(download_id)
+    progress = progress_store.get(progress_id) or {'status': 'not_found'}
+    if progress.get('status') == 'queued':
+        progress = dict(progress, queue_position=scheduler.queue_position(download_id))
+    return progress_id, progress
+
 @app.route('/api/progress/<download_id>')
 def get_progress(download_id):
-    """Obtener progreso de descarga"""
-    progress = download_progress.get(download_id, {'status': 'not_found'})
-    return jsonify(progress)
+    """Obtener progreso de descarga
+    
+    Con `?since=<version>` funciona como long-poll: espera (hasta `wait`
+    segundos) a que haya una versión más nueva antes de responder.
+    """
+    progress_id, progress = progress_snapshot(download_id)
+    since = request.args.get('since', type=int)
+    
+    if since is not None and progress.get('status') not in TERMINAL_STATUSES:
+        wait = min(request.args.get('wait', LONG_POLL_MAX_WAIT, type=float), LONG_POLL_MAX_WAIT)
+        if progress_store.wait(progress_id, since, wait) > since:
+            # Dejar que se acumulen las actualizaciones rápidas del hook
+            time.sleep(PROGRESS_MIN_INTERVAL)
+        progress_id, progress = progress_snapshot(download_id)
+    
+    return jsonify(dict(progress, version=progress_store.version(progress_id)))
+
+@app.route('/api/progress/<download_id>/stream')
+def stream_progress(download_id):
+    """Emitir el progreso como Server-Sent Events hasta que termine"""
+    def events():
+        # El ID observado cambia del líder al propio al terminar una descarga agrupada
+        sent = None
+        while True:
+            progress_id, progress = progress_snapshot(download_id)
+            version = progress_store.version(progress_id)
+            if (progress_id, version) != sent:
+                sent = (progress_id, version)
+                yield f"data: {json.dumps(progress)}\n\n"
+                if progress.get('status') in TERMINAL_STATUSES:
+                    return
+                # Agrupar las actualizaciones rápidas del hook en un evento por intervalo
+                time.sleep(PROGRESS_MIN_INTERVAL)
+                continue
+            if progress_store.wait(progress_id, version, PROGRESS_HEARTBEAT) == version:
+                yield ": ping\n\n"
+    
+    return Response(events(), mimetype='text/event-stream', headers={
+        'Cache-Control': 'no-cache',
+        'X-Accel-Buffering': 'no',
+    })
 
 @app.route('/api/download/<download_id>')
 def download_file(download_id):
-    """Descargar archivo MP3"""
+    """Descargar archivo de audio"""
     try:
-        file_path = os.path.join(DOWNLOAD_FOLDER, f"{download_id}.mp3")
+        # El archivo vive en la caché bajo el nombre indicado en el progreso
+        progress = progress_store.get(resolve_download(download_id)) or {}
+        cached_name = progress.get('filename')
+        file_path = result_cache.path(cached_name) if cached_name else None
         
-        if not os.path.exists(file_path):
+        if not file_path or not os.path.exists(file_path):
             return jsonify({'error': 'Archivo no encontrado'}), 404
         
         # Obtener título del archivo para el nombre de descarga
-        progress = download_progress.get(download_id, {})
         title = progress.get('title', 'audio')
         
-        # Limpiar título para nombre de archivo
-        safe_title = "".join(c for c in title if c.isalnum() or c in (' ', '-', '_')).rstrip()
-        filename = f"{safe_title}.mp3"
+        return send_cached_file(cached_name, title)
         
-        return send_file(
-            file_path,
-            as_attachment=True,
-            download_name=filename,
-            mimetype='audio/mpeg'
-        )
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+
+def send_cached_file(cached_name, title):
+    """Enviar un resultado de la caché con ETag fuerte, Range y peticiones condicionales
+    
+    Con FILE_OFFLOAD el servidor web envía los bytes y el worker solo responde
+    las cabeceras.
+    """
+    started = time.perf_counter()
+    # Renueva su posición LRU y lo protege del conserje mientras se envía
+    result_cache.touch(cached_name)
+    download_name = attachment_name(title, cached_name)
+    mimetype = audio_mimetype(cached_name)
+    etag = result_cache.etag(cached_name)
+    
+    if FILE_OFFLOAD == 'x-accel':
+        # nginx atiende Range por su cuenta; aquí solo se resuelve el 304
+        response = Response(mimetype=mimetype)
+        response.set_etag(etag)
+        response.headers['Content-Disposition'] = content_disposition(download_name)
+        response.headers['X-Accel-Redirect'] = X_ACCEL_PREFIX + quote(cached_name)
+        response.headers['Accept-Ranges'] = 'bytes'
+        response.cache_control.private = True
+        response.cache_control.max_age = CACHE_MAX_AGE
+        return track_served(response.make_conditional(request), started)
+    
+    # send_file responde If-None-Match (304), Range (206) e If-Range
+    response = send_file(
+        result_cache.path(cached_name),
+        as_attachment=True,
+        download_name=download_name,
+        mimetype=mimetype,
+        etag=etag,
+        conditional=True,
+        max_age=CACHE_MAX_AGE
+    )
+    response.cache_control.public = False
+    response.cache_control.private = True
+    response.headers['Accept-Ranges'] = 'bytes'
+    return track_served(response, started)
+
+def track_served(response, started):
+    """Registrar el tiempo en preparar la respuesta y los bytes que enviará el worker
+    
+    La transferencia en sí la hace el servidor (sendfile, nginx), que no
+    pasa por los cierres de la respuesta, así que se cuenta lo que se
+    va a enviar según Content-Length.
+    """
+    record_stage('serve', time.perf_counter() - started)
+    offloaded = 'X-Accel-Redirect' in response.headers or 'X-Sendfile' in response.headers
+    if response.status_code in (200, 206) and not offloaded:
+        bytes_served.inc(response.content_length or 0, route='download')
+    return response
+
+def count_served(chunks, route):
+    try:
+        for chunk in chunks:
+            bytes_served.inc(len(chunk), route=route)
+            yield chunk
+    finally:
+        # Propagar el cierre (cliente desconectado) para detener ffmpeg o el ZIP
+        chunks.close()
+
+@app.route('/api/stream')
+def stream_video():
+    """Convertir y enviar el audio a la vez, sin esperar a que termine la conversión"""
+    url = request.args.get('url')
+    
+    if not url:
+        return jsonify({'error': 'URL requerida'}), 400
+    
+    try:
+        params = parse_audio_params(request.args)
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    
+    client = client_id()
+    wait = check_rate(client, 'metadata')
+    if wait:
+        return busy_response(wait, 'Demasiadas consultas, intenta de nuevo más tarde')
+    
+    try:
+        info = extract_video_info(url)
+    except Exception as e:
+        return jsonify({'error': f"Error obteniendo información del video: {str(e)}"}), 400
+    
+    title = info.get('title', 'audio')
+    cache_key = result_key(info.get('extractor_key'), info.get('id'), params)
+    download_name = attachment_name(title, cache_key)
+    mimetype = audio_mimetype(cache_key)
+    if result_cache.get(cache_key):
+        return send_cached_file(cache_key, title)
+    
+    try:
+        check_job_limits(info, select_audio_format(info, params), params)
+    except JobRejected as e:
+        return jsonify({'error': str(e), 'reason': e.reason}), 400
+    
+    headers = {
+        'Content-Disposition': content_disposition(download_name),
+        'Cache-Control': 'no-store',
+        'X-Accel-Buffering': 'no',
+    }
+    # HEAD (que Flask añade a toda ruta GET) no convierte nada ni reserva recursos
+    if request.method == 'HEAD':
+        return Response(mimetype=mimetype, headers=headers)
+    
+    # Un stream cuenta como una conversión más del cliente
+    stream_id = f"stream-{uuid.uuid4()}"
+    if not acquire_client_job(client, stream_id):
+        return busy_response(RETRY_AFTER_SECONDS, f'Máximo {MAX_CLIENT_JOBS} conversiones simultáneas por cliente')
+    wait = check_rate(client, 'convert', conversion_cost(info.get('duration')))
+    if wait:
+        release_client_job(client, stream_id)
+        return busy_response(wait, 'Demasiadas conversiones, intenta de nuevo más tarde')
+    
+    # Cada stream ocupa un ffmpeg, así que se limita igual que el pool de conversión
+    if not stream_slots.acquire():
+        release_client_job(client, stream_id)
+        return busy_response()
+    
+    def release():
+        stream_slots.release()
+        release_client_job(client, stream_id)
+    
+    response = Response(stream_with_context(count_served(stream_audio(info, cache_key, params), 'stream')),
+                        mimetype=mimetype, headers=headers)
+    # El servidor cierra siempre la respuesta, aunque el cliente se vaya antes del
+    # primer fragmento y el generador no llegue a empezar
+    response.call_on_close(release)
+    return response
+
+@app.route('/api/batch', methods=['POST'])
+def create_batch():
+    """Convertir una lista de reproducción/canal (`url`) o una lista de URLs (`urls`)"""
+    try:
+        data = request.get_json()
+        url = data.get('url')
+        urls = data.get('urls')
+        
+        if not url and not urls:
+            return jsonify({'error': 'URL o lista de URLs requerida'}), 400
+        
+        if urls is not None and (not isinstance(urls, list) or len(urls) > MAX_BATCH_ITEMS):
+            return jsonify({'error': f'La lista debe tener como máximo {MAX_BATCH_ITEMS} URLs'}), 400
+        
+        try:
+            params = parse_audio_params(data)
+        except ValueError as e:
+            return jsonify({'error': str(e)}), 400
+        
+        # Cada elemento paga además su duración al extraer sus metadatos
+        client = client_id()
+        wait = check_rate(client, 'convert', len(urls) if urls else 1)
+        if wait:
+            return busy_response(wait, 'Demasiadas conversiones, intenta de nuevo más tarde')
+        
+        batch_id = start_batch(url, urls, params, client)
+        return jsonify({'success': True, 'batch_id': batch_id})
         
     except Exception as e:
         return jsonify({'error': str(e)}), 500
 
+@app.route('/api/batch/<batch_id>')
+def get_batch(batch_id):
+    """Progreso agregado y por elemento de un lote"""
+    summary = batch_summary(batch_id)
+    if summary is None:
+        return jsonify({'status': 'not_found'})
+    return jsonify(summary)
+
+@app.route('/api/batch/<batch_id>/zip')
+def download_batch_zip(batch_id):
+    """Descargar el lote como ZIP, generado a medida que terminan los elementos"""
+    batch = progress_store.get(batch_id)
+    if not batch or batch.get('type') != 'batch':
+        return jsonify({'error': 'Lote no encontrado'}), 404
+    
+    return Response(stream_with_context(count_served(stream_batch_zip(batch_id), 'zip')), mimetype='application/zip', headers={
+        'Content-Disposition': content_disposition(attachment_name(batch.get('title') or 'lote', 'lote.zip')),
+        'Cache-Control': 'no-store',
+        'X-Accel-Buffering': 'no',
+    })
+
+def attachment_name(title, cached_name=None):
+    """Nombre de archivo seguro para la descarga, con la extensión del resultado"""
+    # Limpiar título para nombre de archivo
+    safe_title = "".join(c for c in (title or 'audio') if c.isalnum() or c in (' ', '-', '_')).rstrip()
+    extension = os.path.splitext(cached_name or '')[1] or '.mp3'
+    return f"{safe_title or 'audio'}{extension}"
+
+def audio_mimetype(cached_name):
+    extension = os.path.splitext(cached_name or '')[1].lstrip('.')
+    return AUDIO_FORMATS.get(extension, AUDIO_FORMATS[DEFAULT_FORMAT])['mimetype']
+
+def content_disposition(filename):
+    """Cabecera Content-Disposition con respaldo ASCII para nombres no ASCII"""
+    ascii_name = unicodedata.normalize('NFKD', filename).encode('ascii', 'ignore').decode('ascii')
+    if ascii_name == filename:
+        return f'attachment; filename="{filename}"'
+    return f"attachment; filename=\"{ascii_name}\"; filename*=UTF-8''{quote(filename)}"
+
 @app.route('/api/cleanup/<download_id>', methods=['DELETE'])
 def cleanup_file(download_id):
     """Limpiar archivos temporales"""
     try:
-        file_path = os.path.join(DOWNLOAD_FOLDER, f"{download_id}.mp3")
-        
-        if os.path.exists(file_path):
-            os.remove(file_path)
+        # El MP3 puede estar compartido en la caché; su borrado lo decide el desalojo LRU
+        scheduler.detach(download_id)
         
         # Remover del diccionario de progreso
-        if download_id in download_progress:
-            del download_progress[download_id]
+        progress_store.delete(download_id)
         
         return jsonify({'success': True})
         
     except Exception as e:
         return jsonify({'error': str(e)}), 500
 
+@app.route('/api/stats')
+def get_stats():
+    """Estadísticas del planificador y de la caché"""
+    return jsonify({
+        'scheduler': scheduler.stats(),
+        'cache': result_cache.stats(),
+        'metadata_cache': metadata_cache.stats(),
+        'janitor': janitor.stats(),
+        'progress': progress_store.stats(),
+        'ytdl_pool': ytdl_pool.stats(),
+        'rate_limits': rate_limiter.stats(),
+        'startup': startup_timings,
+    })
+
+@app.route('/metrics')
+def metrics():
+    """Métricas en formato de texto de Prometheus (de este worker)"""
+    queue = scheduler.stats()
+    cache = result_cache.stats()
+    metadata = metadata_cache.stats()
+    ytdl = ytdl_pool.stats()
+    streams_active = stream_slots.in_use
+    gauges = [
+        ('ytmp3_queue_pending', 'Trabajos esperando en la cola', queue['pending']),
+        ('ytmp3_queue_capacity', 'Tamaño máximo de la cola', queue['max_pending']),
+        ('ytmp3_jobs_inflight', 'Trabajos distintos en curso', queue['inflight']),
+        ('ytmp3_active_downloads', 'Descargas en curso', queue['active_downloads']),
+        ('ytmp3_active_transcodes', 'Conversiones de ffmpeg en curso', queue['active_transcodes']),
+        ('ytmp3_active_streams', 'Conversiones en streaming en curso', streams_active),
+        ('ytmp3_download_pool_saturation', 'Fracción del pool de descargas ocupada',
+         queue['active_downloads'] / queue['download_workers']),
+        ('ytmp3_transcode_pool_saturation', 'Fracción del pool de conversión ocupada',
+         queue['active_transcodes'] / queue['transcode_workers']),
+        ('ytmp3_stream_pool_saturation', 'Fracción de los streams permitidos en uso',
+         streams_active / MAX_STREAMS if MAX_STREAMS else 0),
+        ('ytmp3_result_cache_bytes', 'Tamaño de la caché de resultados', cache['bytes']),
+        ('ytmp3_result_cache_entries', 'Archivos en la caché de resultados', cache['entries']),
+        ('ytmp3_result_cache_hit_ratio', 'Aciertos / consultas de la caché de resultados', cache['hit_ratio']),
+        ('ytmp3_metadata_cache_entries', 'Entradas en la caché de metadatos', metadata['entries']),
+        ('ytmp3_metadata_cache_hit_ratio', 'Aciertos / consultas de la caché de metadatos', metadata['hit_ratio']),
+    ]
+    progress = progress_store.stats()
+    if progress:
+        gauges += [
+            ('ytmp3_progress_entries', 'Entradas en la tabla de progreso', progress['entries']),
+            ('ytmp3_progress_bytes', 'Memoria aproximada de la tabla de progreso', progress['bytes']),
+        ]
+    counters = [
+        ('ytmp3_result_cache_hits_total', 'Aciertos de la caché de resultados', cache['hits']),
+        ('ytmp3_result_cache_misses_total', 'Fallos de la caché de resultados', cache['misses']),
+        ('ytmp3_result_cache_evictions_total', 'Archivos desalojados de la caché', cache['evictions']),
+        ('ytmp3_metadata_cache_hits_total', 'Aciertos de la caché de metadatos', metadata['hits']),
+        ('ytmp3_metadata_cache_misses_total', 'Fallos de la caché de metadatos', metadata['misses']),
+        ('ytmp3_coalesced_requests_total', 'Solicitudes agrupadas con un trabajo idéntico', queue['coalesced']),
+        ('ytmp3_ytdl_instances_created_total', 'Instancias de YoutubeDL creadas', ytdl['created']),
+        ('ytmp3_ytdl_instances_reused_total', 'Usos de una instancia de YoutubeDL ya creada', ytdl['reused']),
+    ]
+    
+    lines = []
+    for kind, entries in (('gauge', gauges), ('counter', counters)):
+        for name, help_text, value in entries:
+            lines += [f"# HELP {name} {help_text}", f"# TYPE {name} {kind}", f"{name} {value:g}"]
+    lines += ['# HELP ytmp3_startup_seconds Duración de cada fase del arranque del worker',
+              '# TYPE ytmp3_startup_seconds gauge']
+    for phase, seconds in startup_timings.items():
+        lines.append(f'ytmp3_startup_seconds{{phase="{phase}"}} {seconds:g}')
+    for metric in (stage_seconds, jobs_total, bytes_served, rate_limited):
+        lines += metric.render()
+    return Response('\n'.join(lines) + '\n', mimetype='text/plain; version=0.0.4')
+
+def warm_up():
+    """Cargar por adelantado lo caro y de solo lectura
+    
+    Con `gunicorn --preload` (ver gunicorn.conf.py) se ejecuta una vez en el
+    proceso maestro y los workers lo heredan compartido (copia en escritura):
+    yt-dlp importado y las expresiones de URL de todos los extractores ya
+    compiladas, que de otro modo cada worker compila en su primera petición.
+    """
+    started = time.perf_counter()
+    for ie in yt_dlp.extractor.gen_extractor_classes():
+        ie.suitable('https://warm-up.invalid/')
+    startup_timings['warm_up'] = time.perf_counter() - started
+    frontend.build()
+
+def startup_report():
+    return 'Arranque: ' + ', '.join(f"{phase} {seconds:.2f}s" for phase, seconds in startup_timings.items())
+
 # Limpiar archivos antiguos al iniciar
 def cleanup_old_files():
-    """Limpiar archivos más antiguos de 1 hora"""
-    try:
-        current_time = time.time()
-        for filename in os.listdir(DOWNLOAD_FOLDER):
-            file_path = os.path.join(DOWNLOAD_FOLDER, filename)
-            if os.path.getctime(file_path) < current_time - 3600:  # 1 hora
-                os.remove(file_path)
-                print(f"Archivo eliminado: {filename}")
-    except Exception as e:
-        print(f"Error limpiando archivos: {e}")
+    """Aplicar los límites de la caché y borrar fragmentos huérfanos"""
+    janitor.run_once()
 
 # Template HTML integrado
 HTML_TEMPLATE = '''
@@ -345,6 +3487,16 @@ HTML_TEMPLATE = '''
             transform: translateY(-50%) scale(1.05);
         }
 
+        .format-select {
+            padding: 10px 15px;
+            border: 2px solid #e0e0e0;
+            border-radius: 10px;
+            font-size: 14px;
+            background: rgba(255, 255, 255, 0.9);
+            color: #333;
+            margin-bottom: 10px;
+        }
+
         .convert-btn {
             background: linear-gradient(135deg, #667eea, #764ba2);
             color: white;
@@ -516,6 +3668,14 @@ HTML_TEMPLATE = '''
             <button class="paste-btn" onclick="pasteFromClipboard()">📋 Pegar</button>
         </div>
         
+        <select class="format-select" id="audioFormat">
+            <option value="mp3:192">MP3 · 192 kbps</option>
+            <option value="mp3:320">MP3 · 320 kbps</option>
+            <option value="m4a:">M4A (AAC) · calidad original</option>
+            <option value="opus:">Opus · calidad original</option>
+            <option value="flac:">FLAC · sin pérdida</option>
+        </select>
+        
         <button class="convert-btn" onclick="convertVideo()">
             <span id="btn-text">🔄 Convertir a MP3</span>
         </button>
@@ -531,7 +3691,7 @@ HTML_TEMPLATE = '''
             <div class="video-title" id="videoTitle"></div>
             <div class="video-details" id="videoDetails"></div>
             <a href="#" class="download-link" id="downloadLink" target="_blank">
-                📥 Descargar MP3
+                📥 Descargar audio
             </a>
         </div>
         
@@ -589,10 +3749,11 @@ HTML_TEMPLATE = '''
                 // Iniciar conversión
                 startConversion();
                 
+                const [format, bitrate] = document.getElementById('audioFormat').value.split(':');
                 const response = await fetch('/api/convert', {
                     method: 'POST',
                     headers: {'Content-Type': 'application/json'},
-                    body: JSON.stringify({url: url})
+                    body: JSON.stringify({url: url, format: format, bitrate: bitrate || null})
                 });
                 
                 const data = await response.json();
@@ -610,37 +3771,64 @@ HTML_TEMPLATE = '''
             }
         }
         
-        async function monitorProgress(downloadId) {
-            const checkProgress = async () => {
-                try {
-                    const response = await fetch(`/api/progress/${downloadId}`);
-                    const progress = await response.json();
-                    
-                    if (progress.status === 'not_found') {
-                        showError('Descarga no encontrada');
-                        stopConversion();
-                        return;
-                    }
-                    
-                    updateStatus(progress.stage || 'Procesando...', progress.percent || 0);
-                    
-                    if (progress.status === 'completed') {
-                        showDownloadLink(downloadId);
-                        showSuccess('¡Conversión completada exitosamente!');
-                        stopConversion();
-                    } else if (progress.status === 'error') {
-                        showError(progress.stage || 'Error durante la conversión');
-                        stopConversion();
-                    } else {
-                        setTimeout(checkProgress, 1000);
-                    }
-                } catch (error) {
-                    showError('Error monitoreando progreso: ' + error.message);
-                    stopConversion();
-                }
-            };
+        function handleProgress(downloadId, progress) {
+            // Devuelve true cuando la descarga ha terminado (con éxito o error)
+            if (progress.status === 'not_found') {
+                showError('Descarga no encontrada');
+                stopConversion();
+                return true;
+            }
+            
+            let stage = progress.stage || 'Procesando...';
+            if (progress.status === 'queued' && progress.queue_position) {
+                stage = `En cola (posición ${progress.queue_position})...`;
+            }
+            updateStatus(stage, progress.percent || 0);
+            
+            if (progress.status === 'completed') {
+                showDownloadLink(downloadId);
+                showSuccess('¡Conversión completada exitosamente!');
+                stopConversion();
+                return true;
+            } else if (progress.status === 'error') {
+                showError(progress.stage || 'Error durante la conversión');
+                stopConversion();
+                return true;
+            }
+            return false;
+        }
+        
+        function monitorProgress(downloadId) {
+            if (!window.EventSource) {
+                pollProgress(downloadId, -1);
+                return;
+            }
             
-            checkProgress();
+            // Canal push (SSE); si se corta, seguir con long-poll
+            let finished = false;
+            const source = new EventSource(`/api/progress/${downloadId}/stream`);
+            source.onmessage = (event) => {
+                finished = handleProgress(downloadId, JSON.parse(event.data));
+                if (finished) source.close();
+            };
+            source.onerror = () => {
+                source.close();
+                if (!finished) pollProgress(downloadId, -1);
+            };
+        }
+        
+        async function pollProgress(downloadId, version) {
+            try {
+                const response = await fetch(`/api/progress/${downloadId}?since=${version}`);
+                const progress = await response.json();
+                
+                if (!handleProgress(downloadId, progress)) {
+                    pollProgress(downloadId, progress.version);
+                }
+            } catch (error) {
+                showError('Error monitoreando progreso: ' + error.message);
+                stopConversion();
+            }
         }
         
         function startConversion() {
@@ -727,8 +3915,12 @@ HTML_TEMPLATE = '''
 </html>
 '''
 
+# Lo que cuesta importar este módulo (sin yt-dlp, que se carga al usarlo)
+startup_timings['import'] = time.perf_counter() - _import_started
+
 if __name__ == '__main__':
     print("🎵 YouTube to MP3 Converter iniciando...")
+    print(f"⏱️ {startup_report()}")
     print("📂 Limpiando archivos antiguos...")
     cleanup_old_files()
     
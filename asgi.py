@@ -0,0 +1,324 @@
+"""Modo de servicio asíncrono (ASGI) para la API
+
+Expone las mismas rutas que la aplicación Flask de app.py. El progreso
+(long-poll y Server-Sent Events) se atiende de forma nativa con asyncio,
+así que miles de clientes esperando cuestan solo una corrutina cada uno.
+El resto de rutas se ejecuta sobre la aplicación Flask en un pool de
+hilos, de modo que la extracción, la conversión y el envío de archivos
+nunca bloquean el bucle de eventos.
+
+Uso:
+    uvicorn asgi:app --host 0.0.0.0 --port 5000
+    gunicorn -k uvicorn.workers.UvicornWorker asgi:app
+"""
+import asyncio
+import io
+import json
+import os
+import re
+import sys
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import parse_qs
+
+from werkzeug.wsgi import FileWrapper
+
+import app as backend
+
+ASGI_THREADS = int(os.environ.get('ASGI_THREADS', 64))
+# Cada fragmento de un archivo cuesta un salto al pool de hilos; mejor pocos y grandes
+ASGI_FILE_CHUNK_SIZE = int(os.environ.get('ASGI_FILE_CHUNK_SIZE', 256 * 1024))
+
+PROGRESS_ROUTE = re.compile(r'^/api/progress/(?P<download_id>[^/]+)$')
+PROGRESS_STREAM_ROUTE = re.compile(r'^/api/progress/(?P<download_id>[^/]+)/stream$')
+
+executor = ThreadPoolExecutor(max_workers=ASGI_THREADS, thread_name_prefix='asgi')
+# Las peticiones que llegan a Flask usan un hilo propio cada una; ASGI_THREADS las limita
+flask_slots = asyncio.Semaphore(ASGI_THREADS)
+
+
+async def off_loop(function, *args):
+    """Ejecutar una llamada bloqueante en el pool de hilos"""
+    return await asyncio.get_running_loop().run_in_executor(executor, function, *args)
+
+
+class ProgressNotifier:
+    """Despierta a las corrutinas que esperan un cambio de progreso
+
+    `set_progress` avisa desde cualquier hilo; el aviso se pasa al bucle de
+    eventos con call_soon_threadsafe. Con almacenes compartidos los cambios
+    de otros procesos no generan aviso, así que además se consulta la
+    versión cada STATE_POLL_INTERVAL segundos.
+    """
+
+    def __init__(self, loop):
+        self.loop = loop
+        self.waiters = {}
+        if isinstance(backend.progress_store, backend.MemoryProgressStore):
+            self.poll_interval = backend.PROGRESS_HEARTBEAT
+        else:
+            self.poll_interval = backend.STATE_POLL_INTERVAL
+
+    def notify(self, download_id):
+        if download_id in self.waiters:
+            self.loop.call_soon_threadsafe(self._wake, download_id)
+
+    def _wake(self, download_id):
+        for event in self.waiters.get(download_id, ()):
+            event.set()
+
+    async def wait(self, download_id, since, timeout):
+        """Esperar a una versión posterior a `since`; devuelve la versión actual"""
+        deadline = self.loop.time() + timeout
+        while True:
+            # Registrar antes de leer la versión para no perder un aviso
+            event = asyncio.Event()
+            self.waiters.setdefault(download_id, set()).add(event)
+            try:
+                version = await store_call(backend.progress_store.version, download_id)
+                remaining = deadline - self.loop.time()
+                if version > since or remaining <= 0:
+                    return version
+                try:
+                    await asyncio.wait_for(event.wait(), min(remaining, self.poll_interval))
+                except asyncio.TimeoutError:
+                    pass
+            finally:
+                waiters = self.waiters.get(download_id)
+                waiters.discard(event)
+                if not waiters:
+                    del self.waiters[download_id]
+
+
+notifier = None
+
+
+async def store_call(function, *args):
+    # El almacén en memoria responde al instante; los compartidos hacen E/S
+    if isinstance(backend.progress_store, backend.MemoryProgressStore):
+        return function(*args)
+    return await off_loop(function, *args)
+
+
+async def snapshot(download_id):
+    progress_id, progress = await store_call(backend.progress_snapshot, download_id)
+    version = await store_call(backend.progress_store.version, progress_id)
+    return progress_id, progress, version
+
+
+async def send_json(send, data, status=200):
+    body = json.dumps(data).encode('utf-8')
+    await send({
+        'type': 'http.response.start',
+        'status': status,
+        'headers': [
+            (b'content-type', b'application/json'),
+            (b'content-length', str(len(body)).encode('latin-1')),
+            (b'access-control-allow-origin', b'*'),
+        ],
+    })
+    await send({'type': 'http.response.body', 'body': body})
+
+
+async def get_progress(scope, receive, send, download_id):
+    """Long-poll nativo: igual que la ruta Flask pero sin ocupar un hilo"""
+    query = parse_qs(scope.get('query_string', b'').decode('latin-1'))
+    progress_id, progress, version = await snapshot(download_id)
+
+    try:
+        since = int(query['since'][0]) if 'since' in query else None
+        wait = float(query['wait'][0]) if 'wait' in query else backend.LONG_POLL_MAX_WAIT
+    except ValueError:
+        since, wait = None, 0
+
+    if since is not None and progress.get('status') not in backend.TERMINAL_STATUSES:
+        wait = min(wait, backend.LONG_POLL_MAX_WAIT)
+        if await notifier.wait(progress_id, since, wait) > since:
+            # Dejar que se acumulen las actualizaciones rápidas del hook
+            await asyncio.sleep(backend.PROGRESS_MIN_INTERVAL)
+        progress_id, progress, version = await snapshot(download_id)
+
+    await send_json(send, dict(progress, version=version))
+
+
+async def stream_progress(scope, receive, send, download_id):
+    """Server-Sent Events nativos hasta que la descarga termina o el cliente se va"""
+    await send({
+        'type': 'http.response.start',
+        'status': 200,
+        'headers': [
+            (b'content-type', b'text/event-stream; charset=utf-8'),
+            (b'cache-control', b'no-cache'),
+            (b'x-accel-buffering', b'no'),
+            (b'access-control-allow-origin', b'*'),
+        ],
+    })
+
+    disconnected = asyncio.Event()
+
+    async def watch_disconnect():
+        while (await receive())['type'] != 'http.disconnect':
+            pass
+        disconnected.set()
+
+    watcher = asyncio.ensure_future(watch_disconnect())
+    try:
+        sent = None
+        while not disconnected.is_set():
+            progress_id, progress, version = await snapshot(download_id)
+            if (progress_id, version) != sent:
+                sent = (progress_id, version)
+                event = f"data: {json.dumps(progress)}\n\n".encode('utf-8')
+                await send({'type': 'http.response.body', 'body': event, 'more_body': True})
+                if progress.get('status') in backend.TERMINAL_STATUSES:
+                    break
+                # Agrupar las actualizaciones rápidas del hook en un evento por intervalo
+                await asyncio.sleep(backend.PROGRESS_MIN_INTERVAL)
+                continue
+            if await notifier.wait(progress_id, version, backend.PROGRESS_HEARTBEAT) == version:
+                await send({'type': 'http.response.body', 'body': b': ping\n\n', 'more_body': True})
+        await send({'type': 'http.response.body', 'body': b''})
+    finally:
+        watcher.cancel()
+
+
+def build_environ(scope, body):
+    """Entorno WSGI equivalente a una petición ASGI"""
+    server = scope.get('server') or ('localhost', 80)
+    client = scope.get('client') or ('', 0)
+    environ = {
+        'REQUEST_METHOD': scope['method'],
+        'SCRIPT_NAME': scope.get('root_path', ''),
+        'PATH_INFO': scope['path'],
+        'QUERY_STRING': scope.get('query_string', b'').decode('latin-1'),
+        'SERVER_NAME': server[0],
+        'SERVER_PORT': str(server[1]),
+        'SERVER_PROTOCOL': f"HTTP/{scope.get('http_version', '1.1')}",
+        'REMOTE_ADDR': client[0],
+        'REMOTE_PORT': str(client[1]),
+        'wsgi.version': (1, 0),
+        'wsgi.url_scheme': scope.get('scheme', 'http'),
+        'wsgi.input': io.BytesIO(body),
+        # El cuerpo ya está completo: su longitud vale también para peticiones chunked
+        'CONTENT_LENGTH': str(len(body)),
+        'wsgi.input_terminated': True,
+        'wsgi.errors': sys.stderr,
+        'wsgi.multithread': True,
+        'wsgi.multiprocess': True,
+        'wsgi.run_once': False,
+        'wsgi.file_wrapper': lambda file, buffer_size=None: FileWrapper(file, ASGI_FILE_CHUNK_SIZE),
+    }
+    for raw_name, raw_value in scope.get('headers', []):
+        name = raw_name.decode('latin-1').upper().replace('-', '_')
+        value = raw_value.decode('latin-1')
+        if name == 'CONTENT_TYPE':
+            environ['CONTENT_TYPE'] = value
+        elif name == 'CONTENT_LENGTH':
+            continue
+        else:
+            key = f'HTTP_{name}'
+            environ[key] = f"{environ[key]},{value}" if key in environ else value
+    return environ
+
+
+async def call_flask(scope, receive, send):
+    """Atender la petición con la aplicación Flask en el pool de hilos"""
+    body = bytearray()
+    while True:
+        message = await receive()
+        if message['type'] == 'http.disconnect':
+            return
+        body += message.get('body', b'')
+        if not message.get('more_body'):
+            break
+
+    # Llamada, iteración y cierre en un mismo hilo: stream_with_context guarda el
+    # contexto de la petición en variables de contexto del hilo que la empezó
+    async with flask_slots:
+        worker = ThreadPoolExecutor(max_workers=1, thread_name_prefix='asgi-request')
+        try:
+            await respond_flask(worker, scope, receive, send, bytes(body))
+        finally:
+            worker.shutdown(wait=False)
+
+
+async def respond_flask(worker, scope, receive, send, body):
+    """Enviar la respuesta WSGI ejecutando cada paso en el hilo de la petición"""
+    response_start = {}
+
+    def start_response(status, headers, exc_info=None):
+        response_start['status'] = int(status.split(' ', 1)[0])
+        response_start['headers'] = [
+            (name.lower().encode('latin-1'), value.encode('latin-1')) for name, value in headers
+        ]
+        return lambda data: None
+
+    loop = asyncio.get_running_loop()
+    result = await loop.run_in_executor(worker, backend.app, build_environ(scope, body), start_response)
+    iterator = iter(result)
+
+    disconnected = asyncio.Event()
+
+    async def watch_disconnect():
+        while (await receive())['type'] != 'http.disconnect':
+            pass
+        disconnected.set()
+
+    watcher = asyncio.ensure_future(watch_disconnect())
+    try:
+        started = False
+        while not disconnected.is_set():
+            # Cada fragmento (lectura de archivo, salida de ffmpeg...) se obtiene fuera del bucle
+            chunk = await loop.run_in_executor(worker, next, iterator, None)
+            if not started:
+                await send({
+                    'type': 'http.response.start',
+                    'status': response_start['status'],
+                    'headers': response_start['headers'],
+                })
+                started = True
+            if chunk is None:
+                await send({'type': 'http.response.body', 'body': b''})
+                break
+            if chunk:
+                await send({'type': 'http.response.body', 'body': chunk, 'more_body': True})
+    finally:
+        watcher.cancel()
+        if hasattr(result, 'close'):
+            # Cerrar el generador detiene ffmpeg/ZIP si el cliente se desconectó
+            await loop.run_in_executor(worker, result.close)
+
+
+async def lifespan(scope, receive, send):
+    while True:
+        message = await receive()
+        if message['type'] == 'lifespan.startup':
+            await off_loop(backend._recover_once)
+            await send({'type': 'lifespan.startup.complete'})
+        elif message['type'] == 'lifespan.shutdown':
+            await send({'type': 'lifespan.shutdown.complete'})
+            return
+
+
+async def app(scope, receive, send):
+    """Aplicación ASGI"""
+    global notifier
+    if scope['type'] == 'lifespan':
+        await lifespan(scope, receive, send)
+        return
+
+    if notifier is None:
+        notifier = ProgressNotifier(asyncio.get_running_loop())
+        backend.progress_listeners.append(notifier.notify)
+
+    if scope['type'] == 'http' and scope['method'] == 'GET':
+        match = PROGRESS_STREAM_ROUTE.match(scope['path'])
+        if match:
+            await stream_progress(scope, receive, send, match['download_id'])
+            return
+        match = PROGRESS_ROUTE.match(scope['path'])
+        if match:
+            await get_progress(scope, receive, send, match['download_id'])
+            return
+
+    if scope['type'] == 'http':
+        await call_flask(scope, receive, send)
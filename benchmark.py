@@ -0,0 +1,391 @@
+"""Benchmark del flujo de conversión sin acceso a la red
+
+Genera archivos de audio/video de prueba con ffmpeg, los sirve desde un
+servidor HTTP local (con soporte de Range) y los convierte a través de la
+API real: yt-dlp los resuelve con su extractor genérico como enlaces
+directos, así que se ejercitan extracción, cola, descarga, conversión y
+caché exactamente igual que en producción.
+
+Mide trabajos por segundo, latencias p50/p95/p99 de cada etapa, segundos
+de CPU por minuto de audio y el pico de memoria (RSS), y escribe el
+resultado en JSON para comparar ejecuciones entre versiones:
+
+    python benchmark.py --jobs 20 --durations 30,180 --output bench.json
+"""
+import argparse
+import json
+import os
+import platform
+import re
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from http.server import SimpleHTTPRequestHandler, ThreadingHTTPServer
+
+# Etapas que se deducen de las transiciones de estado del progreso
+STAGES = ('queue_wait', 'download', 'transcode', 'total')
+FINAL_STATUSES = ('completed', 'error')
+
+
+class RangeRequestHandler(SimpleHTTPRequestHandler):
+    """Servidor de archivos estáticos con Range (un solo rango) y alias numerados
+
+    `/media/fixture-30s-7.webm` sirve `fixture-30s.webm`: cada trabajo usa
+    una URL (y por tanto un ID de video) distinta sin duplicar archivos.
+    """
+
+    extensions_map = dict(SimpleHTTPRequestHandler.extensions_map, **{
+        '.webm': 'audio/webm',
+        '.m4a': 'audio/mp4',
+        '.mp4': 'video/mp4',
+        '.mp3': 'audio/mpeg',
+    })
+
+    def translate_path(self, path):
+        path = re.sub(r'^/media/', '/', path.split('?', 1)[0])
+        path = re.sub(r'-\d+(\.\w+)$', r'\1', path)
+        return super().translate_path(path)
+
+    def send_head(self):
+        path = self.translate_path(self.path)
+        if not os.path.isfile(path):
+            self.send_error(404)
+            return None
+
+        size = os.path.getsize(path)
+        start, end = 0, size - 1
+        match = re.match(r'bytes=(\d*)-(\d*)$', self.headers.get('Range', ''))
+        if match and (match.group(1) or match.group(2)):
+            if match.group(1):
+                start = int(match.group(1))
+                end = min(int(match.group(2)), size - 1) if match.group(2) else size - 1
+            else:
+                start = max(size - int(match.group(2)), 0)
+            if start > end:
+                self.send_response(416)
+                self.send_header('Content-Range', f'bytes */{size}')
+                self.end_headers()
+                return None
+            self.send_response(206)
+            self.send_header('Content-Range', f'bytes {start}-{end}/{size}')
+        else:
+            self.send_response(200)
+
+        self.send_header('Content-Type', self.guess_type(path))
+        self.send_header('Content-Length', str(end - start + 1))
+        self.send_header('Accept-Ranges', 'bytes')
+        self.end_headers()
+
+        f = open(path, 'rb')
+        f.seek(start)
+        self.remaining = end - start + 1
+        return f
+
+    def copyfile(self, source, outputfile):
+        try:
+            while self.remaining > 0:
+                chunk = source.read(min(64 * 1024, self.remaining))
+                if not chunk:
+                    break
+                outputfile.write(chunk)
+                self.remaining -= len(chunk)
+        except (BrokenPipeError, ConnectionResetError):
+            pass  # el cliente cerró antes de tiempo (p. ej. el extractor genérico)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def start_fixture_server(folder):
+    """Arrancar el servidor de archivos de prueba; devuelve (servidor, URL base)"""
+    handler = lambda *args, **kwargs: RangeRequestHandler(*args, directory=folder, **kwargs)
+    server = ThreadingHTTPServer(('127.0.0.1', 0), handler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, f'http://127.0.0.1:{server.server_address[1]}/media'
+
+
+def generate_fixtures(folder, durations, ffmpeg='ffmpeg'):
+    """Generar un audio Opus/WebM y un video MP4 (con pista AAC) por duración"""
+    fixtures = []
+    for duration in durations:
+        audio = os.path.join(folder, f'fixture-{duration}s.webm')
+        subprocess.run([
+            ffmpeg, '-y', '-loglevel', 'error',
+            '-f', 'lavfi', '-i', f'sine=frequency=440:sample_rate=48000:duration={duration}',
+            '-codec:a', 'libopus', '-b:a', '128k', audio,
+        ], check=True)
+        fixtures.append({'file': os.path.basename(audio), 'duration': duration, 'kind': 'audio'})
+
+        video = os.path.join(folder, f'fixture-{duration}s.mp4')
+        subprocess.run([
+            ffmpeg, '-y', '-loglevel', 'error',
+            '-f', 'lavfi', '-i', f'testsrc=size=320x240:rate=15:duration={duration}',
+            '-f', 'lavfi', '-i', f'sine=frequency=220:sample_rate=44100:duration={duration}',
+            '-codec:v', 'libx264', '-preset', 'ultrafast', '-codec:a', 'aac', '-b:a', '128k',
+            '-shortest', video,
+        ], check=True)
+        fixtures.append({'file': os.path.basename(video), 'duration': duration, 'kind': 'video'})
+    return fixtures
+
+
+def percentiles(samples):
+    """p50/p95/p99 (rango más cercano), media y máximo de una lista de segundos"""
+    if not samples:
+        return None
+    ordered = sorted(samples)
+
+    def rank(p):
+        return ordered[min(len(ordered) - 1, max(0, int(round(p / 100 * len(ordered))) - 1))]
+
+    return {
+        'count': len(ordered),
+        'mean': sum(ordered) / len(ordered),
+        'p50': rank(50),
+        'p95': rank(95),
+        'p99': rank(99),
+        'max': ordered[-1],
+    }
+
+
+def cpu_seconds():
+    """CPU consumida por este proceso y por sus hijos ya terminados (ffmpeg)"""
+    own = resource.getrusage(resource.RUSAGE_SELF)
+    children = resource.getrusage(resource.RUSAGE_CHILDREN)
+    return own.ru_utime + own.ru_stime + children.ru_utime + children.ru_stime
+
+
+def peak_rss_mb():
+    # ru_maxrss está en KiB en Linux
+    own = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    children = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss
+    return {'self': own / 1024, 'children': children / 1024}
+
+
+class StageRecorder:
+    """Anota cuándo cambia de estado cada descarga a partir de los avisos de progreso"""
+
+    def __init__(self, backend):
+        self.backend = backend
+        self.lock = threading.Lock()
+        self.transitions = {}
+        self.finished = {}
+
+    def __call__(self, download_id):
+        progress = self.backend.progress_store.get(download_id) or {}
+        status = progress.get('status')
+        if status is None:
+            return
+        with self.lock:
+            seen = self.transitions.setdefault(download_id, {})
+            seen.setdefault(status, time.perf_counter())
+        if status in FINAL_STATUSES:
+            self.finished_event(download_id).set()
+
+    def finished_event(self, download_id):
+        with self.lock:
+            return self.finished.setdefault(download_id, threading.Event())
+
+    def stages(self, download_id):
+        with self.lock:
+            seen = dict(self.transitions.get(download_id, {}))
+        if 'completed' not in seen or 'queued' not in seen:
+            return None
+        started = seen.get('starting', seen['queued'])
+        converting = seen.get('converting', seen['completed'])
+        return {
+            'queue_wait': started - seen['queued'],
+            'download': converting - started,
+            'transcode': seen['completed'] - converting,
+            'total': seen['completed'] - seen['queued'],
+        }
+
+
+def wait_for(backend, recorder, download_ids, timeout):
+    """Esperar a que todas las descargas terminen; devuelve sus estados finales
+
+    Se espera a los avisos del StageRecorder en lugar de consultar el progreso:
+    sondear desde este proceso sumaría su CPU a la medida del pipeline.
+    """
+    deadline = time.monotonic() + timeout
+    final = {}
+    for download_id in download_ids:
+        leader = backend.resolve_download(download_id)
+        event = recorder.finished_event(leader)
+        # El trabajo pudo terminar antes de que existiera su evento
+        progress = backend.progress_store.get(leader) or {}
+        if progress.get('status') in FINAL_STATUSES or event.wait(max(0, deadline - time.monotonic())):
+            final[download_id] = backend.progress_store.get(leader) or {'status': 'not_found'}
+        else:
+            final[download_id] = {'status': 'timeout'}
+    return final
+
+
+def run(args):
+    workdir = tempfile.mkdtemp(prefix='ytmp3-bench-')
+    fixtures_dir = os.path.join(workdir, 'fixtures')
+    os.makedirs(fixtures_dir)
+
+    # La aplicación crea sus carpetas relativas al directorio actual
+    os.chdir(workdir)
+    os.environ.setdefault('STATE_BACKEND_URL', 'memory://')
+    # Todas las conversiones salen del mismo cliente: sin límites por cliente
+    for name in ('METADATA_RATE', 'CONVERT_RATE', 'MAX_CLIENT_JOBS'):
+        os.environ.setdefault(name, '0')
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+    import app as backend
+    backend.app.root_path = workdir
+
+    durations = [int(value) for value in args.durations.split(',')]
+    fixtures = generate_fixtures(fixtures_dir, durations, backend.FFMPEG_BINARY)
+    if args.kind != 'all':
+        fixtures = [fixture for fixture in fixtures if fixture['kind'] == args.kind]
+    server, base_url = start_fixture_server(fixtures_dir)
+
+    recorder = StageRecorder(backend)
+    backend.progress_listeners.append(recorder)
+    client = backend.app.test_client()
+    results = {}
+
+    def job_url(fixture, index):
+        stem, extension = os.path.splitext(fixture['file'])
+        return f"{base_url}/{stem}-{index}{extension}"
+
+    # 1. Extracción de metadatos en frío (cada URL es un video distinto)
+    samples = []
+    for index in range(args.extract_samples):
+        fixture = fixtures[index % len(fixtures)]
+        started = time.perf_counter()
+        backend.get_video_info(job_url(fixture, 100000 + index))
+        samples.append(time.perf_counter() - started)
+    results['extract'] = percentiles(samples)
+
+    # 2. Flujo completo: todos los trabajos se envían de golpe a /api/convert
+    jobs = [(job_url(fixtures[index % len(fixtures)], index), fixtures[index % len(fixtures)])
+            for index in range(args.jobs)]
+    cpu_before = cpu_seconds()
+    started = time.perf_counter()
+    submit_samples = []
+    download_ids = []
+    for url, fixture in jobs:
+        submitted = time.perf_counter()
+        response = client.post('/api/convert', json={'url': url, 'format': args.format})
+        submit_samples.append(time.perf_counter() - submitted)
+        if response.status_code == 200:
+            download_ids.append((response.get_json()['download_id'], fixture))
+    final = wait_for(backend, recorder, [download_id for download_id, _ in download_ids], args.timeout)
+    wall = time.perf_counter() - started
+    cpu_used = cpu_seconds() - cpu_before
+
+    completed = [(download_id, fixture) for download_id, fixture in download_ids
+                 if final[download_id]['status'] == 'completed']
+    audio_minutes = sum(fixture['duration'] for _, fixture in completed) / 60
+    stage_samples = {stage: [] for stage in STAGES}
+    for download_id, _ in completed:
+        stages = recorder.stages(download_id)
+        if stages:
+            for stage in STAGES:
+                stage_samples[stage].append(stages[stage])
+
+    results['pipeline'] = {
+        'jobs': args.jobs,
+        'accepted': len(download_ids),
+        'completed': len(completed),
+        'failed': {download_id: progress.get('stage') for download_id, progress in final.items()
+                   if progress['status'] != 'completed'},
+        'wall_seconds': wall,
+        'jobs_per_second': len(completed) / wall if wall else 0,
+        'audio_minutes': audio_minutes,
+        'cpu_seconds': cpu_used,
+        'cpu_seconds_per_audio_minute': cpu_used / audio_minutes if audio_minutes else None,
+        'submit': percentiles(submit_samples),
+        'stages': {stage: percentiles(values) for stage, values in stage_samples.items()},
+    }
+
+    # 3. Aciertos de caché: repetir URLs ya convertidas
+    samples = []
+    for url, _ in jobs[:args.extract_samples]:
+        started = time.perf_counter()
+        client.post('/api/convert', json={'url': url, 'format': args.format})
+        samples.append(time.perf_counter() - started)
+    results['cache_hit'] = percentiles(samples)
+
+    # 4. Rendimiento de endpoints ligeros (peticiones por segundo, un cliente)
+    endpoints = {}
+    sample_id = completed[0][0] if completed else 'missing'
+    for name, path in (('progress', f'/api/progress/{sample_id}'), ('stats', '/api/stats')):
+        count = 0
+        started = time.perf_counter()
+        while time.perf_counter() - started < args.endpoint_seconds:
+            client.get(path)
+            count += 1
+        endpoints[name] = count / (time.perf_counter() - started)
+    results['endpoints_rps'] = endpoints
+
+    results['peak_rss_mb'] = peak_rss_mb()
+    server.shutdown()
+
+    report = {
+        'meta': {
+            'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S%z'),
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'cpu_count': os.cpu_count(),
+            'yt_dlp': backend.yt_dlp.version.__version__,
+            'ffmpeg': ffmpeg_version(backend.FFMPEG_BINARY),
+            'args': vars(args),
+            'config': {
+                'download_workers': backend.DOWNLOAD_WORKERS,
+                'transcode_workers': backend.TRANSCODE_WORKERS,
+                'max_pending_jobs': backend.MAX_PENDING_JOBS,
+                'download_connections': backend.DOWNLOAD_CONNECTIONS,
+                'segment_size': backend.SEGMENT_SIZE,
+            },
+            'fixtures': fixtures,
+        },
+        'results': results,
+    }
+    if not args.keep:
+        shutil.rmtree(workdir, ignore_errors=True)
+    return report
+
+
+def ffmpeg_version(ffmpeg):
+    try:
+        output = subprocess.run([ffmpeg, '-version'], capture_output=True, text=True).stdout
+        return output.splitlines()[0] if output else None
+    except OSError:
+        return None
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark del convertidor con archivos locales')
+    parser.add_argument('--jobs', type=int, default=20, help='trabajos del flujo completo')
+    parser.add_argument('--durations', default='30,180', help='duraciones de los archivos de prueba (s)')
+    parser.add_argument('--kind', choices=('all', 'audio', 'video'), default='all')
+    parser.add_argument('--format', default='mp3', help='formato de salida pedido')
+    parser.add_argument('--extract-samples', type=int, default=10)
+    parser.add_argument('--endpoint-seconds', type=float, default=2.0)
+    parser.add_argument('--timeout', type=float, default=600.0)
+    parser.add_argument('--output', default='benchmark-results.json')
+    parser.add_argument('--keep', action='store_true', help='no borrar el directorio de trabajo')
+    args = parser.parse_args()
+
+    output = os.path.abspath(args.output)
+    report = run(args)
+    with open(output, 'w', encoding='utf-8') as f:
+        json.dump(report, f, indent=2)
+
+    pipeline = report['results']['pipeline']
+    print(f"✅ {pipeline['completed']}/{pipeline['jobs']} trabajos, "
+          f"{pipeline['jobs_per_second']:.2f} trabajos/s, "
+          f"p95 total {(pipeline['stages']['total'] or {}).get('p95', 0):.2f}s")
+    print(f"📄 Resultados en {output}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,34 @@
+"""Configuración de gunicorn (se carga sola desde el directorio de trabajo)
+
+Con PRELOAD=1 (por defecto) la aplicación se importa y se precalienta una
+vez en el proceso maestro antes del fork: los workers arrancan sin volver a
+importar yt-dlp ni compilar los extractores, y comparten esa memoria.
+"""
+import gc
+import os
+import uuid
+
+preload_app = os.environ.get('PRELOAD', '1') == '1'
+
+# Identificador de este arranque, heredado por todos los workers (también sin
+# PRELOAD): los trabajos de jobs.db con otro arranque se recuperan sin esperar
+os.environ.setdefault('SERVER_BOOT_ID', uuid.uuid4().hex[:12])
+
+# Worker con hilos: SSE, long-poll, /api/stream y los ZIP mantienen una petición
+# abierta durante toda la conversión, y el worker síncrono atendería solo esa.
+# (Con SERVER_ENGINE=asgi el -k de la línea de órdenes tiene prioridad)
+worker_class = os.environ.get('GUNICORN_WORKER_CLASS', 'gthread')
+threads = int(os.environ.get('GUNICORN_THREADS', 64))
+# Con gthread el latido al maestro no espera a las peticiones: el límite solo
+# salta si el proceso entero deja de responder
+timeout = int(os.environ.get('GUNICORN_TIMEOUT', 120))
+
+
+def when_ready(server):
+    if not preload_app:
+        return
+    import app
+    app.warm_up()
+    # Que el recolector no recorra (y copie) los objetos heredados por los workers
+    gc.freeze()
+    server.log.info(app.startup_report())
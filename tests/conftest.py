@@ -0,0 +1,10 @@
+import os
+import sys
+import tempfile
+
+# app.py crea sus carpetas relativas al directorio actual al importarse
+os.chdir(tempfile.mkdtemp(prefix='ytmp3-tests-'))
+os.environ.setdefault('STATE_BACKEND_URL', 'memory://')
+for name in ('METADATA_RATE', 'CONVERT_RATE', 'MAX_CLIENT_JOBS'):
+    os.environ.setdefault(name, '0')
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
@@ -0,0 +1,28 @@
+import time
+import uuid
+
+import app as backend
+
+
+def test_finished_batch_gets_a_terminal_status_and_keeps_its_items(monkeypatch):
+    def enqueue_batch_item(url, params, client):
+        download_id = str(uuid.uuid4())
+        backend.set_progress(download_id, {'status': 'completed', 'percent': 100, 'title': url})
+        return {'download_id': download_id, 'coalesced': False}
+    monkeypatch.setattr(backend, 'enqueue_batch_item', enqueue_batch_item)
+    urls = [f'http://example.com/{index}' for index in range(3)]
+    batch_id = str(uuid.uuid4())
+    backend.set_progress(batch_id, {'type': 'batch', 'status': 'expanding', 'title': 'lote', 'items': [], 'error': None})
+
+    started = time.time()
+    backend.run_batch(batch_id, None, urls, backend.DEFAULT_AUDIO_PARAMS)
+
+    batch = backend.progress_store.get(batch_id)
+    assert batch['status'] == 'completed' and batch['status'] in backend.TERMINAL_STATUSES
+    summary = backend.batch_summary(batch_id)
+    assert summary['status'] == 'completed' and summary['expanded'] and summary['completed'] == 3
+    # Los elementos caducan a la vez que el lote, no antes
+    batch_expires = backend.progress_store.records[batch_id].expires_at
+    for item_id in batch['items']:
+        assert backend.progress_store.records[item_id].expires_at >= started + backend.PROGRESS_TTL
+        assert backend.progress_store.records[item_id].expires_at <= batch_expires
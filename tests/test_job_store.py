@@ -0,0 +1,47 @@
+import time
+
+import pytest
+
+import app as backend
+
+
+@pytest.fixture
+def store(tmp_path, monkeypatch):
+    store = backend.JobStore(str(tmp_path / 'jobs.db'))
+    monkeypatch.setattr(backend, 'job_store', store)
+    return store
+
+
+def add_row(store, download_id, owner, updated_at):
+    job = backend.Job(download_id, f'http://example.com/{download_id}', params=backend.DEFAULT_AUDIO_PARAMS)
+    store.save(job, 'queued')
+    store._connection().execute(
+        'UPDATE jobs SET owner = ?, updated_at = ? WHERE download_id = ?', (owner, updated_at, download_id)
+    )
+
+
+def test_rows_from_a_previous_boot_are_claimed_at_once(store):
+    now = time.time()
+    sibling = f'{backend.SERVER_BOOT_ID}:host:1:abc'
+    add_row(store, 'old-boot', 'previous:host:1:abc', now)
+    add_row(store, 'live-sibling', sibling, now)
+    add_row(store, 'dead-sibling', sibling, now - backend.JOB_LEASE_TTL - 1)
+
+    claimed = {job.download_id for job, _ in store.claim_orphans()}
+
+    assert claimed == {'old-boot', 'dead-sibling'}
+    assert store.claim_orphans() == []
+
+
+def test_finishing_a_leader_removes_recovered_follower_rows(store):
+    scheduler = backend.JobScheduler(1, 1, 10)
+    leader = backend.Job('leader', 'http://example.com/v', key='k', params=backend.DEFAULT_AUDIO_PARAMS)
+    store.save(leader, 'downloading')
+    add_row(store, 'follower', store.owner(), time.time())
+    leader.followers.append('follower')
+    backend.set_progress('leader', {'status': 'completed'})
+
+    scheduler._finish(leader)
+
+    assert store.ids() == set()
+    assert backend.progress_store.get('follower') == {'status': 'completed'}
@@ -0,0 +1,40 @@
+import pytest
+
+import app as backend
+
+
+@pytest.fixture
+def limited(monkeypatch):
+    monkeypatch.setattr(backend, 'MAX_CLIENT_JOBS', 2)
+    monkeypatch.setattr(backend, 'rate_limiter', backend.MemoryRateLimiter())
+    monkeypatch.setitem(backend.RATE_BUDGETS, 'convert', (0.001, 3))
+    return backend.app.test_client()
+
+
+def test_failed_admission_returns_job_and_cost(limited, monkeypatch):
+    for _ in range(3):
+        assert limited.post('/api/convert', json={'url': ['x']}).status_code == 400
+
+    def broken(url):
+        raise RuntimeError('boom')
+    monkeypatch.setattr(backend, 'normalize_video_url', broken)
+    # Más fallos que trabajos simultáneos y que fichas: ninguno se queda reservado ni cobrado
+    for _ in range(5):
+        assert limited.post('/api/convert', json={'url': 'http://example.com/v'}).status_code == 500
+
+
+def test_batch_items_count_against_client_jobs(limited, monkeypatch):
+    enqueued = []
+
+    def enqueue(url, params, download_id=None, client=None, priced=True, priority='interactive'):
+        enqueued.append(download_id)
+        return {'download_id': download_id, 'coalesced': False}
+    monkeypatch.setattr(backend, 'enqueue_conversion', enqueue)
+
+    params = backend.DEFAULT_AUDIO_PARAMS
+    assert backend.enqueue_batch_item('http://example.com/1', params, 'ip:1') is not None
+    assert backend.enqueue_batch_item('http://example.com/2', params, 'ip:1') is not None
+    # El tercero espera a que termine uno de los dos
+    assert backend.enqueue_batch_item('http://example.com/3', params, 'ip:1') is None
+    backend.release_client_job('ip:1', enqueued[0])
+    assert backend.enqueue_batch_item('http://example.com/3', params, 'ip:1') is not None
@@ -0,0 +1,66 @@
+import json
+
+import pytest
+
+import app as backend
+
+
+class StandInRedis:
+    """Sustituto mínimo de Redis: lo único que usa el almacén de progreso"""
+
+    def __init__(self):
+        self.data = {}
+
+    def get(self, key):
+        return self.data.get(key)
+
+    def set(self, key, value, ex=None):
+        self.data[key] = value.encode('utf-8') if isinstance(value, str) else value
+
+    def incr(self, key):
+        self.data[key] = str(int(self.data.get(key) or 0) + 1).encode('ascii')
+        return int(self.data[key])
+
+    def expire(self, key, seconds):
+        return key in self.data
+
+    def delete(self, *keys):
+        for key in keys:
+            self.data.pop(key, None)
+
+
+def test_progress_store_on_a_stand_in_client():
+    store = backend.RedisProgressStore(StandInRedis())
+    assert store.get('job') is None and store.version('job') == 0
+
+    store.set('job', {'status': 'downloading', 'percent': 10})
+    store.update('job', {'percent': 50})
+    assert store.get('job') == {'status': 'downloading', 'percent': 50}
+    assert store.version('job') == 2
+
+    store.delete('job')
+    assert store.get('job') is None and store.version('job') == 0
+
+
+def test_progress_store_and_limiter_on_fakeredis():
+    # Los límites son scripts Lua: hace falta un cliente con scripting (fakeredis con lupa)
+    fakeredis = pytest.importorskip('fakeredis')
+    pytest.importorskip('lupa')
+    client = fakeredis.FakeRedis()
+
+    store = backend.RedisProgressStore(client)
+    store.set('job', {'status': 'completed'})
+    assert json.loads(client.get('ytmp3:progress:job')) == {'status': 'completed'}
+    assert 0 < client.ttl('ytmp3:progress:job') <= backend.PROGRESS_TTL
+
+    limiter = backend.RedisRateLimiter(client)
+    assert limiter.take('convert:ip:1', 2, 1, 3) == 0
+    assert limiter.take('convert:ip:1', 2, 1, 3) == pytest.approx(1, abs=0.1)
+    # Un reembolso forzado devuelve las fichas
+    assert limiter.take('convert:ip:1', -2, 1, 3, force=True) == 0
+    assert limiter.take('convert:ip:1', 2, 1, 3) == 0
+
+    assert limiter.acquire_job('ip:1', 'a', 2) and limiter.acquire_job('ip:1', 'b', 2)
+    assert not limiter.acquire_job('ip:1', 'c', 2)
+    limiter.release_job('ip:1', 'a')
+    assert limiter.acquire_job('ip:1', 'c', 2)
@@ -0,0 +1,52 @@
+import threading
+import time
+
+import app as backend
+
+
+def test_downloads_wait_for_room_in_the_transcode_queue(monkeypatch, tmp_path):
+    downloaded = []
+    release_transcodes = threading.Event()
+    started_transcode = threading.Event()
+
+    def download_audio(url, download_id, params, timings=None):
+        source = tmp_path / f'{download_id}.webm'
+        source.write_bytes(b'audio')
+        downloaded.append(download_id)
+        return {'title': download_id, 'id': download_id, 'extractor_key': 'Generic'}, str(source)
+
+    def transcode_audio(source, download_id, params, info, timings=None):
+        started_transcode.set()
+        release_transcodes.wait(5)
+        return source
+
+    monkeypatch.setattr(backend, 'download_audio', download_audio)
+    monkeypatch.setattr(backend, 'transcode_audio', transcode_audio)
+    monkeypatch.setattr(backend, 'job_store', None)
+    monkeypatch.setattr(backend.result_cache, 'put', lambda temp_file, key, title: None)
+
+    # Un hueco de conversión y uno de espera: como mucho dos audios descargados a la vez
+    scheduler = backend.JobScheduler(3, 1, 10, transcode_backlog=1)
+    jobs = [backend.Job(f'job-{index}', f'http://example.com/{index}', params=backend.DEFAULT_AUDIO_PARAMS, priced=True)
+            for index in range(5)]
+    for job in jobs:
+        scheduler.submit(job)
+
+    assert started_transcode.wait(5)
+    # Con la conversión bloqueada, las descargas se detienen al llenarse la cola
+    for _ in range(20):
+        if len(downloaded) >= 2:
+            break
+        time.sleep(0.05)
+    time.sleep(0.2)
+    assert len(downloaded) == 2
+
+    release_transcodes.set()
+    for job in jobs:
+        progress_id = backend.resolve_download(job.download_id)
+        for _ in range(100):
+            if (backend.progress_store.get(progress_id) or {}).get('status') == 'completed':
+                break
+            time.sleep(0.05)
+    assert len(downloaded) == 5
+    assert scheduler.stats()['active_downloads'] == 0
@@ -0,0 +1,206 @@
+import os
+import threading
+import time
+from http.server import ThreadingHTTPServer
+
+import pytest
+
+import app as backend
+from benchmark import RangeRequestHandler
+
+
+class RecordingHandler(RangeRequestHandler):
+    requests = []
+    # Servidor sin Range: responde siempre 200 con el archivo entero
+    ranges = True
+    # Peticiones atendiéndose a la vez (cada una tarda al menos `delay` segundos)
+    delay = 0
+    active = 0
+    max_active = 0
+    lock = threading.Lock()
+
+    def do_GET(self):
+        cls = type(self)
+        with cls.lock:
+            cls.active += 1
+            cls.max_active = max(cls.max_active, cls.active)
+        try:
+            time.sleep(self.delay)
+            super().do_GET()
+        finally:
+            with cls.lock:
+                cls.active -= 1
+
+    def send_head(self):
+        self.requests.append((self.path, self.headers.get('Range')))
+        if not self.ranges:
+            del self.headers['Range']
+        return super().send_head()
+
+
+class CountingSemaphore(threading.BoundedSemaphore):
+    def __init__(self, value):
+        super().__init__(value)
+        self.acquired = 0
+
+    def acquire(self, *args, **kwargs):
+        self.acquired += 1
+        return super().acquire(*args, **kwargs)
+
+    __enter__ = acquire
+
+
+@pytest.fixture
+def media_server(tmp_path):
+    audio = os.urandom(300 * 1024 + 123)
+    (tmp_path / 'audio.webm').write_bytes(audio)
+    (tmp_path / 'video.mp4').write_bytes(b'\0' * 1024)
+    RecordingHandler.requests = []
+    RecordingHandler.ranges = True
+    RecordingHandler.delay = RecordingHandler.active = RecordingHandler.max_active = 0
+    handler = lambda *args, **kwargs: RecordingHandler(*args, directory=str(tmp_path), **kwargs)
+    server = ThreadingHTTPServer(('127.0.0.1', 0), handler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    yield f'http://127.0.0.1:{server.server_address[1]}/media', audio
+    server.shutdown()
+
+
+def youtube_like_info(base_url, page_url):
+    """Información como la que guarda la caché: la extracción eligió video+audio"""
+    video = {
+        'format_id': 'v1', 'url': f'{base_url}/video.mp4', 'ext': 'mp4', 'protocol': 'https',
+        'vcodec': 'avc1', 'acodec': 'none', 'width': 1280, 'height': 720, 'tbr': 2000,
+    }
+    audio = {
+        'format_id': 'a1', 'url': f'{base_url}/audio.webm', 'ext': 'webm', 'protocol': 'http',
+        'vcodec': 'none', 'acodec': 'opus', 'abr': 128, 'tbr': 128, 'asr': 48000,
+    }
+    return {
+        'id': 'segmented', 'title': 'Segmented', 'duration': 20,
+        'extractor': 'generic', 'extractor_key': 'Generic',
+        'webpage_url': page_url, 'original_url': page_url,
+        'formats': [video, audio],
+        'requested_formats': [dict(video), dict(audio)],
+        'format_id': 'v1+a1', 'ext': 'mp4', 'vcodec': 'avc1', 'acodec': 'opus',
+    }
+
+
+def test_multi_format_video_downloads_audio_by_ranges(media_server, monkeypatch):
+    base_url, audio = media_server
+    page_url = f'{base_url}/watch-1'
+    monkeypatch.setattr(backend, 'DOWNLOAD_CONNECTIONS', 3)
+    monkeypatch.setattr(backend, 'SEGMENT_SIZE', 64 * 1024)
+    monkeypatch.setattr(backend, 'PARALLEL_MIN_BYTES', 0)
+    backend.metadata_cache.put(page_url, youtube_like_info(base_url, page_url))
+
+    info, source = backend.download_audio(page_url, 'segmented-test')
+
+    assert info['format_id'] == 'a1'
+    assert not info.get('requested_formats')
+    with open(source, 'rb') as f:
+        assert f.read() == audio
+    paths = {path for path, _ in RecordingHandler.requests}
+    assert paths == {'/media/audio.webm'}
+    ranges = [value for _, value in RecordingHandler.requests]
+    assert len(ranges) == 5 and all(value and value.startswith('bytes=') for value in ranges)
+    os.remove(source)
+
+
+def test_oversized_download_without_known_size_is_rejected(media_server, monkeypatch):
+    base_url, _ = media_server
+    page_url = f'{base_url}/watch-2'
+    # Sin tamaño ni bitrate: solo yt-dlp puede ver que el archivo es demasiado grande
+    audio = {
+        'format_id': 'a1', 'url': f'{base_url}/audio.webm', 'ext': 'webm', 'protocol': 'http',
+        'vcodec': 'none', 'acodec': 'opus',
+    }
+    info = {
+        'id': 'oversized', 'title': 'Oversized', 'extractor': 'generic', 'extractor_key': 'Generic',
+        'webpage_url': page_url, 'formats': [audio],
+    }
+    monkeypatch.setattr(backend, 'DOWNLOAD_CONNECTIONS', 1)
+    monkeypatch.setattr(backend, 'MAX_FILESIZE', 100 * 1024)
+    # Pool nuevo: las opciones (max_filesize) solo se aplican al crear cada instancia
+    monkeypatch.setattr(backend, 'ytdl_pool', backend.YoutubeDLPool(backend.YTDL_POOL_IDLE))
+    backend.metadata_cache.put(page_url, info)
+
+    with pytest.raises(backend.JobRejected) as rejected:
+        backend.download_audio(page_url, 'oversized-test')
+    assert rejected.value.reason == 'filesize'
+
+    # El rechazo no descarta la instancia de yt-dlp
+    with pytest.raises(backend.JobRejected):
+        backend.download_audio(page_url, 'oversized-test-2')
+    assert (backend.ytdl_pool.created, backend.ytdl_pool.reused, backend.ytdl_pool.discarded) == (1, 1, 0)
+
+
+def audio_only_info(base_url, page_url, video_id):
+    audio = {
+        'format_id': 'a1', 'url': f'{base_url}/audio.webm', 'ext': 'webm', 'protocol': 'http',
+        'vcodec': 'none', 'acodec': 'opus', 'abr': 128,
+    }
+    return {
+        'id': video_id, 'title': video_id, 'duration': 20, 'extractor': 'generic', 'extractor_key': 'Generic',
+        'webpage_url': page_url, 'formats': [audio],
+    }
+
+
+@pytest.fixture
+def ranged(monkeypatch):
+    monkeypatch.setattr(backend, 'DOWNLOAD_CONNECTIONS', 3)
+    monkeypatch.setattr(backend, 'SEGMENT_SIZE', 64 * 1024)
+    monkeypatch.setattr(backend, 'PARALLEL_MIN_BYTES', 0)
+    slots = CountingSemaphore(backend.MAX_UPSTREAM_CONNECTIONS)
+    monkeypatch.setattr(backend, 'upstream_slots', slots)
+    return slots
+
+
+def test_resumes_from_the_last_complete_segment(media_server, ranged):
+    base_url, audio = media_server
+    page_url = f'{base_url}/watch-3'
+    backend.metadata_cache.put(page_url, audio_only_info(base_url, page_url, 'resume'))
+    # Un intento anterior dejó segmento y medio en el .part
+    with open(os.path.join(backend.TEMP_FOLDER, 'resume-test.webm.part'), 'wb') as part:
+        part.write(audio[:96 * 1024])
+
+    _, source = backend.download_audio(page_url, 'resume-test')
+
+    with open(source, 'rb') as f:
+        assert f.read() == audio
+    os.remove(source)
+    # El segmento a medias se repite; el primero no se vuelve a pedir
+    starts = sorted(int(value[len('bytes='):].split('-')[0]) for _, value in RecordingHandler.requests)
+    assert starts == [64 * 1024, 128 * 1024, 192 * 1024, 256 * 1024]
+
+
+def test_server_without_ranges_falls_back_to_yt_dlp(media_server, ranged):
+    base_url, audio = media_server
+    page_url = f'{base_url}/watch-4'
+    backend.metadata_cache.put(page_url, audio_only_info(base_url, page_url, 'noranges'))
+    RecordingHandler.ranges = False
+
+    _, source = backend.download_audio(page_url, 'noranges-test')
+
+    with open(source, 'rb') as f:
+        assert f.read() == audio
+    os.remove(source)
+    # La sonda de rangos y la descarga de yt-dlp, esta también dentro del límite de conexiones
+    assert len(RecordingHandler.requests) == 2
+    assert ranged.acquired == 2
+
+
+def test_parallel_segments_respect_the_upstream_cap(media_server, ranged, monkeypatch):
+    base_url, audio = media_server
+    page_url = f'{base_url}/watch-5'
+    backend.metadata_cache.put(page_url, audio_only_info(base_url, page_url, 'capped'))
+    monkeypatch.setattr(backend, 'DOWNLOAD_CONNECTIONS', 4)
+    monkeypatch.setattr(backend, 'upstream_slots', threading.BoundedSemaphore(2))
+    RecordingHandler.delay = 0.1
+
+    _, source = backend.download_audio(page_url, 'capped-test')
+
+    with open(source, 'rb') as f:
+        assert f.read() == audio
+    os.remove(source)
+    assert RecordingHandler.max_active == 2
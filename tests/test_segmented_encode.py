@@ -0,0 +1,89 @@
+import os
+import shutil
+import struct
+import subprocess
+
+import pytest
+
+import app as backend
+
+SAMPLE_RATE = 48000
+# Duración que no es múltiplo de 1152 muestras, para que el relleno final importe
+# (con algunas longitudes el propio ffmpeg declara unas decenas de muestras de menos)
+SAMPLES = 20 * SAMPLE_RATE + 1000
+
+pytestmark = pytest.mark.skipif(shutil.which(backend.FFMPEG_BINARY) is None, reason="ffmpeg no disponible")
+
+
+@pytest.fixture(scope='module')
+def fixture_wav(tmp_path_factory):
+    path = str(tmp_path_factory.mktemp('encode') / 'fixture.wav')
+    subprocess.run([
+        backend.FFMPEG_BINARY, '-y', '-loglevel', 'error',
+        '-f', 'lavfi', '-i', f'sine=frequency=440:sample_rate={SAMPLE_RATE}',
+        '-af', f'atrim=end_sample={SAMPLES}', '-ac', '2', path,
+    ], check=True)
+    return path
+
+
+def encode(fixture_wav, tmp_path, monkeypatch, segments, name):
+    """Convertir una copia del fixture (transcode_audio borra el origen)"""
+    monkeypatch.setattr(backend, 'SEGMENTED_ENCODE_MIN_DURATION', 0 if segments > 1 else float('inf'))
+    monkeypatch.setattr(backend, 'SEGMENT_ENCODERS', segments)
+    source = str(tmp_path / f'{name}.wav')
+    shutil.copy(fixture_wav, source)
+    source_format = {'duration': SAMPLES / SAMPLE_RATE, 'asr': SAMPLE_RATE, 'acodec': 'pcm_s16le'}
+    output = backend.transcode_audio(source, name, backend.DEFAULT_AUDIO_PARAMS, source_format)
+    with open(output, 'rb') as f:
+        data = f.read()
+    os.remove(output)
+    return data
+
+
+def strip_id3(data):
+    if data[:3] != b'ID3':
+        return data
+    size = int.from_bytes(bytes(byte & 0x7F for byte in data[6:10]), 'big')
+    return data[10 + size:]
+
+
+def decoded_samples(data, tmp_path):
+    path = str(tmp_path / 'decoded.mp3')
+    with open(path, 'wb') as f:
+        f.write(data)
+    pcm = subprocess.run([
+        backend.FFMPEG_BINARY, '-loglevel', 'error', '-i', path, '-f', 's16le', '-ac', '1', 'pipe:1',
+    ], check=True, capture_output=True).stdout
+    return len(pcm) // 2
+
+
+def xing_totals(data):
+    """(tramas, bytes) de la cabecera Xing y el CRC de la etiqueta LAME (guardado, calculado)"""
+    frames = list(backend.mp3_frames(data))
+    info_frame = data[:frames[0][1]]
+    xing = backend.mp3_info_offset(info_frame)
+    assert xing is not None
+    frame_count, byte_count = struct.unpack_from('>II', info_frame, xing + 8)
+    stored_crc = struct.unpack_from('>H', info_frame, xing + 120 + 34)[0]
+    return frames, frame_count, byte_count, (stored_crc, backend.lame_crc16(info_frame[:190]))
+
+
+def test_segmented_mp3_matches_single_encode(fixture_wav, tmp_path, monkeypatch):
+    single = strip_id3(encode(fixture_wav, tmp_path, monkeypatch, 1, 'single'))
+    segmented = strip_id3(encode(fixture_wav, tmp_path, monkeypatch, 3, 'segmented'))
+
+    frames, frame_count, byte_count, _ = xing_totals(single)
+    segmented_frames, segmented_count, segmented_bytes, (stored_crc, crc) = xing_totals(segmented)
+
+    # Mismas tramas de audio y una cabecera Xing que describe el archivo unido
+    assert len(segmented_frames) == len(frames)
+    assert segmented_count == frame_count
+    assert segmented_bytes == len(segmented)
+    assert sum(length for _, length in segmented_frames) == len(segmented)
+    assert stored_crc == crc
+
+    # Retardo y relleno de la etiqueta LAME: la decodificación es exacta a la muestra
+    assert backend.mp3_encoder_padding(segmented[:segmented_frames[0][1]]) == \
+        backend.mp3_encoder_padding(single[:frames[0][1]])
+    assert decoded_samples(segmented, tmp_path) == SAMPLES
+    assert decoded_samples(single, tmp_path) == SAMPLES
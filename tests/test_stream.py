@@ -0,0 +1,37 @@
+import pytest
+
+import app as backend
+
+
+def fake_stream_audio(info, cache_key, params):
+    yield from [b'audio'] * 3
+
+
+@pytest.fixture
+def stream_client(monkeypatch):
+    info = {
+        'id': 'stream', 'title': 'Stream', 'duration': 5, 'extractor_key': 'Generic',
+        'formats': [{'format_id': 'a1', 'url': 'http://127.0.0.1:9/audio.webm', 'ext': 'webm',
+                     'vcodec': 'none', 'acodec': 'opus', 'abr': 128}],
+    }
+    monkeypatch.setattr(backend, 'extract_video_info', lambda url, timings=None: dict(info))
+    monkeypatch.setattr(backend, 'stream_audio', fake_stream_audio)
+    monkeypatch.setattr(backend, 'stream_slots', backend.SlotPool(2))
+    monkeypatch.setattr(backend, 'MAX_CLIENT_JOBS', 2)
+    return backend.app.test_client()
+
+
+def test_head_does_not_take_a_stream_slot(stream_client):
+    for _ in range(5):
+        response = stream_client.head('/api/stream?url=http://example.com/a')
+        assert response.status_code == 200
+    assert backend.stream_slots.in_use == 0
+
+
+def test_stream_closed_early_frees_its_slot(stream_client):
+    for _ in range(5):
+        response = stream_client.get('/api/stream?url=http://example.com/a', buffered=False)
+        assert response.status_code == 200
+        # El cliente se va sin leerlo todo
+        response.close()
+    assert backend.stream_slots.in_use == 0